@@ -5,6 +5,8 @@ import numpy as _np
 import sys
 import copy as CM
 
+from pyhrf.graph import CSRGraph, as_csr_graph
+
 debug = 0
 
 def walkCluster(i, links, labels, l, remainingIndexes):
@@ -26,6 +28,7 @@ def walkCluster(i, links, labels, l, remainingIndexes):
 LINK_GRAPH_METHOD = 1
 LINK_MAT_METHOD = 0
 LINK_CLUST_METHOD = 2
+LINK_CSR_METHOD = 3
 
 def linkNodes(RefGraph, beta, GraphNodesLabels, GraphLinks, RefGrphNgbhPosi):
     
@@ -125,10 +128,66 @@ def set_cluster_labels(links, labels, nbClasses):
                     queue.update(links[k])
 
 
+def weighted_csr_graph(RefGraph, GraphWeight=None):
+    """
+    Return RefGraph as a pyhrf.graph.CSRGraph holding the edge weights
+    GraphWeight, which can be given with the same shape as RefGraph or
+    aligned with the CSR indices. RefGraph is returned unchanged if it is
+    already a CSRGraph and GraphWeight is None.
+    """
+    g = as_csr_graph(RefGraph)
+    if GraphWeight is None:
+        return g
+    if not isinstance(RefGraph, CSRGraph):
+        GraphWeight = _np.concatenate([_np.zeros(0)] +
+                                      [_np.asarray(w, dtype=float)
+                                       for w in GraphWeight])
+    return CSRGraph(g.indptr, g.indices, GraphWeight)
+
+
+def swendsen_wang_csr(graph, labels, beta, nb_labels, weights=None):
+    """
+    Vectorized Swendsen-Wang sampling step on a CSR graph.
+
+    Bonds between neighbours with the same label are drawn at once with
+    probability 1 - exp(-beta * weight), clusters are the connected components
+    of the bond graph and each cluster gets a uniformly drawn label. This is
+    the same Markov chain as linkNodes/pickLabels and
+    linkNodesSets/set_cluster_labels.
+
+    input:
+
+    * graph: pyhrf.graph.CSRGraph (or any graph format accepted by
+      pyhrf.graph.as_csr_graph, which is then converted at each call)
+    * labels: labels of the nodes, modified in place
+    * beta: normalization constant
+    * nb_labels: number of labels
+    * weights: optional edge weights aligned with graph.indices
+      (default is graph.weights, or 1.0)
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    graph = as_csr_graph(graph)
+    if weights is not None:
+        graph = CSRGraph(graph.indptr, graph.indices, weights)
+    nb_nodes = len(graph)
+    i, j, w = graph.upper_edges()
+
+    current = _np.asarray(labels)
+    bond_proba = 1. - _np.exp(-beta * (1. if w is None else w))
+    bonds = _np.where((current[i] == current[j]) &
+                      (_np.random.rand(len(i)) < bond_proba))[0]
+    bond_graph = coo_matrix((_np.ones(len(bonds), dtype=_np.int8),
+                             (i[bonds], j[bonds])), shape=(nb_nodes, nb_nodes))
+    nb_clusters, clusters = connected_components(bond_graph, directed=False)
+    labels[:] = _np.random.randint(nb_labels, size=nb_clusters)[clusters]
+
+
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 def SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,NbLabels,
-                              GraphLinks=None,RefGrphNgbhPosi=None, method=1,
-                              weights=None):
+                              GraphLinks=None,RefGrphNgbhPosi=None,
+                              method=LINK_CSR_METHOD, weights=None):
     """
     image sampling with Swendsen-Wang algorithm
 
@@ -141,6 +200,8 @@ def SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,NbLabels,
       ex: RefGraph[2][3]=10 means 3rd neighbour of the 2nd node is
       the 10th node.
       => There exists i such that RefGraph[10][i]=2
+      It is better given as a pyhrf.graph.CSRGraph when the sampler is
+      called repeatedly on the same graph.
     * GraphNodesLabels:
       list containing the nodes labels. The sampler aims to modify
       its values in function of beta and NbLabels.
@@ -160,6 +221,12 @@ def SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,NbLabels,
       Same shape as RefGraph. RefGrphNgbhPosi[i][j] indicates for which
       k is the link to i in RefGraph[RefGraph[i][j]][k]
       This optional list is never modified.
+    * method:
+      LINK_CSR_METHOD (vectorized, see swendsen_wang_csr), or the
+      pure python implementations LINK_MAT_METHOD and LINK_GRAPH_METHOD
+    * weights:
+      Optional edge weights. Same shape as RefGraph, or aligned with
+      RefGraph.indices for a CSRGraph and method LINK_CSR_METHOD.
 
     output:
 
@@ -167,6 +234,11 @@ def SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,NbLabels,
       resampled nodes labels. (not returned but modified)
     """
     
+    if method == LINK_CSR_METHOD:
+        swendsen_wang_csr(weighted_csr_graph(RefGraph, weights),
+                          GraphNodesLabels, beta, NbLabels)
+        return
+
     #initializations...
     NodesNb=len(RefGraph)
     
@@ -220,17 +292,27 @@ def Cpt_U_graph(RefGraph,GraphNodesLabels,GraphWeight=None):
       and contains the list of its neighbors entry location in the graph.
       ex: RefGraph[2][3]=10 means 3rd neighbour of the 2nd node is the 10th node.
       => There exists i such that RefGraph[10][i]=2
+      It can also be a pyhrf.graph.CSRGraph (then U is computed without loop).
     * GraphNodesLabels: list containing the nodes labels.
     * GraphWeight: Same shape as RefGraph. Each entry is the weight of the corresponding
-      edge in RefGraph. If not defined the weights are set to 1.0.
+      edge in RefGraph. If not defined the weights are set to 1.0 (or to
+      RefGraph.weights for a CSRGraph).
 
     output:
 
     * U value
     """
-    if GraphWeight==None:
-        GraphWeight=CptDefaultGraphWeight(RefGraph)
-        
+    if GraphWeight is None or isinstance(RefGraph, CSRGraph):
+        g = as_csr_graph(RefGraph)
+        if GraphWeight is not None:
+            g = CSRGraph(g.indptr, g.indices, GraphWeight)
+        labels = _np.asarray(GraphNodesLabels)
+        i, j, w = g.upper_edges()
+        same = labels[i] == labels[j]
+        if w is None:
+            return float(same.sum())
+        return float(w[same].sum())
+
     U=0.
     for i in xrange(len(RefGraph)):
         for j in xrange(len(RefGraph[i])):
@@ -263,47 +345,31 @@ def Cpt_Vec_U_graph(RefGraph,beta,LabelsNb,SamplesNb,
     * GraphNodesLabels: Optional list containing the nodes labels. The sampler aims to modify its values in function of
       beta and NbLabels. At this level this variable is seen as temporary and will be modified. Defining
       it slightly increases the calculation times.
-    * GraphLinks: Same shape as RefGraph. Each entry indicates if the link of the corresponding
-      edge in RefGraph is considered (if yes ...=1 else ...=0).
-      At this level this variable is seen as temporary and will be modified. Defining
-      it slightly increases the calculation times.
-    * RefGrphNgbhPosi: Same shape as RefGraph. RefGrphNgbhPosi[i][j] indicates for which k is the link to i in
-      RefGraph[RefGraph[i][j]][k]. This optional list is never modified.
+    * GraphLinks, RefGrphNgbhPosi: unused, kept for compatibility (the vectorized sampler does not need them).
 
     output:
 
     * VecU: Vector of size SamplesNb containing the U computations
     """
     #initialization
-    if GraphWeight is None:
-        GraphWeight=CptDefaultGraphWeight(RefGraph)
-    
-    if GraphNodesLabels==None:
-        GraphNodesLabels=CptDefaultGraphNodesLabels(RefGraph)
+    graph = weighted_csr_graph(RefGraph, GraphWeight)
+
+    if GraphNodesLabels is None:
+        GraphNodesLabels=CptDefaultGraphNodesLabels(graph)
     else:
         for i in xrange(len(GraphNodesLabels)):
             GraphNodesLabels[i]=0
     
-    if GraphLinks==None:
-        GraphLinks=CptDefaultGraphLinks(RefGraph)
-    
-    if RefGrphNgbhPosi==None:
-        RefGrphNgbhPosi=CptRefGrphNgbhPosi(RefGraph)
-        
     #all estimates of ImagLoc will then be significant in the expectation calculation (initial field is homogeneous)
-    SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,LabelsNb,
-                              GraphLinks=GraphLinks,RefGrphNgbhPosi=RefGrphNgbhPosi,
-                              weights=GraphWeight)
+    swendsen_wang_csr(graph, GraphNodesLabels, beta, LabelsNb)
     
     #estimation
     VecU=_np.zeros(SamplesNb)
     
     for i in xrange(SamplesNb):
-        SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,
-                                  LabelsNb,GraphLinks=GraphLinks,RefGrphNgbhPosi=RefGrphNgbhPosi,
-                                  weights=GraphWeight)
+        swendsen_wang_csr(graph, GraphNodesLabels, beta, LabelsNb)
         
-        VecU[i]=Cpt_U_graph(RefGraph,GraphNodesLabels,GraphWeight=GraphWeight)
+        VecU[i]=Cpt_U_graph(graph,GraphNodesLabels)
     
     return VecU
 
@@ -345,7 +411,7 @@ def CptRefGrphNgbhPosi(RefGraph):
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 def CptDefaultGraphNodesLabels(RefGraph):
     """
-    computes a default list GraphNodesLabels from RefGraph
+    computes a default array GraphNodesLabels from RefGraph
 
     input:
 
@@ -356,15 +422,10 @@ def CptDefaultGraphNodesLabels(RefGraph):
 
     output:
 
-    * GraphNodesLabels: List containing the nodes labels (consiedered for the computation of U). The sampler
-      aims to modify its values in function of beta and NbLabels.
+    * GraphNodesLabels: Array containing the nodes labels, all set to 0 (consiedered for the computation of U).
+      The sampler aims to modify its values in function of beta and NbLabels.
     """
-    
-    GraphNodesLabels=[]
-    for i in xrange(len(RefGraph)):
-        GraphNodesLabels.append(0)
-    
-    return GraphNodesLabels
+    return _np.zeros(len(RefGraph), dtype=int)
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 def CptDefaultGraphLinks(RefGraph):
@@ -434,8 +495,9 @@ def GraphBetaMix(RefGraph,GraphNodesLabels,beta=0.5,NbLabels=2,NbIt=5,weights=No
     * GraphNodesLabels: sampled GraphNodesLabels (not returned but modified)
     """
     
+    graph = weighted_csr_graph(RefGraph, weights)
     for i in xrange(NbIt):
-        SwendsenWangSampler_graph(RefGraph,GraphNodesLabels,beta,NbLabels,weights)
+        SwendsenWangSampler_graph(graph,GraphNodesLabels,beta,NbLabels)
         
 
 #+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
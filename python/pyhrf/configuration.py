@@ -59,7 +59,12 @@ defaults = {
     },
     'treatment-default': {
         'save_result_dump': 0,
-    }
+    },
+    'lnz-cache': {
+        # eg op.join(pyhrf_cfg_path, 'lnz_cache'). None: caching disabled
+        'cache_dir': None,
+        'max_entries': 500,
+    },
 }
 
 section_order = ['global',
@@ -67,7 +72,8 @@ section_order = ['global',
                  'parallel-LAN',
                  'parallel-local',
                  'parallel-cluster',
-                 'treatment-default']
+                 'treatment-default',
+                 'lnz-cache']
 
 cfg = defaults.copy()
 
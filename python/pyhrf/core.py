@@ -6,11 +6,13 @@ import cPickle
 import tempfile
 import logging
 
+from multiprocessing.sharedctypes import RawArray
+
 import numpy as np
 from pkg_resources import Requirement, resource_filename, resource_listdir
 import pyhrf
 from pyhrf.ndarray import MRI3Daxes, MRI4Daxes, expand_array_in_mask, TIME_AXIS
-from nipy.labs import compute_mask_files
+from nipy.labs.mask import compute_mask
 from pyhrf.tools import stack_trees, distance
 from pyhrf.graph import parcels_to_graphs, kerMask3D_6n, \
     graph_from_mesh, graph_is_sane, sub_graph
@@ -236,9 +238,43 @@ class FMRISessionSimulationData(XmlInitable):
                 'bold_file': self.simulation_file}
 
 
-def load_vol_bold_and_mask(bold_files, mask_file):
+def load_vol_bold_and_mask(bold_files, mask_file, in_mask_only=False,
+                           background_label=None, dtype=None):
+    """Load a functional mask and the BOLD volumes of all sessions.
+
+    Args:
+        bold_files (list of str): 4D BOLD volume of each session
+        mask_file (str): 3D label volume. If it does not exist, it is
+            computed from the first BOLD volume and saved.
+        in_mask_only (bool): if True, only the time series of in-mask voxels
+            are loaded, without loading the full volumes in memory (see
+            pyhrf.tools._io.read_bold_in_mask)
+        background_label (int): label of out-of-mask voxels (default 0).
+            Only used if *in_mask_only* is True.
+        dtype (numpy.dtype): storage type of BOLD data (eg np.float32). If
+            None, the type of the data in the first file is used.
+
+    Returns:
+        (mask, mask_meta_obj, mask_loaded_from_file, bold, session_scans)
+        where bold is a 4D array, or an array of shape
+        (nb_scans, nb_voxels_in_mask) if *in_mask_only* is True. Voxels with
+        zero variance are discarded from the mask.
+    """
+
+    from pyhrf.tools._io import (read_volume, discard_bad_data,
+                                 read_bold_in_mask, read_volume_stats,
+                                 write_volume, bold_stats)
 
-    from pyhrf.tools._io import read_volume, discard_bad_data
+    if type(bold_files[0]) is list:
+        bold_files = bold_files[0]
+
+    for bold_file in bold_files:
+        if not op.exists(bold_file):
+            raise Exception('File not found: ' + bold_file)
+
+    # Scans of the first session, when already read to compute the mask:
+    first_bold = None
+    first_bold_file = None
 
     # Handle mask
     if not op.exists(mask_file):
@@ -253,8 +289,26 @@ def load_vol_bold_and_mask(bold_files, mask_file):
         else:
             max_frac = .9
             connect_component = True
-        compute_mask_files(bold_files[0], mask_file, False, .4,
-                           max_frac, cc=connect_component)
+        # same as nipy.labs.compute_mask_files, the first session being read
+        # once for both the mask and the BOLD data:
+        if in_mask_only:
+            # the volume is not loaded as a whole but copied while its
+            # statistics are computed, then its in-mask voxels are read
+            # from the copy:
+            first_bold_file = tempfile.TemporaryFile(
+                dir=pyhrf.cfg['global']['tmp_path'])
+            stats, (affine, header), first_bold = \
+                read_volume_stats(bold_files[0], copy_file=first_bold_file)
+        else:
+            first_bold, (affine, header) = read_volume(bold_files[0],
+                                                       remove_nans=False)
+            stats = bold_stats(first_bold, time_axis=TIME_AXIS)
+            first_bold[np.isnan(first_bold)] = 0
+        computed_mask = compute_mask(stats.mean, stats.first, .4, max_frac,
+                                     cc=connect_component)
+        header['descrip'] = 'mask'
+        write_volume(computed_mask.astype(np.uint8), mask_file,
+                     (affine, header))
         mask_loaded_from_file = False
     else:
         mask_loaded_from_file = True
@@ -282,14 +336,28 @@ def load_vol_bold_and_mask(bold_files, mask_file):
     logger.info('Assuming orientation for BOLD files: ' +
                 string.join(MRI4Daxes, ','))
 
-    if type(bold_files[0]) is list:
-        bold_files = bold_files[0]
-
-    for bold_file in bold_files:
-        if not op.exists(bold_file):
-            raise Exception('File not found: ' + bold_file)
-
-        bold, _ = read_volume(bold_file)
+    if in_mask_only:
+        if background_label is None:
+            background_label = 0
+        if first_bold is not None:
+            bold_files = [first_bold] + list(bold_files[1:])
+        try:
+            bold, session_scans, _ = read_bold_in_mask(bold_files, mask,
+                                                       background_label,
+                                                       dtype)
+        finally:
+            if first_bold_file is not None:
+                first_bold_file.close()
+        logger.info('In-mask BOLD has shape %s', str(bold.shape))
+        return mask, mask_meta_obj, mask_loaded_from_file, bold, session_scans
+
+    for isession, bold_file in enumerate(bold_files):
+        if isession == 0 and first_bold is not None:
+            bold = first_bold
+        else:
+            bold, _ = read_volume(bold_file)
+        if dtype is not None:
+            bold = bold.astype(dtype)
         bolds.append(bold)
         session_scans.append(np.arange(last_scan,
                                        last_scan + bold.shape[TIME_AXIS],
@@ -418,6 +486,76 @@ def merge_fmri_sessions(fmri_data_sets):
 
 
 
+class SparseRoiMask(object):
+    """Compact n-ary mask: positions and labels of the non-background voxels.
+
+    It can be given instead of a full mask array to :class:`FmriData` to
+    avoid allocating a full volume for each parcel.
+
+    Args:
+        shape (tuple): spatial shape of the full mask
+        positions (tuple of numpy.ndarray): coordinates of the voxels in mask,
+            in C order (as returned by numpy.where)
+        labels (numpy.ndarray): label of each voxel in mask
+    """
+
+    def __init__(self, shape, positions, labels):
+        self.shape = shape
+        self.ndim = len(shape)
+        self.positions = positions
+        self.labels = labels
+
+
+class BoldBuffer(object):
+    """Single buffer holding the BOLD signals of several ROIs.
+
+    The signal of each ROI is stored as a contiguous (nb_scans, nb_voxels)
+    block so that ROI data sets only hold views on the buffer. The buffer is
+    either allocated in shared memory, and then seen without copy by the
+    processes forked after its creation, or mapped on a file.
+
+    Args:
+        nb_scans (int): number of scans
+        roi_sizes (list of int): number of voxels of each ROI
+        dtype (numpy.dtype): data type of the BOLD signals
+        filename (str): file backing the buffer. If None, the buffer is
+            allocated in shared memory
+    """
+
+    def __init__(self, nb_scans, roi_sizes, dtype=np.float64, filename=None):
+        self.nb_scans = nb_scans
+        self.roi_sizes = list(roi_sizes)
+        self.dtype = np.dtype(dtype)
+        self.offsets = np.concatenate(([0], np.cumsum(self.roi_sizes))) * nb_scans
+        self.filename = filename
+        size = max(int(self.offsets[-1]), 1)
+        if filename is None:
+            self.data = np.frombuffer(RawArray(self.dtype.char, size),
+                                      dtype=self.dtype)
+        else:
+            self.data = np.memmap(filename, dtype=self.dtype, mode='w+',
+                                  shape=(size,))
+
+    def get(self, iroi):
+        """Return the BOLD signal of the *iroi*-th ROI as a view on the buffer."""
+        return self.data[self.offsets[iroi]:self.offsets[iroi + 1]]\
+            .reshape(self.nb_scans, self.roi_sizes[iroi])
+
+    def __getstate__(self):
+        # A shared memory segment can not be pickled: the unpickled buffer is
+        # detached (ROI data sets keep their own copy of the signal).
+        # A file-backed buffer is mapped again when unpickled.
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.filename is not None and op.exists(self.filename):
+            self.data = np.memmap(self.filename, dtype=self.dtype, mode='r+',
+                                  shape=(max(int(self.offsets[-1]), 1),))
+
+
 # FIXME: remove the following class and rewrite the next function
 class Object(object):
     pass
@@ -468,12 +606,20 @@ class FmriGroupData(XmlInitable):
         return sout + '\n'.join([ds.getSummary(long=long)
                                  for ds in self.data_subjects])
 
-    def roi_split(self):
+    def roi_split(self, bold_storage=None):
         '''
         Retrieve a list of FmriGroupData object,
         each containing the data for all subject, in one ROI
+
+        See FmriData.roi_split for *bold_storage*
         '''
-        rfd = [ds.roi_split() for ds in self.data_subjects]
+        if bold_storage is None or bold_storage == 'shared':
+            storages = [bold_storage] * self.nbSubj
+        else:
+            storages = ['%s_subj%d' % (bold_storage, i)
+                        for i in xrange(self.nbSubj)]
+        rfd = [ds.roi_split(bold_storage=s)
+               for ds, s in zip(self.data_subjects, storages)]
         nb_rois = len(rfd[0])
         all_rois = []
         for roi_id in xrange(nb_rois):
@@ -581,7 +727,8 @@ class FmriData(XmlInitable):
         else:
             logger.info('bold shape: %s', str(bold.shape))
         logger.info('roi mask shape: %s', str(roiMask.shape))
-        logger.info('unique(mask): %s', str(np.unique(roiMask)))
+        if not isinstance(roiMask, SparseRoiMask):
+            logger.info('unique(mask): %s', str(np.unique(roiMask)))
 
         sessionsDurations = [len(ss) * tr for ss in sessionsScans]
         self.paradigm = Paradigm(onsets, sessionsDurations,
@@ -642,6 +789,8 @@ class FmriData(XmlInitable):
         self.bold = bold
         self.bold_full = bold
         self.bold_avg = None
+        self.bold_buffer = None
+        self.bold_buffer_index = None
 
         self.graphs = graphs
         self.edge_lengths = edge_lengths
@@ -669,8 +818,12 @@ class FmriData(XmlInitable):
 
     def store_mask_sparse(self, roiMask):
 
-        self.np_roi_mask = np.where(roiMask != self.backgroundLabel)
-        self.roi_ids_in_mask = roiMask[self.np_roi_mask]
+        if isinstance(roiMask, SparseRoiMask):
+            self.np_roi_mask = roiMask.positions
+            self.roi_ids_in_mask = roiMask.labels
+        else:
+            self.np_roi_mask = np.where(roiMask != self.backgroundLabel)
+            self.roi_ids_in_mask = roiMask[self.np_roi_mask]
         self.nb_voxels_in_mask = len(self.roi_ids_in_mask)
         self.spatial_shape = roiMask.shape
 
@@ -682,6 +835,28 @@ class FmriData(XmlInitable):
         return roi_mask
     roiMask = property(get_roi_mask)
 
+    def get_cropped_roi_mask(self):
+        """Return the roi mask restricted to the bounding box of the voxels in
+        mask, along with the corresponding voxel positions.
+        """
+        if self.nb_voxels_in_mask == 0:
+            return self.roiMask, self.np_roi_mask
+        corner = [p.min() for p in self.np_roi_mask]
+        positions = tuple(p - c for p, c in zip(self.np_roi_mask, corner))
+        shape = tuple(p.max() + 1 for p in positions)
+        roi_mask = np.zeros(shape, dtype=self.roi_ids_in_mask.dtype) + \
+            self.backgroundLabel
+        roi_mask[positions] = self.roi_ids_in_mask
+        return roi_mask, positions
+
+    def attach_bold_buffer(self, bold_buffer, index):
+        """Use the *index*-th ROI signal of *bold_buffer* (see BoldBuffer) as
+        BOLD signal, without copy.
+        """
+        self.bold_buffer = bold_buffer
+        self.bold_buffer_index = index
+        self.bold = self.bold_full = bold_buffer.get(index)
+
     # def __getstate__(self):
     #     return dict((k, v) for (k, v) in self.__dict__.iteritems() \
     #                     if k != 'roiMask')
@@ -696,13 +871,15 @@ class FmriData(XmlInitable):
                        paradigm_csv_file=DEFAULT_PARADIGM_CSV,
                        bold_files=[DEFAULT_BOLD_VOL_FILE],
                        tr=DEFAULT_BOLD_VOL_TR, background_label=None,
-                       paradigm_csv_delim=None):
+                       paradigm_csv_delim=None, bold_dtype=None):
         paradigm = Paradigm.from_csv(paradigm_csv_file,
                                      delim=paradigm_csv_delim)
         durations = paradigm.stimDurations
         onsets = paradigm.stimOnsets
 
-        m, mmo, mlf, b, ss = load_vol_bold_and_mask(bold_files, mask_file)
+        m, mmo, mlf, b, ss = load_vol_bold_and_mask(
+            bold_files, mask_file, in_mask_only=True,
+            background_label=background_label, dtype=bold_dtype)
         mask = m
         mask_meta_obj = mmo
         mask_loaded_from_file = mlf
@@ -719,7 +896,8 @@ class FmriData(XmlInitable):
                     paradigm_csv_file=paradigm_csv_file,
                     bold_files=bold_files, tr=tr,
                     background_label=background_label,
-                    paradigm_csv_delim=paradigm_csv_delim)
+                    paradigm_csv_delim=paradigm_csv_delim,
+                    bold_dtype=bold_dtype)
         return fd
 
     @PickleableStaticMethod
@@ -732,7 +910,8 @@ class FmriData(XmlInitable):
             durations[rel_conditions[i]] = paradigm.stimDurations[
                 rel_conditions[i]]
             onsets[rel_conditions[i]] = paradigm.stimOnsets[rel_conditions[i]]
-        m, mmo, mlf, b, ss = load_vol_bold_and_mask(bold_files, mask_file)
+        m, mmo, mlf, b, ss = load_vol_bold_and_mask(bold_files, mask_file,
+                                                    in_mask_only=True)
         mask = m
         mask_meta_obj = mmo
         mask_loaded_from_file = mlf
@@ -803,7 +982,8 @@ class FmriData(XmlInitable):
             durations = None
 
         mask, mmo, mlf, bold, session_scans = \
-            load_vol_bold_and_mask(bold_files, mask_file)
+            load_vol_bold_and_mask(bold_files, mask_file, in_mask_only=True,
+                                   background_label=background_label)
         mask_meta_obj = mmo
         mask_loaded_from_file = mlf
         fmri_data = FmriData(onsets, bold, tr, session_scans, mask,
@@ -1009,7 +1189,9 @@ class FmriData(XmlInitable):
             if self.data_type == 'volume':
                 logger.info('Building graph from volume ...')
                 to_discard = [self.backgroundLabel]
-                self.graphs = parcels_to_graphs(self.roiMask,
+                # graph indexes only depend on the order of voxels in mask,
+                # which is kept when cropping the mask:
+                self.graphs = parcels_to_graphs(self.get_cropped_roi_mask()[0],
                                                 kerMask3D_6n,
                                                 toDiscard=to_discard)
                 logger.info('Graph built (%d rois)!', len(self.graphs.keys()))
@@ -1046,41 +1228,79 @@ class FmriData(XmlInitable):
         else:
             return self.graphs
 
-    def roi_split(self, mask=None):
-        if mask is None:
-            mask = self.roiMask
+    def roi_split(self, mask=None, bold_storage=None):
+        """Split data into one FmriData object per parcel of *mask*
 
-        assert mask.shape == self.roiMask.shape
+        Parcel data sets only store the positions of their voxels, the full
+        mask being rebuilt on demand (see roiMask).
+
+        Args:
+            mask (numpy.ndarray): n-ary mask defining parcels, must have the
+                same non-background positions as the current roi mask.
+                Defaults to the current roi mask.
+            bold_storage (str): if None, each parcel holds a copy of its BOLD
+                signal. If "shared", all parcel signals are stored in a single
+                BoldBuffer in shared memory. Otherwise, it is the name of the
+                file backing the BoldBuffer. In the two last cases, parcels
+                hold views on the buffer.
+
+        Return:
+            list of FmriData, ordered by parcel label
+        """
+        if mask is None:
+            positions = self.np_roi_mask
+            in_mask = self.roi_ids_in_mask
+        else:
+            assert mask.shape == self.spatial_shape
+            positions = np.where(mask != self.backgroundLabel)
+            in_mask = mask[positions]
 
         onsets = self.paradigm.stimOnsets
         durations = self.paradigm.stimDurations
 
-        in_mask = mask[np.where(mask != self.backgroundLabel)]
-        data_rois = []
-        for roiId in np.unique(mask):
-            if roiId != self.backgroundLabel:
-                mroi = np.where(mask == roiId)
-                roiMask = np.zeros_like(mask) + self.backgroundLabel
-                roiMask[mroi] = roiId
-                mroi_bold = np.where(in_mask == roiId)
-                roiBold = self.bold[:, mroi_bold[0]]
-                roiGraph = None
-                if self.graphs is not None:
-                    roiGraph = self.graphs[roiId]
-                    logger.info('graph for roi %s has %d nodes',
-                                roiId, len(roiGraph))
-                else:
-                    logger.info('graph for roi %s is None', (roiId))
+        # group voxels by parcel, keeping their order within each parcel:
+        voxel_order = np.argsort(in_mask, kind='mergesort')
+        roi_ids, starts = np.unique(in_mask[voxel_order], return_index=True)
+        stops = np.append(starts[1:], len(voxel_order))
 
-                simulation = get_roi_simulation(
-                    self.simulation, in_mask, roiId)
+        bold_buffer = None
+        if bold_storage is not None:
+            filename = None if bold_storage == 'shared' else bold_storage
+            bold_buffer = BoldBuffer(self.bold.shape[0], stops - starts,
+                                     self.bold.dtype, filename)
 
-                data_rois.append(FmriData(onsets, roiBold, self.tr,
-                                          self.sessionsScans, roiMask,
-                                          {roiId: roiGraph},
-                                          durations, self.meta_obj,
-                                          simulation, self.backgroundLabel,
-                                          self.data_files, self.data_type))
+        data_rois = []
+        for iroi, (roiId, start, stop) in enumerate(zip(roi_ids, starts,
+                                                        stops)):
+            mroi_bold = voxel_order[start:stop]
+            if bold_buffer is None:
+                roiBold = self.bold[:, mroi_bold]
+            else:
+                roiBold = bold_buffer.get(iroi)
+                roiBold[:] = self.bold[:, mroi_bold]
+            roiMask = SparseRoiMask(self.spatial_shape,
+                                    tuple(p[mroi_bold] for p in positions),
+                                    in_mask[mroi_bold])
+            roiGraph = None
+            if self.graphs is not None:
+                roiGraph = self.graphs[roiId]
+                logger.info('graph for roi %s has %d nodes',
+                            roiId, len(roiGraph))
+            else:
+                logger.info('graph for roi %s is None', (roiId))
+
+            simulation = get_roi_simulation(
+                self.simulation, in_mask, roiId)
+
+            roi_data = FmriData(onsets, roiBold, self.tr,
+                                self.sessionsScans, roiMask,
+                                {roiId: roiGraph},
+                                durations, self.meta_obj,
+                                simulation, self.backgroundLabel,
+                                self.data_files, self.data_type)
+            if bold_buffer is not None:
+                roi_data.attach_bold_buffer(bold_buffer, iroi)
+            data_rois.append(roi_data)
         return data_rois
 
     def discard_small_rois(self, min_size):
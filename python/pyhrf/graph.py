@@ -3,6 +3,10 @@
 Module to handle graphs.
 Base structures :
 - undirected, unweighted graph: a list of neighbours index (list of numpy array).
+- the same graph in compressed sparse row format (CSRGraph), as built by the
+  vectorized lattice functions (lattice_graph, parcels_to_csr_graphs). It is
+  the representation used by the VEM, MCMC and Potts field code
+  (see as_csr_graph).
 """
 
 import logging
@@ -94,6 +98,8 @@ def graph_from_mesh(polygonList):
 
 
 def graph_nb_cliques(graph):
+    if isinstance(graph, CSRGraph):
+        return graph.nb_cliques()
     return sum([len(x) for x in graph]) / 2.
 
 
@@ -176,6 +182,303 @@ kerMask2D_8n = (np.array([-1, 1, 0, 0, -1, 1, -1, 1], dtype=int),
                 np.array([0, 0, 1, -1, -1, 1, 1, -1], dtype=int))
 
 
+class CSRGraph(object):
+    """ Graph stored in compressed sparse row (CSR) format: the neighbours of
+    node i are indices[indptr[i]:indptr[i+1]].
+
+    It behaves as a sequence of neighbour arrays (len, indexing by node,
+    iteration), like the list-of-neighbours format. The latter is still
+    available as a compatibility view through :meth:`to_lists`.
+
+    Neighbour sums, which are the core of Potts field computations, are
+    sparse matrix-vector products (see :meth:`sum_over_neighbours`).
+
+    Args:
+        - indptr (np.ndarray): offsets of the neighbour lists, of size
+          nb_nodes + 1
+        - indices (np.ndarray): concatenated neighbour lists
+        - weights (np.ndarray): optional edge weights, aligned with indices
+    """
+
+    def __init__(self, indptr, indices, weights=None):
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            assert weights.shape == self.indices.shape
+        self.weights = weights
+        self._sparse_matrix = None
+        self._upper_edges = None
+
+    @classmethod
+    def from_lists(cls, graph):
+        """ Build a CSR graph from a list of neighbour index arrays
+        """
+        if isinstance(graph, CSRGraph):
+            return graph
+        degrees = np.array([len(nl) for nl in graph], dtype=np.int32)
+        indptr = np.zeros(len(graph) + 1, dtype=np.int32)
+        np.cumsum(degrees, out=indptr[1:])
+        if indptr[-1] > 0:
+            indices = np.concatenate([np.asarray(nl, dtype=np.int32)
+                                      for nl in graph if len(nl) > 0])
+        else:
+            indices = np.array([], dtype=np.int32)
+        return cls(indptr, indices)
+
+    @classmethod
+    def from_padded(cls, neighbours_indexes):
+        """ Build a CSR graph from a 2D array of neighbours where rows are
+        padded with negative values (eg BOLDSamplerInput.neighboursIndexes)
+        """
+        neighbours_indexes = np.asarray(neighbours_indexes)
+        valid = neighbours_indexes >= 0
+        indptr = np.zeros(len(neighbours_indexes) + 1, dtype=np.int32)
+        np.cumsum(valid.sum(1), out=indptr[1:])
+        return cls(indptr, neighbours_indexes[valid])
+
+    @classmethod
+    def block_diag(cls, graphs):
+        """ Concatenate graphs into a single graph with no edge between them:
+        node indexes of each graph are shifted by the number of nodes of the
+        previous ones.
+        """
+        graphs = [as_csr_graph(g) for g in graphs]
+        nb_nodes = np.array([len(g) for g in graphs], dtype=np.int32)
+        nb_edges = np.array([len(g.indices) for g in graphs], dtype=np.int32)
+        node_offsets = np.concatenate(([0], np.cumsum(nb_nodes)[:-1]))
+        edge_offsets = np.concatenate(([0], np.cumsum(nb_edges)[:-1]))
+        indptr = np.concatenate([g.indptr[:-1] + eo for g, eo in
+                                 zip(graphs, edge_offsets)] +
+                                [[nb_edges.sum()]])
+        indices = np.concatenate([np.zeros(0, dtype=np.int32)] +
+                                 [g.indices + no for g, no in
+                                  zip(graphs, node_offsets)])
+        if len(graphs) > 0 and all(g.weights is not None for g in graphs):
+            weights = np.concatenate([g.weights for g in graphs])
+        else:
+            weights = None
+        return cls(indptr, indices, weights)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def __iter__(self):
+        for node in xrange(len(self)):
+            yield self[node]
+
+    def get_nb_nodes(self):
+        return len(self)
+    nb_nodes = property(get_nb_nodes)
+
+    def degrees(self):
+        """ Return the number of neighbours of each node """
+        return np.diff(self.indptr)
+
+    def nb_cliques(self):
+        """ Return the number of edges (each one being stored twice) """
+        return len(self.indices) / 2.
+
+    def upper_edges(self):
+        """ Return the edges (i, j) such that i < j, ie each undirected edge
+        once, as a tuple (i, j, weights) of arrays where weights is None if
+        the graph is not weighted. The result is cached. """
+        if self._upper_edges is None:
+            rows = np.repeat(np.arange(len(self), dtype=np.int32),
+                             self.degrees())
+            upper = np.where(rows < self.indices)[0]
+            if self.weights is None:
+                weights = None
+            else:
+                weights = self.weights[upper]
+            self._upper_edges = (rows[upper], self.indices[upper], weights)
+        return self._upper_edges
+
+    def greedy_colouring(self):
+        """ Return the colour (int) of each node, such that neighbours have
+        different colours. Nodes are coloured in breadth-first order with the
+        smallest colour not taken by their neighbours, which gives 2 colours
+        for bipartite graphs, eg lattices with 6-connectivity (4 in 2D).
+        """
+        from scipy.sparse.csgraph import breadth_first_order
+        adjacency = self.to_sparse_matrix()
+        colours = np.zeros(len(self), dtype=np.int32) - 1
+        for root in xrange(len(self)):
+            if colours[root] >= 0:
+                continue
+            for node in breadth_first_order(adjacency, root, directed=False,
+                                            return_predecessors=False):
+                taken = set(colours[self[node]])
+                colour = 0
+                while colour in taken:
+                    colour += 1
+                colours[node] = colour
+        return colours
+
+    def colour_classes(self):
+        """ Return the list of node index arrays of each colour of
+        :meth:`greedy_colouring`. Nodes of a same class are not neighbours, so
+        that a Markov field defined on the graph can be updated one whole
+        class at a time in a Gibbs sampler.
+        """
+        colours = self.greedy_colouring()
+        nb_colours = colours.max() + 1 if len(colours) > 0 else 0
+        return [np.where(colours == c)[0] for c in xrange(nb_colours)]
+
+    def to_padded(self, fill=-1, dtype=np.int32):
+        """ Return the 2D array of neighbours where rows are padded with
+        *fill*, as expected by C extensions """
+        degrees = self.degrees()
+        width = degrees.max() if len(degrees) > 0 else 0
+        padded = np.empty((len(self), width), dtype=dtype)
+        padded.fill(fill)
+        rows = np.repeat(np.arange(len(self)), degrees)
+        cols = np.arange(len(self.indices)) - self.indptr[rows]
+        padded[rows, cols] = self.indices
+        return padded
+
+    def to_sparse_matrix(self):
+        """ Return the (weighted) adjacency matrix as a scipy.sparse
+        csr_matrix, which is built once and cached """
+        if self._sparse_matrix is None:
+            from scipy.sparse import csr_matrix
+            if self.weights is None:
+                data = np.ones(len(self.indices))
+            else:
+                data = self.weights
+            self._sparse_matrix = csr_matrix((data, self.indices, self.indptr),
+                                             shape=(len(self), len(self)))
+        return self._sparse_matrix
+
+    def sum_over_neighbours(self, array):
+        """ Sum *array* over the (weighted) neighbours of each node, along
+        its last axis which must be of size nb_nodes. This is a single sparse
+        matrix product, without any padding copy of *array*.
+        """
+        array = np.asarray(array)
+        if array.shape[-1] != len(self):
+            raise Exception("Can't sum over neighbours. Please check "
+                            "dimensions")
+        flat = array.reshape(-1, len(self))
+        summed = self.to_sparse_matrix().dot(flat.T).T
+        return summed.reshape(array.shape)
+
+    def to_lists(self):
+        """ Return the list-of-neighbours format: an object array holding
+        the (int) array of neighbours of each node """
+        lists = np.empty(len(self), dtype=object)
+        for node, nl in enumerate(np.split(self.indices.astype(int),
+                                           self.indptr[1:-1])):
+            lists[node] = nl
+        return lists
+
+    def is_sane(self):
+        """ Vectorized version of :func:`graph_is_sane` (toroidal=False) """
+        nb_nodes = len(self)
+        rows = np.repeat(np.arange(nb_nodes), self.degrees())
+        edges = rows.astype(np.int64) * nb_nodes + self.indices
+        unique_edges = np.unique(edges)
+        if len(unique_edges) != len(edges):
+            logger.info('duplicate neighbours')
+            return False
+        reversed_edges = self.indices.astype(np.int64) * nb_nodes + rows
+        if not np.in1d(reversed_edges, unique_edges,
+                       assume_unique=True).all():
+            logger.info('neighbourhood relation is not symmetric')
+            return False
+        return True
+
+
+def as_csr_graph(graph):
+    """ Return *graph* as a CSRGraph. It can already be a CSRGraph, a list of
+    neighbour arrays or a 2D array of neighbours padded with negative values.
+    """
+    if isinstance(graph, CSRGraph):
+        return graph
+    if isinstance(graph, np.ndarray) and graph.ndim == 2 and \
+            graph.dtype != object:
+        return CSRGraph.from_padded(graph)
+    return CSRGraph.from_lists(graph)
+
+
+def _default_ker_mask(ndim):
+    # Full neighbourhood, ie 8 in 2D, 26 in 3D ...
+    neighbourCoords = list(cartesian(*[[0, -1, 1]] * ndim))[1:]
+    return tuple(np.array(neighbourCoords, dtype=int).transpose())
+
+
+def _lattice_neighbours(positions, indexes, kerMask, toroidal=False,
+                        labels=None):
+    """ Compute neighbours of all given lattice positions at once.
+
+    Args:
+        - positions (tuple of np.ndarray): coordinates of nodes
+        - indexes (np.ndarray): node index at each lattice position, -1 for
+          positions which are not nodes
+        - kerMask (tuple of np.ndarray): relative coordinates of neighbours
+        - toroidal (bool): wrap coordinates around lattice borders
+        - labels (np.ndarray): if not None, only positions with the same
+          label are neighbours
+
+    Return: (indptr, indices) of the CSR adjacency, where neighbours of each
+            node are in the order of kerMask.
+    """
+    shape = indexes.shape
+    nb_nodes = len(positions[0])
+    if labels is not None:
+        node_labels = labels[positions]
+    neighbours = np.empty((nb_nodes, len(kerMask[0])), dtype=np.int32)
+    for k in xrange(len(kerMask[0])):
+        inside = np.ones(nb_nodes, dtype=bool)
+        coords = []
+        for ic in xrange(len(shape)):
+            comp = positions[ic] + kerMask[ic][k]
+            if not toroidal:
+                inside &= (comp >= 0) & (comp < shape[ic])
+                np.clip(comp, 0, shape[ic] - 1, comp)
+            else:  # same as center_mask_at
+                comp[comp < 0] = shape[ic] - 1
+                comp[comp >= shape[ic]] = 0
+            coords.append(comp)
+        coords = tuple(coords)
+        nk = indexes[coords]
+        nk[~inside] = -1
+        if labels is not None:
+            nk[labels[coords] != node_labels] = -1
+        neighbours[:, k] = nk
+
+    valid = neighbours >= 0
+    indptr = np.zeros(nb_nodes + 1, dtype=np.int32)
+    np.cumsum(valid.sum(1), out=indptr[1:])
+    return indptr, neighbours[valid]
+
+
+def lattice_graph(mask, kerMask=None, toroidal=False):
+    """ Vectorized construction of the graph of a n-dimensional lattice.
+
+    Args:
+        - mask (np.ndarray): non-zero values define the nodes, indexed in the
+          order of np.where(mask)
+        - kerMask (tuple of np.ndarray): relative positions of neighbours.
+          Default is the full neighbourhood (8 in 2D, 26 in 3D, ...).
+        - toroidal (bool): wrap the lattice around its borders
+
+    Return: CSRGraph
+    """
+    if kerMask is not None:
+        assert mask.ndim == len(kerMask)
+    else:
+        kerMask = _default_ker_mask(mask.ndim)
+    positions = np.where(mask)
+    indexes = np.zeros(mask.shape, dtype=np.int32) - 1
+    indexes[positions] = np.arange(len(positions[0]), dtype=np.int32)
+    return CSRGraph(*_lattice_neighbours(positions, indexes, kerMask,
+                                         toroidal))
+
+
 def graph_pool_indexes(g):
     nodeMap = dict([(v, iv) for iv, v in enumerate(nodes)])
     for nl in subg:
@@ -204,34 +507,16 @@ def graph_from_lattice3D(mask, kerMask=None, depth=1, toroidal=False):
     neighbourhood system, ie the relative positions of neighbours for a given
     position in the lattice.
     """
-    # print 'size:', latticeIndexes.size
     if kerMask is not None:
         assert mask.ndim == len(kerMask)
     else:
-        # Full neighbourhood, ie 8 in 2D, 26 in 3D ...
-        ndim = mask.ndim
-        neighbourCoords = list(cartesian(*[[0, -1, 1]] * ndim))[1:]
-        kerMask = tuple(np.array(neighbourCoords, dtype=int).transpose())
-
-    # loop over valid positions:
-
-    positions = np.array(np.where(mask >= 0)).transpose()
-    # print "----------------------------"
-    # print np.prod(mask.shape)
-    # print positions.shape
-    # print "----------------------------"
-    # raw_input('')
-    #positions = mask_to_coords(mask)
+        kerMask = _default_ker_mask(mask.ndim)
+
+    positions = np.where(mask >= 0)
     latticeIndexes = lattice_indexes(mask)
-    # print positions
-    # print positions.shape
     # Build lists of closest neighbours:
-    closestNeighbours = np.empty(len(positions), dtype=object)
-    for idx, pos in enumerate(positions):
-        # print 'idx :', idx, '- pos:', pos
-        # O(n) :
-        m = center_mask_at(kerMask, pos, latticeIndexes, toroidal)
-        closestNeighbours[idx] = latticeIndexes[m][latticeIndexes[m] >= 0]
+    closestNeighbours = CSRGraph(*_lattice_neighbours(
+        positions, latticeIndexes, kerMask, toroidal)).to_lists()
 
     if depth == 1:
         return closestNeighbours
@@ -275,6 +560,11 @@ def graph_to_sparse_matrix(graph):
     (list of neighbors list)
     """
     from scipy.sparse.coo import coo_matrix
+    if isinstance(graph, CSRGraph):
+        rows = np.repeat(np.arange(len(graph)), graph.degrees())
+        return coo_matrix((np.ones(len(graph.indices), dtype=int),
+                           (rows, graph.indices)),
+                          shape=(len(graph), len(graph)))
     n_vox = len(graph)
 
     ij = [[], []]
@@ -293,29 +583,9 @@ def graph_from_lattice(mask, kerMask=None, depth=1, toroidal=False):
     neighbourhood system, ie the relative positions of neighbours for a given
     position in the lattice.
     """
-    # print 'size:', latticeIndexes.size
-    if kerMask is not None:
-        assert mask.ndim == len(kerMask)
-    else:
-        # Full neighbourhood, ie 8 in 2D, 26 in 3D ...
-        ndim = mask.ndim
-        neighbourCoords = list(cartesian(*[[0, -1, 1]] * ndim))[1:]
-        kerMask = tuple(np.array(neighbourCoords, dtype=int).transpose())
-
-    # loop over valid positions:
-    # print mask.shape
-    positions = mask_to_coords(mask)
-    latticeIndexes = lattice_indexes(mask)
-    # print positions
-    # print positions.shape
-    # Build lists of closest neighbours:
-    closestNeighbours = np.empty(len(positions), dtype=object)
-    for idx, pos in enumerate(positions):
-        # print 'idx :', idx, '- pos:', pos
-        # O(n) :
-        m = center_mask_at(kerMask, pos, latticeIndexes, toroidal)
-        # print 'm:', m
-        closestNeighbours[idx] = latticeIndexes[m][latticeIndexes[m] >= 0]
+    # Build lists of closest neighbours (see lattice_graph for the CSR
+    # format):
+    closestNeighbours = lattice_graph(mask, kerMask, toroidal).to_lists()
 
     if depth == 1:
         return closestNeighbours
@@ -567,6 +837,25 @@ def parcels_to_graphs(parcellation, kerMask, toKeep=None, toDiscard=None):
     -------
     a dictionary mapping a roi ID to its graph
 
+    """
+    return dict((pid, g.to_lists()) for pid, g in
+                parcels_to_csr_graphs(parcellation, kerMask, toKeep,
+                                      toDiscard).iteritems())
+
+
+def parcels_to_csr_graphs(parcellation, kerMask, toKeep=None, toDiscard=None):
+    """Compute graphs (:class:`CSRGraph`) of all parcels in one pass over
+    the labelled volume. Nodes of a parcel are indexed in the order of
+    np.where(parcellation == parcel_id).
+
+    Parameters
+    ----------
+    see :func:`parcels_to_graphs`
+
+    Returns
+    -------
+    a dictionary mapping a roi ID to its graph
+
     """
     # determine the set of parcels to work on:
     parcelIds = np.unique(parcellation)  # everything
@@ -576,15 +865,40 @@ def parcels_to_graphs(parcellation, kerMask, toKeep=None, toDiscard=None):
     if toDiscard is not None:
         #assert set(toDiscard).issubset(set(parcelIds))
         parcelIds = set(parcelIds).difference(toDiscard)
-    # print 'parcelIds:', parcelIdsx
+    parcelIds = sorted(parcelIds)
+    if kerMask is None:
+        kerMask = _default_ker_mask(parcellation.ndim)
+
+    positions = np.where(np.in1d(parcellation, parcelIds).reshape(
+        parcellation.shape))
+    # group nodes by parcel, keeping their order within a parcel:
+    order = np.argsort(parcellation[positions], kind='mergesort')
+    sorted_labels = parcellation[positions][order]
+    starts = np.searchsorted(sorted_labels, parcelIds, 'left')
+    ends = np.searchsorted(sorted_labels, parcelIds, 'right')
+    # index of each node within its parcel:
+    indexes = np.zeros(parcellation.shape, dtype=np.int32) - 1
+    local_indexes = np.empty(len(order), dtype=np.int32)
+    local_indexes[order] = (np.arange(len(order)) -
+                            np.repeat(starts, ends - starts))
+    indexes[positions] = local_indexes
+
+    indptr, indices = _lattice_neighbours(positions, indexes, kerMask,
+                                          labels=parcellation)
+    # reorder rows by parcel:
+    degrees = np.diff(indptr)[order]
+    sorted_indptr = np.zeros(len(order) + 1, dtype=np.int32)
+    np.cumsum(degrees, out=sorted_indptr[1:])
+    sorted_indices = indices[np.repeat(indptr[order] - sorted_indptr[:-1],
+                                       degrees) +
+                             np.arange(sorted_indptr[-1])]
 
     parcelGraphs = {}
-    parcelNodeMap = {}
-    # loop over parcels
-    for pid in parcelIds:
-        parcelGraphs[pid] = graph_from_lattice(parcellation == pid,
-                                               kerMask=kerMask)
-        # print 'pg:', parcelGraphs[pid]
-        assert graph_is_sane(parcelGraphs[pid])
+    for pid, start, end in zip(parcelIds, starts, ends):
+        offset = sorted_indptr[start]
+        parcelGraphs[pid] = CSRGraph(
+            sorted_indptr[start:end + 1] - offset,
+            sorted_indices[offset:sorted_indptr[end]])
+        assert parcelGraphs[pid].is_sane()
 
     return parcelGraphs
@@ -706,6 +706,24 @@ class ResponseLevelSampler(GibbsSamplerVariable):
 
         self.computeRR()
 
+    def pool_observables(self, others):
+        GibbsSamplerVariable.pool_observables(self, others)
+        chains = [self] + list(others)
+        counts = [v.final_labeled_vars_it_count for v in chains]
+        cumuls = [v.final_labeled_vars_cumul for v in chains]
+        count = sum(counts)
+        cumul = sum(cumuls)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(count > 0, cumul / count, 0.)
+            # within-chain sums of squares plus the spread of chain means,
+            # for each class:
+            cumul2 = sum(v.final_labeled_vars_cumul2 +
+                         np.where(c > 0, c * (s / c - mean) ** 2, 0.)
+                         for v, c, s in zip(chains, counts, cumuls))
+        self.final_labeled_vars_it_count = count
+        self.final_labeled_vars_cumul = cumul
+        self.final_labeled_vars_cumul2 = cumul2
+
     def updateObsersables(self):
         GibbsSamplerVariable.updateObsersables(self)
         labels = self.get_variable('label').currentValue
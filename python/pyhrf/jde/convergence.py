@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""On-line convergence diagnostics of MCMC chains.
+
+:class:`ConvergenceMonitor` follows summaries of sampled variables (eg the
+HRF, the condition-wise means of NRLs, beta, the mean noise variance) after
+the burn-in period. It only keeps sums and sums of squares of the samples
+over batches of consecutive iterations. When *max_batches* batches are
+filled, consecutive batches are merged in pairs and the batch size doubles,
+so that the memory used does not depend on the number of iterations.
+
+From these batch statistics, each scalar component of the followed
+summaries gets:
+
+- an effective sample size (ESS), from the batch means estimate of the
+  asymptotic variance of the chain mean,
+- a Geweke z-score, comparing the means of the first 10% and of the last
+  50% of the chain,
+- a split-Rhat, computed on the two halves of the chain.
+
+The chain is considered converged when all components reach the configured
+thresholds.
+
+:func:`gelman_rubin` gives the potential scale reduction factor (Rhat) of
+several chains from their means and variances. It is used for the
+split-Rhat of a single chain, and across independent chains (see
+:class:`~pyhrf.jde.multichain.MultiChainSampler`).
+"""
+
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+def gelman_rubin(means, variances, n):
+    """Potential scale reduction factor (Rhat) of several chains
+
+    Args:
+        means (numpy.ndarray): mean of each chain (first axis: chain, other
+            axes: components)
+        variances (numpy.ndarray): unbiased variance of each chain, same
+            shape as *means*
+        n (float): number of samples per chain
+
+    Return:
+        numpy.ndarray: Rhat of each component (1 for constant components)
+    """
+    w = np.asarray(variances, dtype=np.float64).mean(0)
+    between = n * np.asarray(means, dtype=np.float64).var(0, ddof=1)
+    var_plus = (n - 1.) / n * w + between / n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(w > 0, np.sqrt(var_plus / w), 1.)
+
+
+class ConvergenceMonitor(object):
+    """Convergence diagnostics of a chain from batch means.
+
+    Args:
+        min_ess (float): minimal effective sample size (None: not checked)
+        max_geweke (float): maximal absolute Geweke z-score (None: not
+            checked)
+        max_rhat (float): maximal split-Rhat (None: not checked)
+        batch_size (int): initial number of iterations per batch
+        max_batches (int): maximal number of stored batches (even)
+        min_batches (int): minimal number of full batches before convergence
+            can be declared
+        check_pace (int): number of updates between two convergence checks
+    """
+
+    def __init__(self, min_ess=None, max_geweke=None, max_rhat=None,
+                 batch_size=5, max_batches=64, min_batches=10, check_pace=20):
+        self.min_ess = min_ess
+        self.max_geweke = max_geweke
+        self.max_rhat = max_rhat
+        self.initial_batch_size = batch_size
+        self.max_batches = max_batches - max_batches % 2
+        self.min_batches = min_batches
+        self.check_pace = check_pace
+        self.reset()
+
+    def reset(self):
+        """Forget all samples"""
+        self.batch_size = self.initial_batch_size
+        self.nb_batches = 0
+        self.nb_updates = 0
+        self.converged = False
+        self.converged_at = None
+        self.shifts = {}
+        self.batch_sums = {}
+        self.batch_sq_sums = {}
+        self.current_sums = {}
+        self.current_sq_sums = {}
+        self.current_count = 0
+
+    def update(self, values):
+        """Add one sample of each followed summary
+
+        Args:
+            values (dict of str: array): value of each summary. All calls
+                must give the same summaries with the same shapes.
+        """
+        for name, v in values.iteritems():
+            v = np.asarray(v, dtype=np.float64).ravel()
+            if name not in self.shifts:
+                # samples are shifted by the first one to avoid
+                # cancellations when computing variances:
+                self.shifts[name] = v.copy()
+                self.batch_sums[name] = np.zeros((self.max_batches, v.size))
+                self.batch_sq_sums[name] = np.zeros((self.max_batches, v.size))
+                self.current_sums[name] = np.zeros(v.size)
+                self.current_sq_sums[name] = np.zeros(v.size)
+            v = v - self.shifts[name]
+            self.current_sums[name] += v
+            self.current_sq_sums[name] += v ** 2
+        self.current_count += 1
+        self.nb_updates += 1
+
+        if self.current_count == self.batch_size:
+            self._close_batch()
+
+        if (self.nb_updates % self.check_pace) == 0 and not self.converged:
+            self.converged = self.check()
+            if self.converged:
+                self.converged_at = self.nb_updates
+
+    def _close_batch(self):
+        if self.nb_batches == self.max_batches:
+            # merge consecutive batches in pairs:
+            half = self.max_batches / 2
+            for sums in (self.batch_sums, self.batch_sq_sums):
+                for name, s in sums.iteritems():
+                    s[:half] = s[0::2] + s[1::2]
+            self.nb_batches = half
+            self.batch_size *= 2
+            # the current batch is the first half of a new batch:
+            return
+        for name in self.current_sums:
+            self.batch_sums[name][self.nb_batches] = self.current_sums[name]
+            self.batch_sq_sums[name][self.nb_batches] = \
+                self.current_sq_sums[name]
+            self.current_sums[name][:] = 0
+            self.current_sq_sums[name][:] = 0
+        self.nb_batches += 1
+        self.current_count = 0
+
+    def get_diagnostics(self):
+        """Compute the diagnostics of all components, over full batches
+
+        Return:
+            dict of str: (ess, geweke z-score, split-Rhat), each being an
+            array with one value per component of the summary. Empty if less
+            than 2 batches are filled.
+        """
+        nb = self.nb_batches - self.nb_batches % 2
+        if nb < 2:
+            return {}
+        b = self.batch_size
+        n = nb * b
+        n_first = max(1, int(round(.1 * nb)))
+        n_last = nb / 2
+        diags = {}
+        for name in self.batch_sums:
+            sums = self.batch_sums[name][:nb]
+            sq_sums = self.batch_sq_sums[name][:nb]
+            batch_means = sums / b
+            mean = sums.sum(0) / n
+            var = (sq_sums.sum(0) / n - mean ** 2) * n / (n - 1.)
+            # variance of batch means, ie asymptotic variance / batch size:
+            var_bm = batch_means.var(0, ddof=1)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ess = np.where(var_bm > 0, var / (b * var_bm) * n, n)
+                ess = np.minimum(ess, n)
+
+                diff = batch_means[:n_first].mean(0) - \
+                    batch_means[-n_last:].mean(0)
+                z = np.where(var_bm > 0,
+                             diff / np.sqrt(var_bm * (1. / n_first +
+                                                      1. / n_last)), 0.)
+
+                # split-Rhat on the two halves of the chain:
+                nh = n / 2
+                halves = [slice(0, nb / 2), slice(nb / 2, nb)]
+                h_means = np.array([sums[h].sum(0) / nh for h in halves])
+                h_vars = np.array([(sq_sums[h].sum(0) / nh - m ** 2) *
+                                   nh / (nh - 1.)
+                                   for h, m in zip(halves, h_means)])
+                rhat = gelman_rubin(h_means, h_vars, nh)
+            diags[name] = (ess, z, rhat)
+        return diags
+
+    def check(self):
+        """Return True if all thresholds are met"""
+        if self.nb_batches < self.min_batches:
+            return False
+        if self.min_ess is None and self.max_geweke is None and \
+                self.max_rhat is None:
+            return False
+        for name, (ess, z, rhat) in self.get_diagnostics().iteritems():
+            if self.min_ess is not None and ess.min() < self.min_ess:
+                return False
+            if self.max_geweke is not None and \
+                    np.abs(z).max() > self.max_geweke:
+                return False
+            if self.max_rhat is not None and rhat.max() > self.max_rhat:
+                return False
+        logger.info('Convergence reached after %d iterations (ess >= %s, '
+                    '|geweke| <= %s, rhat <= %s)', self.nb_updates,
+                    str(self.min_ess), str(self.max_geweke),
+                    str(self.max_rhat))
+        return True
+
+    def summary(self):
+        """Worst value of each diagnostic for each summary
+
+        Return:
+            dict of str: (min ess, max absolute geweke z-score, max rhat)
+        """
+        return dict((name, (ess.min(), np.abs(z).max(), rhat.max()))
+                    for name, (ess, z, rhat)
+                    in self.get_diagnostics().iteritems())
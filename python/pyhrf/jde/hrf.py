@@ -173,6 +173,8 @@ class HRFSampler(xmlio.XmlInitable, GibbsSamplerVariable):
 
     }
 
+    pooled_observables = ('cumul_ah', 'cumul2_ah')
+
     def __init__(self, do_sampling=True, use_true_value=False,
                  val_ini=None, duration=25., zero_constraint=True,
                  normalise=1., deriv_order=2, covar_hack=False,
@@ -480,6 +482,9 @@ class HRFSampler(xmlio.XmlInitable, GibbsSamplerVariable):
                     tMaxHRF, maxHRF)
 
     def calcXh(self, hrf):
+        paradigmOperator = getattr(self.dataInput, 'paradigmOperator', None)
+        if paradigmOperator is not None:
+            return paradigmOperator.dot(hrf).transpose()
         logger.info('CalcXh got stackX %s', str(self.dataInput.stackX.shape))
         # print 'GLOB:', self.dataInput.stackX.shape,  hrf.shape
         stackXh = np.dot(self.dataInput.stackX, hrf)
@@ -574,6 +579,14 @@ class HRFSampler(xmlio.XmlInitable, GibbsSamplerVariable):
             self.cumul_ah = np.zeros_like(self.current_ah)
             self.cumul2_ah = np.zeros_like(self.current_ah)
 
+    def pool_observables(self, others):
+        GibbsSamplerVariable.pool_observables(self, others)
+        if getattr(self, 'compute_ah_online', False) and \
+                self.nbItObservables > 0:
+            self.mean_ah = self.cumul_ah / self.nbItObservables
+            self.var_ah = self.cumul2_ah / \
+                self.nbItObservables - self.mean_ah ** 2
+
     def updateObsersables(self):
         GibbsSamplerVariable.updateObsersables(self)
         sScale = self.samplerEngine.get_variable('scale')
@@ -1574,6 +1587,9 @@ class HRF_two_parts_Sampler(HRFSampler):
             'sampled HRF max = (tMax=%1.3f,vMax=%1.3f)', tMaxHRF, maxHRF)
 
     def calcXh(self, hrf):
+        paradigmOperator = getattr(self.dataInput, 'paradigmOperator', None)
+        if paradigmOperator is not None:
+            return paradigmOperator.dot(hrf).transpose()
         logger.info('CalcXh got stackX %s', str(self.dataInput.stackX.shape))
         stackXh = np.dot(self.dataInput.stackX, hrf)
         return np.reshape(stackXh, (self.nbConditions, self.ny)).transpose()
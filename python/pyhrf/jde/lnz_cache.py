@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of log-partition function grids of Potts fields.
+
+Estimating ln Z(beta) of a Potts field defined on the graph of a parcel
+(see :func:`pyhrf.jde.beta.Cpt_Vec_Estim_lnZ_Graph`) relies on Swendsen-Wang
+sampling and may take minutes, while it only depends on the graph topology,
+the number of labels and the beta grid. :class:`LnZCache` stores the
+estimated grids on disk under a key computed from these inputs, so that
+parcels sharing the same topology -- across runs and subjects -- reuse them.
+
+The least recently used grids are removed when the cache holds more than
+*max_entries* grids.
+"""
+
+import os
+import os.path as op
+import hashlib
+import cPickle
+import logging
+
+import numpy as np
+
+import pyhrf
+
+from pyhrf.graph import as_csr_graph
+
+
+logger = logging.getLogger(__name__)
+
+# to be increased when the estimation of grids changes so that previously
+# cached grids are not reused:
+LNZ_CACHE_VERSION = 1
+
+
+def graph_lnz_key(graph, nb_labels, method, **grid_params):
+    """Canonical key of the ln Z grid of a Potts field defined on *graph*
+
+    Args:
+        graph (CSRGraph, list or object array): neighbours of each node
+        nb_labels (int): number of labels of the Potts field
+        method (str): lnZ estimation method
+        grid_params: other parameters of the estimation (eg BetaMax,
+            BetaStep)
+
+    Return:
+        str (hexadecimal sha1 digest)
+    """
+    graph = as_csr_graph(graph)
+    nb_neighbours = graph.degrees()
+    # neighbours sorted within each node:
+    rows = np.repeat(np.arange(len(graph)), nb_neighbours)
+    neighbours = graph.indices[np.lexsort((graph.indices, rows))]
+    sha = hashlib.sha1()
+    sha.update(repr((LNZ_CACHE_VERSION, len(graph), nb_labels, method,
+                     sorted(grid_params.items()))))
+    sha.update(nb_neighbours.tostring())
+    sha.update(neighbours.tostring())
+    return sha.hexdigest()
+
+
+class LnZCache(object):
+    """On-disk cache of ln Z grids, with least recently used eviction
+
+    Each grid is stored in its own file, named after its key (see
+    :func:`graph_lnz_key`). Files are written atomically so that the cache
+    can be shared by concurrent processes. The modification time of a file
+    is updated each time its grid is read, and is used to find the least
+    recently used grids.
+
+    Args:
+        cache_dir (str): directory of cached grids (created if needed)
+        max_entries (int): maximum number of grids kept in the cache
+    """
+
+    def __init__(self, cache_dir, max_entries=500):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        if not op.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _filename(self, key):
+        return op.join(self.cache_dir, 'lnz_%s.pck' % key)
+
+    def _cached_files(self):
+        return [op.join(self.cache_dir, fn) for fn in os.listdir(self.cache_dir)
+                if fn.startswith('lnz_') and fn.endswith('.pck')]
+
+    def __len__(self):
+        return len(self._cached_files())
+
+    def __contains__(self, key):
+        return op.exists(self._filename(key))
+
+    def get(self, key):
+        """Return the cached grid (lnZ values, beta values) associated to
+        *key*, or None if not cached."""
+        fn = self._filename(key)
+        try:
+            fin = open(fn, 'rb')
+        except IOError:
+            return None
+        try:
+            lnz_grid = cPickle.load(fin)
+        except Exception:
+            logger.warning('Could not load cached lnZ grid %s', fn,
+                           exc_info=True)
+            return None
+        finally:
+            fin.close()
+        try:
+            os.utime(fn, None)
+        except OSError:  # evicted meanwhile by another process
+            pass
+        return lnz_grid
+
+    def put(self, key, lnz_grid):
+        """Store *lnz_grid* (lnZ values, beta values) under *key*, then evict
+        the least recently used grids if the cache is full."""
+        fn = self._filename(key)
+        tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+        fout = open(tmp_fn, 'wb')
+        cPickle.dump(tuple(np.asarray(a) for a in lnz_grid), fout,
+                     cPickle.HIGHEST_PROTOCOL)
+        fout.close()
+        os.rename(tmp_fn, fn)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used grids in excess of *max_entries*"""
+        cached = []
+        for fn in self._cached_files():
+            try:
+                cached.append((os.stat(fn).st_mtime, fn))
+            except OSError:
+                pass
+        if len(cached) <= self.max_entries:
+            return
+        cached.sort()
+        for _, fn in cached[:len(cached) - self.max_entries]:
+            logger.debug('Evicting cached lnZ grid %s', fn)
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
+    def clear(self):
+        for fn in self._cached_files():
+            os.remove(fn)
+
+
+def get_lnz_cache():
+    """Return the lnZ cache defined in the pyhrf configuration (section
+    'lnz-cache'), or None if caching is disabled (cache_dir is None)."""
+    cfg = pyhrf.cfg['lnz-cache']
+    if cfg['cache_dir'] is None:
+        return None
+    try:
+        return LnZCache(cfg['cache_dir'], cfg['max_entries'])
+    except OSError:
+        logger.warning('Could not create lnZ cache directory %s, caching '
+                       'disabled', cfg['cache_dir'], exc_info=True)
+        return None
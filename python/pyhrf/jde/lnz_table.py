@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""Reference table of log-partition functions of Potts fields.
+
+The table holds ln Z(beta) grids of Potts fields, which were estimated
+off-line by path sampling on regular and non-regular graphs with a
+6-connectivity system. Each entry is described by the number of labels, the
+number of sites, the number of cliques and the homogeneity of neighbourhoods
+of its graph (see :func:`graph_lnz_descriptors`). All grids share the beta
+values of :data:`LNZ_TABLE_BETAS`.
+
+The table is stored in the binary file 'lnz_ref_table.npy' of the pyhrf data
+files, as a numpy record array (see :func:`make_lnz_table`), which is memory
+mapped when first used (see :func:`load_lnz_table`).
+
+:func:`interpolate_lnz` estimates the ln Z grid of any graph from the
+reference grids of the graphs which are the most similar to it, without
+sampling.
+"""
+
+import logging
+
+import numpy as np
+
+import pyhrf
+
+from pyhrf.graph import as_csr_graph
+
+
+logger = logging.getLogger(__name__)
+
+LNZ_TABLE_FILE = 'lnz_ref_table.npy'
+
+# beta values of all reference grids:
+LNZ_TABLE_BETAS = np.round(np.arange(30) * .05, 2)
+
+LNZ_TABLE_DTYPE = np.dtype([('nb_labels', np.int16),
+                            ('nb_sites', np.int32),
+                            ('nb_cliques', np.int32),
+                            ('std_ngbh', np.float64),
+                            ('log_pf', np.float64, len(LNZ_TABLE_BETAS))])
+
+_lnz_table = None
+
+
+def make_lnz_table(nb_labels, nb_sites, nb_cliques, std_ngbh, log_pf):
+    """Build a reference table of ln Z grids
+
+    Args:
+        nb_labels (array of int): number of labels of each entry
+        nb_sites (array of int): number of sites of each graph
+        nb_cliques (array of int): number of cliques of each graph
+        std_ngbh (array of float): standard deviation of the number of
+            cliques per site divided by the mean number of neighbours (see
+            :func:`graph_lnz_descriptors`)
+        log_pf (2D array of float): ln Z grid of each entry, on the beta
+            values of :data:`LNZ_TABLE_BETAS`
+
+    Return:
+        numpy record array of dtype :data:`LNZ_TABLE_DTYPE`, to be saved with
+        np.save
+    """
+    table = np.zeros(len(nb_labels), dtype=LNZ_TABLE_DTYPE)
+    table['nb_labels'] = nb_labels
+    table['nb_sites'] = nb_sites
+    table['nb_cliques'] = nb_cliques
+    table['std_ngbh'] = std_ngbh
+    table['log_pf'] = log_pf
+    return table
+
+
+def load_lnz_table():
+    """Return the reference table of ln Z grids, memory mapped from the pyhrf
+    data files. The file is only opened once."""
+    global _lnz_table
+    if _lnz_table is None:
+        fn = pyhrf.get_data_file_name(LNZ_TABLE_FILE)
+        logger.debug('Loading reference lnZ table %s', fn)
+        _lnz_table = np.load(fn, mmap_mode='r')
+    return _lnz_table
+
+
+def graph_lnz_descriptors(graph):
+    """Descriptors of *graph* used to compare it to the graphs of the
+    reference table
+
+    Args:
+        graph (CSRGraph, list or object array): neighbours of each node
+
+    Return:
+        tuple (nb_sites, nb_cliques, std_ngbh) where std_ngbh is the standard
+        deviation of the number of cliques per site divided by the mean number
+        of neighbours
+    """
+    degrees = as_csr_graph(graph).degrees()
+    nb_sites = len(degrees)
+    nb_cliques = degrees.sum() / 2
+    ns = nb_sites + 0.
+    nc = nb_cliques + 0.
+    if ns == 1:  # HACK
+        ns_1 = 1.
+    else:
+        ns_1 = ns - 1.
+    std_cliques_per_site = np.sqrt((((nc / ns - degrees / 2.) ** 2.) /
+                                    ns).sum())
+    return nb_sites, nb_cliques, std_cliques_per_site / (nc / ns_1)
+
+
+def interpolate_lnz(graph, nb_labels, nb_refs=16, table=None):
+    """Estimate the ln Z(beta) grid of the Potts field defined on *graph*
+    from the reference table, without sampling.
+
+    The excess of ln Z over its value at beta=0, normalized by the number of
+    cliques, ie (ln Z(beta) - nb_sites * ln(nb_labels)) / nb_cliques, mostly
+    depends on the graph density (number of cliques per site), on the
+    homogeneity of neighbourhoods and on the graph size. It is estimated for
+    *graph* by a local linear regression on these descriptors over the
+    *nb_refs* closest reference graphs. The regression extrapolates to graph
+    sizes outside the table, but not to densities outside the range of the
+    table, for which None is returned.
+
+    Args:
+        graph (CSRGraph, list or object array): neighbours of each node
+        nb_labels (int): number of labels of the Potts field
+        nb_refs (int): number of reference graphs used in the regression
+        table (record array): reference table, default is the one of
+            :func:`load_lnz_table`
+
+    Return:
+        tuple (lnZ values, beta values) or None if the table has no entry
+        for *nb_labels* or if the graph density is out of the table range
+    """
+    nb_sites, nb_cliques, std_ngbh = graph_lnz_descriptors(graph)
+    return interpolate_lnz_from_descriptors(nb_labels, nb_sites, nb_cliques,
+                                            std_ngbh, nb_refs, table)
+
+
+def interpolate_lnz_from_descriptors(nb_labels, nb_sites, nb_cliques,
+                                     std_ngbh, nb_refs=16, table=None):
+    """Same as :func:`interpolate_lnz` where the graph is given by its
+    descriptors (see :func:`graph_lnz_descriptors`)
+    """
+    if table is None:
+        table = load_lnz_table()
+    refs = table[table['nb_labels'] == nb_labels]
+    if len(refs) == 0:
+        return None
+
+    if nb_cliques == 0:
+        return (np.zeros(len(LNZ_TABLE_BETAS)) + nb_sites * np.log(nb_labels),
+                LNZ_TABLE_BETAS.copy())
+
+    ref_sites = refs['nb_sites'].astype(np.float64)
+    ref_cliques = refs['nb_cliques'].astype(np.float64)
+    ref_density = ref_cliques / ref_sites
+    density = nb_cliques / (nb_sites + 0.)
+    if density < ref_density.min() or density > ref_density.max():
+        logger.info('Graph density (%1.2f) out of the range of the lnZ table '
+                    '[%1.2f, %1.2f]', density, ref_density.min(),
+                    ref_density.max())
+        return None
+
+    ref_features = np.vstack((ref_density, refs['std_ngbh'],
+                              np.log(ref_sites))).T
+    features = np.array([density, std_ngbh, np.log(nb_sites)])
+    ref_lnz = np.asarray(refs['log_pf'])
+    ref_excess = (ref_lnz - ref_lnz[:, :1]) / ref_cliques[:, np.newaxis]
+
+    scale = ref_features.std(0)
+    scale[scale == 0] = 1.
+    dist = np.sqrt((((ref_features - features) / scale) ** 2).sum(1))
+    closest = np.argsort(dist)[:nb_refs]
+    sqrt_w = 1. / np.sqrt(dist[closest] + 1e-2)
+    design = np.hstack((np.ones((len(closest), 1)),
+                        ref_features[closest] - features))
+    coeffs = np.linalg.lstsq(sqrt_w[:, np.newaxis] * design,
+                             sqrt_w[:, np.newaxis] * ref_excess[closest])[0]
+    # ln Z is increasing with beta:
+    excess = np.maximum.accumulate(np.maximum(coeffs[0], 0.))
+
+    lnz = nb_sites * np.log(nb_labels) + nb_cliques * excess
+    return lnz, LNZ_TABLE_BETAS.copy()
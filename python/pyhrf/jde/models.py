@@ -9,8 +9,10 @@ import numpy as np
 from scipy.linalg import toeplitz
 
 from pyhrf import xmlio
-from pyhrf.graph import graph_nb_cliques
+from pyhrf.graph import graph_nb_cliques, CSRGraph
+from pyhrf.paradigm import ParadigmOperator
 from pyhrf.jde.samplerbase import *
+from pyhrf.jde.convergence import ConvergenceMonitor
 from pyhrf.jde.hrf import *
 from pyhrf.jde.nrl import *
 from pyhrf.jde.noise import *
@@ -136,21 +138,8 @@ class BOLDSamplerInput:
         # print 'graph:'
         # print graph
 
-        nmax = max([len(nl) for nl in graph])
-        # print 'nmax:', nmax
-
-        # hack
-        # nmax=4
-        # for nb in graph:
-        # print 'nb:', nb
-        #nl = graph[nb]
-        # print 'nl:', nl[0]
-        #nmax = max(len(nl))
-
-        self.neighboursIndexes = np.zeros((self.nbVoxels, nmax), dtype=int)
-        self.neighboursIndexes -= 1
-        for i in xrange(self.nbVoxels):
-            self.neighboursIndexes[i, :len(graph[i])] = graph[i]
+        self.graph = CSRGraph.from_lists(graph)
+        self.neighboursIndexes = self.graph.to_padded(dtype=int)
         self.nbCliques = graph_nb_cliques(self.neighboursIndexes)
         # Store some parameters usefull for analysis :
         self.typeLFD = typeLFD
@@ -356,39 +345,17 @@ class BOLDSamplerInput:
 
         self.varOSAvailDataIdx = [array(ai * osf, dtype=int)
                                   for ai in availableDataIndex]
-        vX = []
-        logger.info('Build pseudo teoplitz matrices')
+        logger.info('Build paradigm operators')
+        self.paradigmOperators = []
         for iSess in xrange(self.nbSessions):
             self.lenData = len(self.varOSAvailDataIdx[iSess])
-            varX = np.zeros((self.nbConditions, self.lenData, self.lgCI),
-                            dtype=int)
-            logger.debug('iSess : %d', iSess)
-            for j in xrange(self.nbConditions):
-                logger.debug(' cond : %d', j)
-                col = concatenate(([allMatH[iSess][0, j]],
-                                   np.zeros(self.hrfLength - 1, dtype=int)))
-                logger.debug(' col :')
-                logger.debug([col[b] for b in xrange(col.shape[0])])
-
-                matTmp = array(toeplitz(allMatH[iSess][:, j], col), dtype=int)
-                logger.debug(' matTmp :')
-                logger.debug([matTmp[b, a]
-                              for a in xrange(matTmp.shape[1])
-                              for b in xrange(matTmp.shape[0])])
-# TODO: check if the previous is the same that the following
-#                if pyhrf.verbose.verbosity >= 6:
-#                    for b in xrange(matTmp.shape[0]):
-#                        print ' [',
-#                        for a in xrange(matTmp.shape[1]):
-#                            print matTmp[b,a],
-#                        print ']'
-
-                d0 = matTmp[self.varOSAvailDataIdx[iSess], :]
-                d1 = d0[:, self.hrfColIndex]
-                varX[j, :, :] = d1
-
-            vX.append(varX)
-        self.varX = hstack(vX)
+            sessionBins = [allMatH[iSess][:, j]
+                           for j in xrange(self.nbConditions)]
+            self.paradigmOperators.append(ParadigmOperator.from_bins(
+                sessionBins, self.varOSAvailDataIdx[iSess], self.hrfColIndex))
+        self.paradigmOperator = ParadigmOperator.concatenate(
+            self.paradigmOperators)
+        self.varX = self.paradigmOperator.toarray().astype(int)
         logger.info('varX : %s', str(self.varX.shape))
         self.buildOtherMatX()
 
@@ -514,6 +481,7 @@ class BOLDSamplerInput:
         del self.varPtP
         del self.paradigmData
         del self.neighboursIndexes
+        del self.graph
         del self.varSingleCondXtrials
         del self.stimRepetitions
         del self.hrfColIndex
@@ -525,19 +493,8 @@ class WN_BiG_BOLDSamplerInput(BOLDSamplerInput):
 
     def makePrecalculations(self):
         # XQX & XQ:
-        self.matXQX = np.zeros((self.nbConditions, self.nbConditions,
-                                self.nbColX, self.nbColX), dtype=float)
-        self.matXQ = np.zeros((self.nbConditions, self.nbColX, self.ny),
-                              dtype=float)
-
-        for j in xrange(self.nbConditions):
-            # print 'self.varX :', self.varX[j,:,:].transpose().shape
-            # print 'self.delta :', self.delta.shape
-            self.matXQ[j, :, :] = np.dot(self.varX[j, :, :].transpose(),
-                                         self.delta)
-            for k in xrange(self.nbConditions):
-                self.matXQX[j, k, :, :] = np.dot(self.matXQ[j, :, :],
-                                                 self.varX[k, :, :])
+        self.matXQ = self.paradigmOperator.rdot(self.delta)
+        self.matXQX = self.paradigmOperator.gram(self.delta)
         # Qy, yTQ & yTQy  :
         self.matQy = np.zeros((self.ny, self.nbVoxels), dtype=float)
         self.yTQ = np.zeros((self.ny, self.nbVoxels), dtype=float)
@@ -561,15 +518,7 @@ class WN_BiG_Drift_BOLDSamplerInput(BOLDSamplerInput):
 
     def makePrecalculations(self):
         # XQX & XQ:
-        self.matXtX = np.zeros((self.nbConditions, self.nbConditions,
-                                self.nbColX, self.nbColX), dtype=float)
-
-        for j in xrange(self.nbConditions):
-            # print 'self.varX :', self.varX[j,:,:].transpose().shape
-            # print 'self.delta :', self.delta.shape
-            for k in xrange(self.nbConditions):
-                self.matXtX[j, k, :, :] = np.dot(self.varX[j, :, :].transpose(),
-                                                 self.varX[k, :, :])
+        self.matXtX = self.paradigmOperator.gram()
         # Qy, yTQ & yTQy  :
         # self.matQy = np.zeros((self.ny,self.nbVoxels), dtype=float)
         # self.yTQ = np.zeros((self.ny,self.nbVoxels), dtype=float)
@@ -601,19 +550,8 @@ class ARN_BiG_BOLDSamplerInput(BOLDSamplerInput):
 class Hab_WN_BiG_BOLDSamplerInput(WN_BiG_BOLDSamplerInput):
 
     def makePrecalculations(self):
-        self.matXQX = np.zeros((self.nbConditions, self.nbConditions,
-                                self.nbColX, self.nbColX), dtype=float)
-        self.matXQ = np.zeros((self.nbConditions, self.nbColX, self.ny),
-                              dtype=float)
-
-        for j in xrange(self.nbConditions):
-            # print 'self.varX :', self.varX[j,:,:].transpose().shape
-            # print 'self.delta :', self.delta.shape
-            self.matXQ[j, :, :] = np.dot(self.varX[j, :, :].transpose(),
-                                         self.delta)
-            for k in xrange(self.nbConditions):
-                self.matXQX[j, k, :, :] = np.dot(self.matXQ[j, :, :],
-                                                 self.varX[k, :, :])
+        self.matXQ = self.paradigmOperator.rdot(self.delta)
+        self.matXQX = self.paradigmOperator.gram(self.delta)
 
         # Qy, yTQ & yTQy  :
         self.matQy = np.zeros((self.ny, self.nbVoxels), dtype=float)
@@ -679,12 +617,8 @@ class BOLDSampler_Multi_SessInput:
         graph = data.get_graph()
         self.nbVoxels = len(graph)
 
-        nmax = max([len(nl) for nl in graph])
-
-        self.neighboursIndexes = np.zeros((self.nbVoxels, nmax), dtype=int)
-        self.neighboursIndexes -= 1
-        for i in xrange(self.nbVoxels):
-            self.neighboursIndexes[i, :len(graph[i])] = graph[i]
+        self.graph = CSRGraph.from_lists(graph)
+        self.neighboursIndexes = self.graph.to_padded(dtype=int)
         self.nbCliques = graph_nb_cliques(self.neighboursIndexes)
         # Store some parameters usefull for analysis :
         self.typeLFD = typeLFD
@@ -938,38 +872,16 @@ class BOLDSampler_Multi_SessInput:
 
         self.varOSAvailDataIdx = [array(ai * osf, dtype=int)
                                   for ai in availableDataIndex]
-        vX = []
-        logger.info('Build pseudo teoplitz matrices')
+        logger.info('Build paradigm operators')
+        self.paradigmOperators = []
         for iSess in xrange(self.nbSessions):
             self.lenData = len(self.varOSAvailDataIdx[iSess])
-            varX = zeros((self.nbConditions, self.lenData, self.lgCI),
-                         dtype=int)
-            logger.debug('iSess : %d', iSess)
-            for j in xrange(self.nbConditions):
-                logger.debug(' cond : %d', j)
-                col = concatenate(([allMatH[iSess][0, j]],
-                                   zeros(self.hrfLength - 1, dtype=int)))
-                logger.debug(' col :')
-                logger.debug([col[b] for b in xrange(col.shape[0])])
-
-                matTmp = array(toeplitz(allMatH[iSess][:, j], col), dtype=int)
-                logger.debug(' matTmp :')
-                logger.debug([matTmp[b, a]
-                              for a in xrange(matTmp.shape[1])
-                              for b in xrange(matTmp.shape[0])])
-# TODO: check if the previous is the same that the following
-#                if pyhrf.verbose.verbosity >= 6:
-#                    for b in xrange(matTmp.shape[0]):
-#                        print ' [',
-#                        for a in xrange(matTmp.shape[1]):
-#                            print matTmp[b,a],
-#                        print ']'
-                d0 = matTmp[self.varOSAvailDataIdx[iSess], :]
-                d1 = d0[:, self.hrfColIndex]
-                varX[j, :, :] = d1
-
-            vX.append(varX)
-        self.varX = np.array(vX)
+            sessionBins = [allMatH[iSess][:, j]
+                           for j in xrange(self.nbConditions)]
+            self.paradigmOperators.append(ParadigmOperator.from_bins(
+                sessionBins, self.varOSAvailDataIdx[iSess], self.hrfColIndex))
+        self.varX = np.array([op.toarray().astype(int)
+                              for op in self.paradigmOperators])
         logger.info('varX : %s', str(self.varX.shape))
         self.buildOtherMatX()
 
@@ -1050,6 +962,7 @@ class BOLDSampler_Multi_SessInput:
         del self.varPtP
         del self.paradigmData
         del self.neighboursIndexes
+        del self.graph
         del self.stimRepetitions
         del self.hrfColIndex
         del self.colIndex
@@ -1096,7 +1009,24 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
         'If x>=1: define the step in iterations number between saved '
         ' samples.\n'
         'If x=1: save samples at each iteration.',
-        'obs_hist_pace': 'See comment for samplesHistoryPaceSave.'
+        'obs_hist_pace': 'See comment for samplesHistoryPaceSave.',
+        'stop_min_ess': 'Stop sampling when the effective sample size of '
+        'the HRF, NRL means, beta and mean noise variance is above this '
+        'value (and the other convergence thresholds are met).\n'
+        'If x<0: not checked',
+        'stop_max_geweke': 'Stop sampling when the absolute Geweke z-scores '
+        'are below this value (see stop_min_ess).\nIf x<0: not checked',
+        'stop_max_rhat': 'Stop sampling when the split-Rhat values are '
+        'below this value (see stop_min_ess).\nIf x<0: not checked',
+        'diagnostics_pace': 'Number of iterations between two computations '
+        'of the fit diagnostics (reconstruction error and log-likelihood).\n'
+        'If x<=0: not computed',
+        'history_max_samples': 'Number of last values kept in the histories '
+        'of samples and observables (see smpl_hist_pace and obs_hist_pace)'
+        '.\nIf None: all values are kept',
+        'history_dir': 'Directory of memory-mapped files storing the '
+        'histories of samples and observables.\nIf None: histories are '
+        'stored in memory',
     }
 
     def __init__(self, nb_iterations=default_nb_its,
@@ -1108,9 +1038,19 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
                  hrf_var=RHSampler(), mixt_weights=MixtureWeightsSampler(),
                  mixt_params=BiGaussMixtureParamsSampler(), scale=ScaleSampler(),
                  stop_crit_threshold=-1, stop_crit_from_start=False,
-                 check_final_value=None):
+                 check_final_value=None, stop_min_ess=-1, stop_max_geweke=-1,
+                 stop_max_rhat=-1, diagnostics_pace=1,
+                 history_max_samples=None, history_dir=None):
         """
         check_final_value: None, 'print' or 'raise'
+        stop_min_ess, stop_max_geweke, stop_max_rhat: thresholds of the
+            on-line convergence diagnostics (see
+            pyhrf.jde.convergence.ConvergenceMonitor). Negative values
+            disable a threshold. When at least one threshold is set, sampling
+            stops as soon as all of them are met.
+        diagnostics_pace: see GibbsSampler.set_diagnostics_pace
+        history_max_samples, history_dir: see
+            GibbsSampler.set_history_storage
         """
         # print 'param:', parameters
         xmlio.XmlInitable.__init__(self)
@@ -1140,6 +1080,12 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
 
         self.stop_threshold = stop_crit_threshold
         self.crit_diff_from_start = stop_crit_from_start
+        conv_thresholds = [t if t >= 0 else None for t in
+                           (stop_min_ess, stop_max_geweke, stop_max_rhat)]
+        if conv_thresholds != [None] * 3:
+            self.convergence_monitor = ConvergenceMonitor(*conv_thresholds)
+        else:
+            self.convergence_monitor = None
         self.full_crit_diff_trajectory = defaultdict(list)
         self.full_crit_diff_trajectory_timing = []
         self.crit_diff0 = {}
@@ -1152,13 +1098,21 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
                               callbackObj,
                               globalObsHistoryPace=globalObsHistPace,
                               check_ftval=check_ftval)
+        self.set_diagnostics_pace(diagnostics_pace)
+        self.set_history_storage(history_max_samples, history_dir)
 
         # self.buildSharedDataTree()
 
     def stop_criterion(self, it):
         # return False
-        if it < self.nbSweeps + 1 or self.stop_threshold < 0.:
+        monitor = getattr(self, 'convergence_monitor', None)
+        if it < self.nbSweeps + 1 or \
+                (self.stop_threshold < 0. and monitor is None):
             return False
+        if monitor is not None and not monitor.converged:
+            return False
+        if self.stop_threshold < 0.:
+            return True
         epsilon = self.stop_threshold
         diffs = np.array([d for d in self.crit_diff.values()])
         logger.info("Stop criterion (it=%d):", it)
@@ -1167,6 +1121,21 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
                 " - %s : %f < %f -> %s", k, v, epsilon, str(v < epsilon))
         return (diffs < epsilon).all()
 
+    def get_convergence_summaries(self):
+        """
+        Return the current value of the quantities followed by the
+        convergence monitor: HRF, condition-wise means of NRLs, beta and mean
+        noise variance. Variables which are not sampled are skipped.
+        """
+        summaries = {'hrf': lambda v: v.currentValue,
+                     'nrl': lambda v: v.currentValue.mean(-1),
+                     'beta': lambda v: v.currentValue,
+                     'noise_var': lambda v: np.mean(v.currentValue)}
+        return dict((vn, f(self.variablesMapping[vn]))
+                    for vn, f in summaries.iteritems()
+                    if vn in self.variablesMapping and
+                    self.variablesMapping[vn].sampleFlag)
+
     def compute_crit_diff(self, old_vals, means=None):
         crit_diff = {}
         for vn, v in self.variablesMapping.iteritems():
@@ -1184,6 +1153,9 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
 
     def initGlobalObservables(self):
 
+        if getattr(self, 'convergence_monitor', None) is not None:
+            self.convergence_monitor.reset()
+
         if self.stop_threshold >= 0.:
             self.crit_diff = {}
             self.conv_crit_diff = defaultdict(list)
@@ -1199,6 +1171,8 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
                 self.cumul_for_full_crit_diff[vn] = val.copy()
 
     def updateGlobalObservables(self):
+        if getattr(self, 'convergence_monitor', None) is not None:
+            self.convergence_monitor.update(self.get_convergence_summaries())
         if self.stop_threshold >= 0.:
             self.crit_diff.update(
                 self.compute_crit_diff(self.variables_old_val))
@@ -1280,6 +1254,19 @@ class BOLDGibbsSampler(xmlio.XmlInitable, GibbsSampler):
 
     def getGlobalOutputs(self):
         outputs = GibbsSampler.getGlobalOutputs(self)
+        monitor = getattr(self, 'convergence_monitor', None)
+        if monitor is not None:
+            conv_summary = monitor.summary()
+            if len(conv_summary) > 0:
+                vnames = sorted(conv_summary.keys())
+                for i, diag in enumerate(['ess', 'geweke', 'rhat']):
+                    values = np.array([conv_summary[vn][i] for vn in vnames])
+                    outputs['convergence_%s' % diag] = \
+                        xndarray(values, axes_names=['variable'],
+                                 axes_domains={'variable': vnames},
+                                 value_label=diag)
+            outputs['convergence_nb_iterations'] = \
+                xndarray(np.array([self.final_iteration + 1]))
         if self.globalObsHistoryIts is not None:
             if hasattr(self, 'conv_crit_diff'):
                 it_axis = self.globalObsHistoryIts
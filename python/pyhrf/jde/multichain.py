@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+"""Independent MCMC chains of a Gibbs sampler, pooled into one posterior.
+
+:class:`MultiChainSampler` wraps a :class:`~pyhrf.jde.samplerbase.GibbsSampler`
+(eg :class:`~pyhrf.jde.models.BOLDGibbsSampler` or
+:class:`~pyhrf.jde.asl.ASLSampler`) and runs several copies of it on the same
+parcel, on a pool of local processes. Each chain draws from its own
+:class:`numpy.random.RandomState` stream, derived from a master seed.
+
+Once all chains are done, the observables accumulated after burn-in by each
+variable (posterior mean, variance and variable-specific sums, see
+:meth:`~pyhrf.jde.samplerbase.GibbsSamplerVariable.pool_observables`) are
+pooled into the first chain, which is then finalized as if it had run all
+the iterations. The Gelman-Rubin Rhat across chains is reported for each
+sampled variable.
+"""
+
+import os
+import os.path as op
+import copy
+import time
+import logging
+import multiprocessing
+
+import numpy as np
+
+from pyhrf.ndarray import xndarray
+from pyhrf.jde.convergence import gelman_rubin
+from pyhrf.tools.cpus import available_cpu_count
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_chain(sampler, random_state, atom_data=None):
+    """Run *sampler* without finalizing it, drawing from *random_state*
+
+    The global numpy random generator, used by all samplers, is set to the
+    state of *random_state* during sampling and restored afterwards.
+    *random_state* is left in its state at the end of sampling.
+
+    Args:
+        sampler (:class:`~pyhrf.jde.samplerbase.GibbsSampler`): sampler linked
+            to its data
+        random_state (numpy.random.RandomState): random stream of the chain
+        atom_data (pyhrf.core.FmriData): parcel-specific data (see
+            :meth:`~pyhrf.jde.samplerbase.GibbsSampler.runSampling`)
+
+    Return:
+        the sampler
+    """
+    global_state = np.random.get_state()
+    np.random.set_state(random_state.get_state())
+    try:
+        sampler.runSampling(atom_data, finalize=False)
+        random_state.set_state(np.random.get_state())
+    finally:
+        np.random.set_state(global_state)
+    return sampler
+
+
+_chain_worker = {}
+
+
+def _init_chain_worker(chains, random_states, atom_data):
+    _chain_worker['chains'] = chains
+    _chain_worker['random_states'] = random_states
+    _chain_worker['atom_data'] = atom_data
+
+
+def _run_chain_task(ichain):
+    sampler = run_chain(_chain_worker['chains'][ichain],
+                        _chain_worker['random_states'][ichain],
+                        _chain_worker['atom_data'])
+    return ichain, sampler
+
+
+class MultiChainSampler(object):
+    """Several independent chains of a Gibbs sampler with a pooled posterior
+
+    The wrapper is used like the wrapped sampler: :meth:`linkToData`,
+    :meth:`set_checkpoint`, :meth:`runSampling`, then :meth:`getOutputs`.
+    Histories of samples and observables are those of the first chain.
+
+    Args:
+        sampler (:class:`~pyhrf.jde.samplerbase.GibbsSampler`): template of
+            the chains (not modified)
+        nb_chains (int): number of chains
+        n_jobs (int): number of processes running chains (None: one per
+            chain, within the number of available CPUs). Chains are run in
+            the current process if *n_jobs* is 1 or if the current process
+            is itself a pool worker (eg when parcels are analysed in
+            parallel).
+        random_seed (int): seed of the master stream from which the stream
+            of each chain is derived (None: the random seed of *sampler*,
+            if any)
+    """
+
+    def __init__(self, sampler, nb_chains=4, n_jobs=None, random_seed=None):
+        self.sampler = sampler
+        self.nb_chains = nb_chains
+        self.n_jobs = n_jobs
+        if random_seed is None:
+            random_seed = getattr(sampler, 'randomSeed', None)
+        self.random_seed = random_seed
+        self.dataInput = None
+        self.checkpoint_file = None
+        self.checkpoint_pace = -1
+        self.checkpoint_tag = None
+        self.pooled_sampler = None
+        self.chains_rhat = {}
+        self.chains_nb_iterations = []
+        self.analysis_duration = None
+
+    def linkToData(self, dataInput):
+        self.dataInput = dataInput
+        self.sampler.linkToData(dataInput)
+
+    def set_checkpoint(self, file_name, pace=100, tag=None):
+        """
+        Set the checkpoint of the sampling state of chains (see
+        :meth:`~pyhrf.jde.samplerbase.GibbsSampler.set_checkpoint`). Each
+        chain gets its own file, suffixed by the chain index.
+        """
+        self.checkpoint_file = file_name
+        self.checkpoint_pace = pace
+        self.checkpoint_tag = tag
+
+    def get_chain_checkpoint_file(self, ichain):
+        if self.checkpoint_file is None:
+            return None
+        root, ext = op.splitext(self.checkpoint_file)
+        return '%s_chain%d%s' % (root, ichain, ext)
+
+    def make_chains(self):
+        """
+        Return the samplers of all chains and their random streams.
+        Chains share the input data of the template sampler.
+        """
+        master = np.random.RandomState(self.random_seed)
+        chains, random_states = [], []
+        for ichain in xrange(self.nb_chains):
+            chain = copy.deepcopy(self.sampler,
+                                  {id(self.dataInput): self.dataInput})
+            # the global generator must not be reseeded by each chain:
+            chain.randomSeed = None
+            chain.set_checkpoint(self.get_chain_checkpoint_file(ichain),
+                                 self.checkpoint_pace, self.checkpoint_tag)
+            chains.append(chain)
+            random_states.append(np.random.RandomState(
+                master.randint(np.iinfo(np.int32).max)))
+        return chains, random_states
+
+    def get_nb_processes(self):
+        if multiprocessing.current_process().daemon:
+            # daemonic processes (eg pool workers) cannot have children
+            return 1
+        n_jobs = self.n_jobs
+        if n_jobs is None:
+            n_jobs = available_cpu_count()
+        return max(1, min(n_jobs, self.nb_chains))
+
+    def runSampling(self, atomData=None):
+        """
+        Run all chains, then pool their observables into the first one and
+        finalize it (see :attr:`pooled_sampler`).
+        """
+        tIni = time.time()
+        chains, random_states = self.make_chains()
+        nb_procs = self.get_nb_processes()
+        logger.info('Running %d chains on %d processes', self.nb_chains,
+                    nb_procs)
+        if nb_procs == 1:
+            chains = [run_chain(c, rs, atomData)
+                      for c, rs in zip(chains, random_states)]
+        else:
+            pool = multiprocessing.Pool(nb_procs, _init_chain_worker,
+                                        (chains, random_states, atomData))
+            try:
+                for ichain, chain in pool.imap_unordered(_run_chain_task,
+                                                         xrange(len(chains))):
+                    logger.info('Chain %d done', ichain)
+                    chains[ichain] = chain
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
+        self.pool_chains(chains)
+        self.analysis_duration = time.time() - tIni
+        self.pooled_sampler.analysis_duration = self.analysis_duration
+
+    def pool_chains(self, chains):
+        """
+        Compute the Rhat of sampled variables across *chains*, then pool
+        their observables into the first chain and finalize it.
+        """
+        self.chains_nb_iterations = [c.final_iteration + 1 for c in chains]
+        self.chains_rhat = self.compute_chains_rhat(chains)
+        for vn, rhat in sorted(self.chains_rhat.iteritems()):
+            logger.info('Rhat of %s across %d chains: %f', vn, len(chains),
+                        rhat)
+
+        pooled = chains[0]
+        for v in pooled.variables:
+            v.pool_observables([c.get_variable(v.name) for c in chains[1:]])
+        pooled.finalize_run()
+        for c in chains[1:]:
+            if c.checkpoint_file is not None and \
+                    os.path.exists(c.checkpoint_file):
+                os.remove(c.checkpoint_file)
+        self.pooled_sampler = pooled
+        self.dataInput = pooled.dataInput
+
+    def compute_chains_rhat(self, chains):
+        """
+        Return the maximal Rhat over the components of each sampled
+        variable, computed from the observables of *chains* (dict of
+        variable name: Rhat).
+        """
+        rhats = {}
+        for v in chains[0].variables:
+            vs = [c.get_variable(v.name) for c in chains]
+            counts = np.array([cv.nbItObservables for cv in vs], dtype=float)
+            if not v.sampleFlag or (counts < 2).any():
+                continue
+            means = np.array([cv.cumul / n for cv, n in zip(vs, counts)])
+            variances = np.array([cv.cumul3 / (n - 1.)
+                                  for cv, n in zip(vs, counts)])
+            rhats[v.name] = gelman_rubin(means, variances,
+                                         counts.mean()).max()
+        return rhats
+
+    def get_variable(self, label):
+        return self.pooled_sampler.get_variable(label)
+
+    def getOutputs(self):
+        outputs = self.pooled_sampler.getOutputs()
+        if len(self.chains_rhat) > 0:
+            vnames = sorted(self.chains_rhat.keys())
+            outputs['convergence_chains_rhat'] = \
+                xndarray(np.array([self.chains_rhat[vn] for vn in vnames]),
+                         axes_names=['variable'],
+                         axes_domains={'variable': vnames},
+                         value_label='rhat')
+        outputs['convergence_chains_nb_iterations'] = \
+            xndarray(np.array(self.chains_nb_iterations),
+                     axes_names=['chain'],
+                     axes_domains={'chain': np.arange(self.nb_chains)})
+        return outputs
@@ -25,6 +25,7 @@ from pyhrf.tools.aexpression import (ArithmeticExpressionNameError,
 from pyhrf.stats import (compute_roc_labels_scikit, threshold_labels,
                          mark_wrong_labels, compute_roc_labels)
 from pyhrf.tools._io import read_volume
+from pyhrf.graph import as_csr_graph
 
 
 logger = logging.getLogger(__name__)
@@ -51,6 +52,13 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         'contrasts': 'Define contrasts as arithmetic expressions.\n'
         'Condition names used in expressions must be consistent with '
         'those specified in session data above',
+        'gibbs_mode': 'Update scheme of NRLs and labels when a spatial prior '
+        'is used:\n'
+        '  - "serial": voxels are updated one by one in a random order\n'
+        '  - "chromatic": voxels are split into classes of the colouring of '
+        'the neighbourhood graph (eg 2 classes for a 6-connectivity lattice),'
+        ' and each class is updated at once as they are conditionally '
+        'independent',
     }
 
     # other class attributes
@@ -62,6 +70,17 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
     FALSE_POS = 2
     FALSE_NEG = 3
 
+    GIBBS_MODES = ['serial', 'chromatic']
+
+    history_attributes = dict(
+        GibbsSamplerVariable.history_attributes,
+        labels_mean=('labelsMeanHistory', 'obsHistoryIts'),
+        labels_smpl=('labelsSmplHistory', 'smplHistoryIts'))
+
+    pooled_observables = ('cumulLabels', 'count_above_thresh',
+                          'count_above_Multi_thresh', 'cumulContrast',
+                          'cumul2Contrast')
+
     def __init__(self, do_sampling=True, val_ini=None,
                  contrasts={'dummy_contrast_example':
                             '0.5 * audio - 0.5 * video'},
@@ -70,7 +89,7 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
                  ppm_proba_threshold=0.05, ppm_value_threshold=0,
                  ppm_value_multi_threshold=np.arange(0., 4.1, 0.1),
                  mean_activation_threshold=4, rescale_results=False,
-                 wip_variance_computation=False):
+                 wip_variance_computation=False, gibbs_mode='serial'):
 
         # TODO : comment
         xmlio.XmlInitable.__init__(self)
@@ -107,6 +126,11 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         self.ppm_value_multi_thresh = ppm_value_multi_threshold
         self.rescale_results = rescale_results
 
+        if gibbs_mode not in self.GIBBS_MODES:
+            raise Exception('Unknown gibbs mode "%s", choices are: %s'
+                            % (gibbs_mode, ', '.join(self.GIBBS_MODES)))
+        self.gibbs_mode = gibbs_mode
+
     def linkToData(self, dataInput):
         self.dataInput = dataInput
         self.nbConditions = self.dataInput.nbConditions
@@ -440,6 +464,15 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         self.varCon_2cond_indep_apost = np.zeros((4, self.nbVox),
                                                  dtype=np.float32)
 
+    def pool_observables(self, others):
+        GibbsSamplerVariable.pool_observables(self, others)
+        if self.nbItObservables > 0:
+            self.meanLabels = self.cumulLabels / self.nbItObservables
+            self.freq_above_thresh = self.count_above_thresh / \
+                self.nbItObservables
+            self.freq_above_Multi_thresh = self.count_above_Multi_thresh / \
+                self.nbItObservables
+
     def updateObsersables(self):
         logger.info('NRLSampler.updateObsersables ...')
         GibbsSamplerVariable.updateObsersables(self)
@@ -645,22 +678,11 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
 
     def saveObservables(self, it):
         GibbsSamplerVariable.saveObservables(self, it)
-        if self.labelsMeanHistory is not None:
-            self.labelsMeanHistory = np.concatenate((self.labelsMeanHistory,
-                                                     [self.meanLabels]))
-        else:
-            self.labelsMeanHistory = np.array([self.meanLabels.copy()])
-
-        # print 'save trucs'
+        self.save_history('labels_mean', self.meanLabels, it)
 
     def saveCurrentValue(self, it):
-        # print 'self.labels', self.labels
         GibbsSamplerVariable.saveCurrentValue(self, it)
-        if self.labelsSmplHistory is not None:
-            self.labelsSmplHistory = np.concatenate((self.labelsSmplHistory,
-                                                     [self.labels]))
-        else:
-            self.labelsSmplHistory = np.array([self.labels.copy()])
+        self.save_history('labels_smpl', self.labels, it)
 
     def cleanObservables(self):
         GibbsSamplerVariable.cleanObservables(self)
@@ -734,8 +756,33 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
 
         self.computeAA(self.currentValue, self.aa)
 
+        if self.gibbs_mode == 'chromatic' and not self.imm:
+            self.initColourClasses()
+
         self.iteration = 0
 
+    def initColourClasses(self, colourClasses=None):
+        """ Split voxels into classes of non-neighbouring voxels, used by
+        :meth:`sampleNrlsChromatic`. Default classes are the colour classes
+        of the neighbourhood graph. For each class, store the rows of the
+        adjacency matrix to count the activating neighbours.
+        """
+        if self.nbClasses != 2:
+            raise Exception('Chromatic sampling is only available for 2 '
+                            'classes (got %d)' % self.nbClasses)
+        graph = as_csr_graph(getattr(self.dataInput, 'graph',
+                                     self.dataInput.neighboursIndexes))
+        adjacency = graph.to_sparse_matrix()
+        if colourClasses is None:
+            colourClasses = graph.colour_classes()
+        self.colourClasses = colourClasses
+        self.colourAdjacency = [adjacency[vox] for vox in self.colourClasses]
+        self.colourDegrees = [graph.degrees()[vox]
+                              for vox in self.colourClasses]
+        logger.info('Chromatic sampling: %d colour classes of sizes %s',
+                    len(self.colourClasses),
+                    str([len(vox) for vox in self.colourClasses]))
+
     def computeAA(self, nrls, destaa):
         for j in xrange(self.nbConditions):
             for k in xrange(self.nbConditions):
@@ -869,6 +916,74 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
 
         self.countLabels(self.labels, self.voxIdx, self.cardClass)
 
+    def sampleNrlsChromatic(self, gTQg):
+        """ Same update as :meth:`sampleNrlsSerial`, vectorized over voxels.
+
+        Given the labels, the NRL of a voxel only depends on its own
+        residual, so that posterior components of all voxels are computed at
+        once for each condition. Labels are sampled one colour class of
+        voxels at a time (see :meth:`initColourClasses`): voxels of a class
+        are not neighbours, hence they are conditionally independent given
+        the labels of the other classes.
+        """
+        logger.info('Sampling Nrls (chromatic, spatial prior) ...')
+        logger.info('Label sampling: %s', str(self.sampleLabelsFlag))
+        sIMixtP = self.samplerEngine.get_variable('mixt_params')
+        var = sIMixtP.getCurrentVars()
+        mean = sIMixtP.getCurrentMeans()
+        rb = self.samplerEngine.get_variable('noise_var').currentValue
+        varXh = self.samplerEngine.get_variable('hrf').varXh
+        beta = self.samplerEngine.get_variable('beta').currentValue
+        ci, ca = self.L_CI, self.L_CA
+        colourOrder = np.random.permutation(len(self.colourClasses))
+
+        for j in xrange(self.nbConditions):
+            oldNrls = self.currentValue[j, :].copy()
+            # varXhtQ_j * (yTilde + nrl_j * varXh_j) for all voxels:
+            varXjhtQjej = (np.dot(self.varXhtQ[j], self.varYtilde) +
+                           oldNrls * gTQg[j]) / rb
+
+            varj = var[:, j, np.newaxis]
+            vApost = 1. / (1. / varj + gTQg[j] / rb)
+            sApost = np.sqrt(vApost)
+            mApost = vApost * (mean[:, j, np.newaxis] / varj + varXjhtQjej)
+            vApost[vApost <= 0.] = 1e-8
+            self.meanClassApost[:, j, :] = mApost
+            self.varClassApost[:, j, :] = vApost
+
+            if self.sampleLabelsFlag:
+                # as in the C serial version, extreme ratios saturate to 0
+                # or inf:
+                with np.errstate(over='ignore', under='ignore'):
+                    # ratio of label posteriors, without the spatial term:
+                    rl = np.sqrt(var[ca, j] / var[ci, j]) * \
+                        (sApost[ci] / sApost[ca] *
+                         np.exp(0.5 * (mApost[ci] ** 2 / vApost[ci] -
+                                       mApost[ca] ** 2 / vApost[ca] -
+                                       mean[ci, j] ** 2 / var[ci, j] +
+                                       mean[ca, j] ** 2 / var[ca, j])))
+                    for ic in colourOrder:
+                        vox = self.colourClasses[ic]
+                        nbActiv = self.colourAdjacency[ic].dot(
+                            self.labels[j, :] == ca)
+                        # nb of inactivating - nb of activating neighbours:
+                        dECorr = self.colourDegrees[ic] - 2 * nbActiv
+                        lApostCI = 1. - 1. / (1. + rl[vox] *
+                                              np.exp(beta[j] * dECorr))
+                        self.labels[j, vox] = np.where(
+                            self.labelsSamples[j, vox] <= lApostCI, ci, ca)
+
+            labels = self.labels[j, :]
+            self.currentValue[j, :] = np.choose(labels, sApost) * \
+                self.nrlsSamples[j, :] + np.choose(labels, mApost)
+            self.varYtilde += np.outer(varXh[:, j],
+                                       oldNrls - self.currentValue[j, :])
+
+        if (self.varClassApost <= 0).any():
+            raise Exception('Negative posterior variances!')
+
+        self.countLabels(self.labels, self.voxIdx, self.cardClass)
+
     def printState(self, _):
         for j in xrange(self.nbConditions):
             logger.info('nrl cond %d = %1.3f(%1.3f)', j,
@@ -940,6 +1055,9 @@ class NRLSampler(xmlio.XmlInitable, GibbsSamplerVariable):
         if self.imm:
             self.sampleNrlsParallel(varXh, rb, h, varLambda, varCI,
                                     varCA, meanCA, gTQg, variables)
+        elif self.gibbs_mode == 'chromatic':  # MMS
+            self.sampleNrlsChromatic(gTQg)
+            self.computeVarYTildeOpt(varXh)
         else:  # MMS
             self.sampleNrlsSerial(rb, h, varCI, varCA, meanCA, gTQg, variables)
             self.computeVarYTildeOpt(varXh)
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import os
 import time
+import tempfile
+import cPickle
 import logging
 
 import numpy as np
@@ -40,6 +43,19 @@ class GibbsSampler:
     outputs ...
     """
 
+    # mid-sampling checkpoint (see set_checkpoint):
+    checkpoint_file = None
+    checkpoint_pace = -1
+    checkpoint_tag = None
+
+    # storage of sample and observable histories (see set_history_storage):
+    history_max_samples = None
+    history_dir = None
+
+    # iterations between two computations of the fit diagnostics
+    # (see set_diagnostics_pace):
+    diagnostics_pace = 1
+
     def __init__(self, variables, nbIt, smplHistoryPace=-1,
                  obsHistoryPace=-1, nbSweeps=None,
                  callbackObj=None, randomSeed=None, globalObsHistoryPace=-1,
@@ -148,22 +164,126 @@ class GibbsSampler:
     def get_variable(self, label):
         return self.variablesMapping[label]
 
-    def iterate_sampling(self):
-        it = 0
-        while it < self.nbIterations and not self.stop_criterion(it):
-            yield it
-            it += 1
+    def set_checkpoint(self, file_name, pace=100, tag=None):
+        """
+        Save the whole sampling state in *file_name* every *pace* iterations,
+        so that an interrupted sampling can resume from its last checkpoint.
+        If *file_name* already exists when sampling starts and its tag
+        matches *tag* (eg a digest of the input data), sampling resumes from
+        it. The checkpoint file is removed when sampling is done.
+        If *file_name* is None, checkpointing is disabled.
+        """
+        self.checkpoint_file = file_name
+        self.checkpoint_pace = pace
+        self.checkpoint_tag = tag
 
-    def stop_criterion(self, it):
-        return False
+    def set_history_storage(self, max_samples=None, directory=None):
+        """
+        Set how the histories of samples and observables of all variables
+        are stored (see :class:`SampleHistory`).
+        If *max_samples* is not None, only the last *max_samples* values of
+        each history are kept.
+        If *directory* is not None, histories are stored in memory-mapped
+        files created in *directory* (and removed right away, so that they
+        do not outlive the sampling).
+        """
+        self.history_max_samples = max_samples
+        self.history_dir = directory
 
-    def runSampling(self, atomData=None):
-        # np.seterr(all='raise')
+    def set_diagnostics_pace(self, pace):
         """
-        Launch a complete sampling process by calling the function
-        L{GibbsSamplerVariable.sampleNext()} of each variable. Call the callback
-        function after each iteration. Measure time elapsed and store it in
-        L{tSamplinOnly} and L{analysis_duration}
+        Compute the fit diagnostics (relative reconstruction error and
+        log-likelihood, see :meth:`compute_diagnostics`) every *pace*
+        iterations. If *pace* is not positive, diagnostics are not computed.
+        """
+        self.diagnostics_pace = pace
+
+    def compute_diagnostics(self, bold):
+        """
+        Compute the relative reconstruction error of *bold* by the current
+        fit (see :meth:`computeFit`) and the log-likelihood of the residuals
+        under the current noise variances.
+
+        Return:
+            tuple (relative error, log-likelihood)
+        """
+        r = bold - self.computeFit()
+        rec_error_j = (r ** 2).sum(0)
+        rec_error = rec_error_j.mean() / (bold ** 2).sum(0).mean()
+        var_noise = self.get_variable('noise_var').currentValue
+        N = r.shape[0]
+        loglh = -(np.log(np.abs(2 * np.pi * var_noise * N)) +
+                  rec_error_j / var_noise / 2).sum()
+        return rec_error, loglh
+
+    def new_history(self, history_pace, history_start=0):
+        """
+        Return an empty :class:`SampleHistory` sized for values saved every
+        *history_pace* iterations from iteration *history_start*, plus the
+        initial value.
+        """
+        if history_pace > 0:
+            nb_samples = max(self.nbIterations - history_start, 0) / \
+                history_pace + 2
+        else:
+            nb_samples = 1
+        return SampleHistory(nb_samples, self.history_max_samples,
+                             self.history_dir)
+
+    def save_checkpoint(self, it, loop_state):
+        """
+        Save the sampling state after iteration *it*. *loop_state* is a dict
+        of quantities accumulated by runSampling.
+        """
+        logger.info('(it %d) saving checkpoint to %s', it, self.checkpoint_file)
+        checkpoint = {'iteration': it, 'tag': self.checkpoint_tag,
+                      'random_state': np.random.get_state(),
+                      'loop_state': loop_state, 'sampler': self}
+        tmp_file = self.checkpoint_file + '.tmp'
+        fout = open(tmp_file, 'wb')
+        cPickle.dump(checkpoint, fout, cPickle.HIGHEST_PROTOCOL)
+        fout.close()
+        os.rename(tmp_file, self.checkpoint_file)
+
+    def load_checkpoint(self):
+        """
+        Restore the sampling state from the checkpoint file, if any.
+        Return the checkpoint dict (iteration, loop_state), or None if there
+        is no valid checkpoint.
+        """
+        if self.checkpoint_file is None or \
+                not os.path.exists(self.checkpoint_file):
+            return None
+        try:
+            fin = open(self.checkpoint_file, 'rb')
+            checkpoint = cPickle.load(fin)
+            fin.close()
+        except Exception:
+            logger.warning('Could not load checkpoint %s, starting sampling '
+                           'from scratch', self.checkpoint_file, exc_info=True)
+            return None
+        if checkpoint['tag'] != self.checkpoint_tag:
+            logger.warning('Checkpoint %s does not match current sampling, '
+                           'starting sampling from scratch',
+                           self.checkpoint_file)
+            return None
+
+        checkpoint_settings = (self.checkpoint_file, self.checkpoint_pace,
+                               self.checkpoint_tag)
+        self.__dict__.update(checkpoint.pop('sampler').__dict__)
+        self.checkpoint_file, self.checkpoint_pace, self.checkpoint_tag = \
+            checkpoint_settings
+        for v in self.variables:
+            v.setSamplerEngine(self)
+        np.random.set_state(checkpoint.pop('random_state'))
+        logger.info('Sampling resumed from checkpoint %s (iteration %d)',
+                    self.checkpoint_file, checkpoint['iteration'])
+        return checkpoint
+
+    def init_sampling(self):
+        """
+        Seed the random generator, then initialize and warm up all variables
+        before the first iteration.
         """
         if self.randomSeed is not None:
             logger.info('setting random seed: %s', str(self.randomSeed))
@@ -199,6 +319,55 @@ class GibbsSampler:
             v.initObservables()
         self.initGlobalObservables()
 
+        for v in self.variables:
+            if self.smplHistoryPace != -1:
+                logger.info('Saving init value of %s', v.name)
+                v.saveCurrentValue(-1)
+
+    def iterate_sampling(self, start=0):
+        it = start
+        while it < self.nbIterations and not self.stop_criterion(it):
+            yield it
+            it += 1
+
+    def stop_criterion(self, it):
+        return False
+
+    def runSampling(self, atomData=None, finalize=True):
+        # np.seterr(all='raise')
+        """
+        Launch a complete sampling process by calling the function
+        L{GibbsSamplerVariable.sampleNext()} of each variable. Call the callback
+        function after each iteration. Measure time elapsed and store it in
+        L{tSamplinOnly} and L{analysis_duration}
+        If *finalize* is False, the observables are kept as accumulated at
+        the end of the sampling loop (eg to be pooled with those of other
+        chains) and :meth:`finalize_run` has to be called afterwards.
+        """
+        checkpoint = self.load_checkpoint()
+        if self.diagnostics_pace > 0:
+            nb_diags = self.nbIterations / self.diagnostics_pace + 1
+        else:
+            nb_diags = 0
+        rerror = np.zeros(nb_diags)
+        loglkhd = np.zeros(nb_diags)
+        if checkpoint is None:
+            self.init_sampling()
+            start = 0
+            nb_diags = 0
+            loglh = N = None
+        else:
+            start = checkpoint['iteration'] + 1
+            loop_state = checkpoint['loop_state']
+            nb_diags = len(loop_state['rerror'])
+            if nb_diags > len(rerror):
+                rerror = np.zeros(nb_diags)
+                loglkhd = np.zeros(nb_diags)
+            rerror[:nb_diags] = loop_state['rerror']
+            loglkhd[:nb_diags] = loop_state['loglkhd']
+            loglh = loop_state['loglh']
+            N = loop_state['N']
+
         # init for time measures :
         tGlobIni = time.time()
         tIni = time.time()
@@ -217,15 +386,8 @@ class GibbsSampler:
                     self.dataInput.nbConditions, lhrf)
 
         tLoopIni = time.time()
-        for v in self.variables:
-            if self.smplHistoryPace != -1:
-                logger.info('Saving init value of %s', v.name)
-                v.saveCurrentValue(-1)
-
-        rerror = np.array([])
-        loglkhd = np.array([])
-
-        for it in self.iterate_sampling():
+        it = start - 1
+        for it in self.iterate_sampling(start):
             iv = 0
 
             for v in self.variables:
@@ -278,31 +440,23 @@ class GibbsSampler:
             # Save jde_fit()
             #self.jde_fit_vec = np.append(self.jde_fit_vec, self.computeFit())
 
-            # Compute error measures
-            try:
-                bold = atomData.bold
-
-                # relative reconstruction error
-                jde_fit = self.computeFit()
-                r = bold - jde_fit
-                rec_error_j = np.sum(r ** 2, 0)
-                bold2 = np.sum(bold ** 2, 0)
-                #rec_error = np.mean(rec_error_j/bold2)   # Univariate analysis
-                rec_error = np.mean(rec_error_j) / np.mean(bold2)
-                rerror = np.append(rerror, rec_error)
-
-                # Loglikelihood
-                var_noise = self.get_variable('noise_var').currentValue
-                loglh = 0
-                N = r.shape[0]
-                J = r.shape[1]
-                for j in np.arange(0, J):
-                    loglh -= (np.log(np.abs(2*np.pi*var_noise[j]*N)) + \
-                        np.dot(r[:,j].T,r[:,j])/var_noise[j] / 2)
-                loglkhd = np.append(loglkhd, loglh)
-
-            except AttributeError:
-                pass
+            # Compute error measures (relative reconstruction error and
+            # loglikelihood)
+            if self.diagnostics_pace > 0 and \
+                    (it % self.diagnostics_pace) == 0:
+                try:
+                    bold = atomData.bold
+                    rec_error, loglh = self.compute_diagnostics(bold)
+                    N = bold.shape[0]
+                    if nb_diags == len(rerror):
+                        rerror = np.concatenate((rerror, np.zeros(nb_diags)))
+                        loglkhd = np.concatenate((loglkhd,
+                                                  np.zeros(nb_diags)))
+                    rerror[nb_diags] = rec_error
+                    loglkhd[nb_diags] = loglh
+                    nb_diags += 1
+                except AttributeError:
+                    pass
 
 
             # Some verbose about online profiling :
@@ -327,35 +481,56 @@ class GibbsSampler:
             # launch callback function after each sample step :
             logger.info('calling callback ...')
             self.callbacker(it, self.variables, self)
+
+            if self.checkpoint_file is not None and self.checkpoint_pace > 0 \
+                    and ((it + 1) % self.checkpoint_pace) == 0:
+                self.save_checkpoint(it, {'rerror': rerror[:nb_diags],
+                                          'loglkhd': loglkhd[:nb_diags],
+                                          'loglh': loglh, 'N': N})
             tIni = time.time()
         self.final_iteration = it
         logger.info('##- Sampling done, final iteration=%d -##',
                     self.final_iteration)
 
-        try:
-            bold = atomData.bold
-            Q, J = bold.shape
-
-            #BIC
-            self.converror = rerror
-            self.loglikelihood = loglkhd
+        if nb_diags > 0:
             try:
-                hrf = self.get_variable('brf').currentValue
-            except KeyError:
-                hrf = self.get_variable('hrf').currentValue
-            if len(hrf.shape) > 1:
-                M = hrf.shape[1]
-            else:
-                M = 1
-            D = hrf.shape[0]
-            p = 2 * M * J + 2 * (D - 1) + J * Q + J
-            n = N * J
-            self.bic = loglh + p / 2 * np.log(n)
-        except AttributeError:
-            pass
+                bold = atomData.bold
+                Q, J = bold.shape
+
+                #BIC
+                self.converror = rerror[:nb_diags]
+                self.loglikelihood = loglkhd[:nb_diags]
+                try:
+                    hrf = self.get_variable('brf').currentValue
+                except KeyError:
+                    hrf = self.get_variable('hrf').currentValue
+                if len(hrf.shape) > 1:
+                    M = hrf.shape[1]
+                else:
+                    M = 1
+                D = hrf.shape[0]
+                p = 2 * M * J + 2 * (D - 1) + J * Q + J
+                n = N * J
+                self.bic = loglh + p / 2 * np.log(n)
+            except AttributeError:
+                pass
+
+        if finalize:
+            self.finalize_run()
+        # measure time for sampling and callback :
+        self.analysis_duration = time.time() - tGlobIni
+        #print self.getTinyProfile()
+
+        return
 
-        # Finalizing everything :
+    def finalize_run(self):
+        """
+        Compute the final values of all variables from their observables,
+        finalize variables and sampler, and remove the sampling checkpoint.
+        Called at the end of :meth:`runSampling`, unless it is asked not to.
+        """
         for v in self.variables:
+            v.sync_histories()
             if v.finalValue is None:
                 v.setFinalValue()
 
@@ -371,12 +546,10 @@ class GibbsSampler:
         logger.info('Finalizing overall sampling ...')
 
         self.finalizeSampling()
+        if self.checkpoint_file is not None and \
+                os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
         #outputs = self.getGlobalOutputs()
-        # measure time for sampling and callback :
-        self.analysis_duration = time.time() - tGlobIni
-        #print self.getTinyProfile()
-
-        return
 
     def finalizeSampling(self):
         pass
@@ -609,6 +782,139 @@ class Trajectory:
         return c
 
 
+class SampleHistory:
+
+    """ Successive values of a numpy array saved along sampling iterations.
+
+    Values are copied into a preallocated buffer, so that saving a value does
+    not copy the previous ones. The buffer is sized for the expected number of
+    saved values and its size is doubled if more values come.
+
+    If *max_samples* is given, the history is a ring buffer which only keeps
+    the last *max_samples* values. Each value is then written twice, in a
+    buffer of 2 x *max_samples* values, so that the kept values are always
+    available in order as a view on the buffer.
+
+    If *directory* is given, the buffer is a memory-mapped file created in
+    *directory*. The file is unlinked as soon as it is mapped.
+    """
+
+    def __init__(self, nb_samples, max_samples=None, directory=None):
+        """
+        Args:
+            *nb_samples* is the expected number of saved values.
+            *max_samples* is the number of last values to keep (None to keep
+                          all values).
+            *directory* is the directory of the memory-mapped buffer (None to
+                        store values in memory).
+        """
+        self.max_samples = max_samples
+        self.directory = directory
+        if max_samples is not None:
+            self.capacity = 2 * max_samples
+        else:
+            self.capacity = max(nb_samples, 1)
+        self.data = None
+        self.iterations = None
+        self.count = 0
+
+    def _allocate(self, capacity, shape, dtype):
+        if self.directory is None:
+            return np.empty((capacity,) + shape, dtype=dtype)
+        fd, fn = tempfile.mkstemp(suffix='.dat', prefix='history_',
+                                  dir=self.directory)
+        os.close(fd)
+        data = np.memmap(fn, dtype=dtype, mode='w+',
+                         shape=(capacity,) + shape)
+        os.remove(fn)
+        return data
+
+    def _grow(self):
+        capacity = 2 * len(self.data)
+        logger.debug('Growing sample history to %d values', capacity)
+        data = self._allocate(capacity, self.data.shape[1:], self.data.dtype)
+        data[:self.count] = self.data[:self.count]
+        iterations = np.empty(capacity, dtype=int)
+        iterations[:self.count] = self.iterations[:self.count]
+        self.data, self.iterations = data, iterations
+
+    def append(self, value, iteration):
+        """ Save a copy of *value*, taken at iteration *iteration* """
+        value = np.asarray(value)
+        if self.data is None:
+            self.data = self._allocate(self.capacity, value.shape, value.dtype)
+            self.iterations = np.empty(self.capacity, dtype=int)
+
+        if self.max_samples is None:
+            if self.count == len(self.data):
+                self._grow()
+            self.data[self.count] = value
+            self.iterations[self.count] = iteration
+        else:
+            i = self.count % self.max_samples
+            for j in (i, i + self.max_samples):
+                self.data[j] = value
+                self.iterations[j] = iteration
+        self.count += 1
+
+    def _window(self):
+        if self.max_samples is None or self.count <= self.max_samples:
+            return slice(0, self.count)
+        start = self.count % self.max_samples
+        return slice(start, start + self.max_samples)
+
+    def __len__(self):
+        w = self._window()
+        return w.stop - w.start
+
+    def get_data(self):
+        """ Return the kept values, oldest first, as a view on the buffer
+        (None if no value was saved) """
+        if self.data is None:
+            return None
+        return self.data[self._window()]
+
+    def get_iterations(self):
+        """ Return the iterations of the kept values """
+        if self.iterations is None:
+            return np.array([], dtype=int)
+        return self.iterations[self._window()]
+
+    def __getstate__(self):
+        # only kept values are pickled, not the whole buffer:
+        d = dict(self.__dict__)
+        if self.data is not None:
+            d['capacity'] = len(self.data)
+            d['data'] = np.array(self.get_data())
+            d['iterations'] = np.array(self.get_iterations())
+        return d
+
+    def __setstate__(self, d):
+        values, iterations = d['data'], d['iterations']
+        d['data'] = d['iterations'] = None
+        self.__dict__ = d
+        if values is None:
+            return
+        if self.directory is not None and \
+                not os.path.isdir(self.directory):
+            logger.warning('Directory of sample history %s not found, '
+                           'history stored in memory', self.directory)
+            self.directory = None
+        self.data = self._allocate(self.capacity, values.shape[1:],
+                                   values.dtype)
+        self.iterations = np.empty(self.capacity, dtype=int)
+        if self.max_samples is None:
+            positions = [np.arange(len(values))]
+        else:
+            # positions of the kept values in the ring buffer:
+            i = np.arange(self.count - len(values), self.count) % \
+                self.max_samples
+            positions = [i, i + self.max_samples]
+        for pos in positions:
+            self.data[pos] = values
+            self.iterations[pos] = iterations
+
+
 class GibbsSamplerVariable:
 
     # TODO: make GibbsSamplerVariable be XMLParamDrivenClass
@@ -655,6 +961,8 @@ class GibbsSamplerVariable:
         self.meanHistory = None
         self.errorHistory = None
         self.obsHistoryIts = []
+        # SampleHistory objects (see save_history):
+        self.histories = {}
 
         # Used to save history of samples:
         self.tracked_quantities = {}
@@ -671,9 +979,22 @@ class GibbsSamplerVariable:
         """
         return self.samplerEngine.get_variable(label)
 
+    # kind of history -> (attribute of saved values, attribute of iterations)
+    history_attributes = {'smpl': ('smplHistory', 'smplHistoryIts'),
+                          'mean': ('meanHistory', 'obsHistoryIts'),
+                          'error': ('errorHistory', 'obsHistoryIts')}
+
+    # attributes holding sums over the iterations after burn-in, other than
+    # cumul and cumul3, which are added up when chains are pooled
+    # (see pool_observables):
+    pooled_observables = ()
+
     def __setstate__(self, d):
         d['sampleNext'] = self.chooseSampleNext(d['sampleFlag'])
+        d.setdefault('histories', {})
         self.__dict__ = d
+        # attributes exposing histories are views on their buffers:
+        self.sync_histories()
 
     def __getstate__(self):  # use for compatibilty with pickles which doesn't
                             # support instance variable methods
@@ -683,6 +1004,10 @@ class GibbsSamplerVariable:
         # remove the closure that cannot be pickled
         if d.has_key('sampleNext'):
             del d['sampleNext']
+        # histories are pickled once, in their buffers (see __setstate__):
+        for kind in d.get('histories', {}):
+            for attr in self.history_attributes[kind]:
+                d.pop(attr, None)
         # return state to be pickled
         return d
 
@@ -816,28 +1141,79 @@ class GibbsSamplerVariable:
         if (self.error < 0.).any():
             raise Exception('neg error on variable %s' % self.name)
 
-    def saveObservables(self, it):
-
-        self.obsHistoryIts.append(it)
-        if self.meanHistory is not None:
-            self.meanHistory = np.concatenate((self.meanHistory,
-                                               [self.mean]))
-        else:
-            self.meanHistory = np.array([self.mean.copy()])
+    def pool_observables(self, others):
+        """
+        Pool the observables of this variable with those of the same
+        variable in other chains (*others*, list of GibbsSamplerVariable),
+        as if all their iterations after burn-in had been done in a single
+        chain. Observables are updated in place, so that the final value
+        is the pooled posterior mean.
+        """
+        chains = [self] + list(others)
+        counts = [v.nbItObservables for v in chains]
+        n = sum(counts)
+        if n == 0:
+            return
+        cumul = sum(v.cumul for v in chains)
+        mean = cumul / n
+        # within-chain sums of squares plus the spread of chain means:
+        cumul3 = sum(v.cumul3 + nc * (v.cumul / nc - mean) ** 2
+                     for v, nc in zip(chains, counts) if nc > 0)
+        for name in self.pooled_observables:
+            value = getattr(self, name, None)
+            if value is None:
+                continue
+            other_values = [getattr(v, name) for v in others]
+            if isinstance(value, dict):
+                for k in value:
+                    value[k] = value[k] + sum(o[k] for o in other_values)
+            else:
+                setattr(self, name, value + sum(other_values))
+        self.nbItObservables = n
+        self.cumul = cumul
+        self.cumul3 = cumul3
+        self.mean = mean
+        self.error = cumul3 / n
+
+    def save_history(self, kind, value, it):
+        """
+        Save *value* at iteration *it* in the history *kind* (see
+        :attr:`history_attributes`), and update the attributes exposing this
+        history (eg smplHistory and smplHistoryIts for 'smpl').
+        Histories of observables (all kinds but 'smpl' and those ending with
+        '_smpl') are sized from the observables history pace.
+        """
+        history = self.histories.get(kind)
+        if history is None:
+            engine = self.samplerEngine
+            if kind == 'smpl' or kind.endswith('_smpl'):
+                history = engine.new_history(engine.smplHistoryPace)
+            else:
+                history = engine.new_history(engine.obsHistoryPace,
+                                             engine.nbSweeps or 0)
+            self.histories[kind] = history
+        history.append(value, it)
+        self.sync_history(kind)
+
+    def sync_history(self, kind):
+        """ Set the attributes exposing the history *kind* """
+        values_attr, its_attr = self.history_attributes[kind]
+        history = self.histories[kind]
+        setattr(self, values_attr, history.get_data())
+        if its_attr is not None:
+            setattr(self, its_attr, history.get_iterations())
+
+    def sync_histories(self):
+        """ Set the attributes exposing all histories """
+        for kind in self.histories:
+            self.sync_history(kind)
 
-        if self.errorHistory is not None:
-            self.errorHistory = np.concatenate((self.errorHistory,
-                                                [self.error]))
-        else:
-            self.errorHistory = np.array([self.error.copy()])
+    def saveObservables(self, it):
+        self.save_history('mean', self.mean, it)
+        self.save_history('error', self.error, it)
 
     def saveCurrentValue(self, it):
-        self.smplHistoryIts.append(it)
-        if self.smplHistory is not None:
-            self.smplHistory = np.concatenate((self.smplHistory,
-                                               [self.currentValue]))
-        else:
-            self.smplHistory = np.array([self.currentValue.copy()])
+        self.save_history('smpl', self.currentValue, it)
 
     def roiMapped(self):
         logger.debug('roiMapped ?')
@@ -5,6 +5,7 @@ from collections import OrderedDict
 from pprint import pformat
 
 import numpy as np
+import scipy.sparse
 
 from nipy.modalities.fmri.experimental_paradigm import (EventRelatedParadigm,
                                                         BlockParadigm)
@@ -429,6 +430,164 @@ def restarize_events(events, durations, dt, t_max):
     return bin_seq
 
 
+class ParadigmOperator(object):
+    """Compact representation of the paradigm occurrence matrix.
+
+    For each condition *m*, the occurrence matrix :math:`X_m` of shape
+    (nb_scans, hrf_len) is defined by :math:`X_m[n, k] = s_m(t_n - c_k)` where
+    :math:`s_m` is the binary stimulus sequence sampled at dt, :math:`t_n` the
+    time bin of scan *n* and :math:`c_k` the time bin of the *k*-th HRF
+    coefficient. Since :math:`X_m h` is a (sub-sampled) convolution, most
+    entries are zeros for event-related designs. The matrices are then
+    stored as sparse matrices and the products :math:`X_m h`,
+    :math:`X^t_m y` and :math:`X^t_m \\Gamma X_{m'}` are computed without
+    building the dense (nb_conditions, nb_scans, hrf_len) array.
+
+    The methods mimic the dense array conventions, so an operator can be used
+    in place of the occurrence matrix in the VEM steps
+    (see :func:`pyhrf.vbjde.vem_tools.create_conditions`).
+
+    Args:
+        matrices (list): (nb_scans, hrf_len) matrix of each condition (dense or sparse).
+    """
+
+    def __init__(self, matrices):
+        self.matrices = [scipy.sparse.csr_matrix(matrix) for matrix in matrices]
+        nb_scans, hrf_len = self.matrices[0].shape
+        self.shape = (len(self.matrices), nb_scans, hrf_len)
+        self.ndim = 3
+
+    @classmethod
+    def from_bins(cls, paradigm_bins, scan_indexes, col_indexes):
+        """Build the operator from stimulus sequences sampled at dt.
+
+        Args:
+            paradigm_bins (list of 1D arrays): stimulus sequence of each condition on the dt time grid.
+            scan_indexes (1D int array): time bin of each scan on the dt grid (must be unique).
+            col_indexes (1D int array): time bin of each HRF coefficient.
+
+        Returns:
+            ParadigmOperator
+        """
+        scan_indexes = np.asarray(scan_indexes, dtype=int)
+        col_indexes = np.asarray(col_indexes, dtype=int)
+        nb_scans, hrf_len = len(scan_indexes), len(col_indexes)
+        scan_positions = -np.ones(scan_indexes.max() + 1, dtype=int)
+        scan_positions[scan_indexes] = np.arange(nb_scans)
+
+        matrices = []
+        for bins in paradigm_bins:
+            bins = np.asarray(bins)
+            events = np.flatnonzero(bins)
+            times = events[:, np.newaxis] + col_indexes
+            cols = np.repeat(np.arange(hrf_len)[np.newaxis, :], len(events), axis=0)
+            values = np.repeat(bins[events][:, np.newaxis], hrf_len, axis=1)
+            valid = (times >= 0) & (times < len(scan_positions))
+            rows = scan_positions[times[valid]]
+            in_scans = rows >= 0
+            matrices.append(scipy.sparse.coo_matrix(
+                (values[valid][in_scans], (rows[in_scans], cols[valid][in_scans])),
+                shape=(nb_scans, hrf_len)))
+        return cls(matrices)
+
+    @classmethod
+    def from_onsets(cls, onsets, durations, nb_scans, hrf_len, tr, dt):
+        """Build the operator of a single session paradigm.
+
+        It represents the same matrix as :func:`pyhrf.vbjde.vem_tools.create_conditions`.
+
+        Args:
+            onsets (dict): onsets of each condition.
+            durations (dict): durations of each condition.
+            nb_scans (int): number of scans.
+            hrf_len (int): number of HRF coefficients.
+            tr (float): time of repetition.
+            dt (float): HRF temporal resolution.
+
+        Returns:
+            ParadigmOperator
+        """
+        osf = tr / dt
+        if int(osf) != osf:
+            raise Exception('OSF (%f) is not an integer' % osf)
+
+        paradigm_bins = [restarize_events(onsets[condition], np.asarray(durations[condition]).flatten(), dt,
+                                          nb_scans * tr)
+                         for condition in onsets]
+        return cls.from_bins(paradigm_bins, (np.arange(nb_scans) * osf).astype(int), np.arange(hrf_len))
+
+    @classmethod
+    def concatenate(cls, operators):
+        """Stack the scans of several operators (eg sessions) sharing the same conditions and HRF length."""
+        return cls([scipy.sparse.vstack(matrices, format='csr')
+                    for matrices in zip(*[operator.matrices for operator in operators])])
+
+    def select_columns(self, col_indexes):
+        """Return the operator restricted to some HRF coefficients (eg for the zero constraint)."""
+        return self.__class__([matrix[:, col_indexes] for matrix in self.matrices])
+
+    def dot(self, hrf):
+        """Compute :math:`X_m h` for each condition.
+
+        Args:
+            hrf (ndarray): shape (hrf_len,) or (hrf_len, P).
+
+        Returns:
+            ndarray: shape (nb_conditions, nb_scans) or (nb_conditions, nb_scans, P).
+        """
+        return np.array([matrix.dot(hrf) for matrix in self.matrices])
+
+    def rdot(self, array):
+        """Compute :math:`X^t_m y` for each condition.
+
+        Args:
+            array (ndarray): shape (nb_scans,) or (nb_scans, P).
+
+        Returns:
+            ndarray: shape (nb_conditions, hrf_len) or (nb_conditions, hrf_len, P).
+        """
+        return np.array([matrix.T.dot(array) for matrix in self.matrices])
+
+    def sum_rdot(self, array):
+        """Compute :math:`\\sum_m X^t_m y_m`.
+
+        Args:
+            array (ndarray): shape (nb_scans, nb_conditions), column *m* is :math:`y_m`.
+
+        Returns:
+            ndarray: shape (hrf_len,).
+        """
+        return sum(matrix.T.dot(array[:, m]) for m, matrix in enumerate(self.matrices))
+
+    def gram(self, noise_struct=None):
+        """Compute the Gram blocks :math:`X^t_m \\Gamma X_{m'}`.
+
+        Args:
+            noise_struct: None for white noise, an object providing an *apply*
+                method (see :mod:`pyhrf.vbjde.noise`) or a dense (nb_scans, nb_scans) array.
+
+        Returns:
+            ndarray: shape (nb_conditions, nb_conditions, hrf_len, hrf_len).
+        """
+        nb_conditions, _, hrf_len = self.shape
+        gram = np.zeros((nb_conditions, nb_conditions, hrf_len, hrf_len))
+        for l, matrix_l in enumerate(self.matrices):
+            if noise_struct is None:
+                ns_matrix_l = matrix_l
+            elif hasattr(noise_struct, 'apply'):
+                ns_matrix_l = noise_struct.apply(matrix_l.toarray())
+            else:
+                ns_matrix_l = np.dot(noise_struct, matrix_l.toarray())
+            for m, matrix_m in enumerate(self.matrices):
+                product = matrix_m.T.dot(ns_matrix_l)
+                gram[m, l] = product.toarray() if scipy.sparse.issparse(product) else product
+        return gram
+
+    def toarray(self):
+        """Return the dense (nb_conditions, nb_scans, hrf_len) occurrence matrix."""
+        return np.array([matrix.toarray() for matrix in self.matrices])
+
+
 class Paradigm:
     """
     """
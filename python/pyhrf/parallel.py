@@ -6,9 +6,12 @@ import cPickle
 import shutil
 import subprocess
 import logging
+import multiprocessing
 
+from multiprocessing.sharedctypes import RawArray
 from os.path import basename, splitext
 from tempfile import mkdtemp
+from copy import copy
 
 try:
     from soma_workflow.client import Job, FileTransfer
@@ -18,8 +21,11 @@ try:
 except ImportError:
     pass
 
+import numpy as np
+
 import pyhrf
 
+from pyhrf.core import FmriData, BoldBuffer
 from pyhrf.tools._io import remote_copy
 from pyhrf import xmliobak
 from pyhrf.tools.cpus import available_cpu_count
@@ -587,3 +593,150 @@ def remote_map(func, largs=None, lkwargs=None, mode='serial'):
                     raise RemoteException('Task %d failed' % i, o)
             results.append(o)
         return results
+
+
+def schedule_longest_first(costs):
+    """Order tasks by decreasing cost (ties keep their original order).
+
+    Dispatching the most expensive tasks first to a pool of workers avoids
+    ending the run with a single worker busy on a large task while the others
+    are idle.
+
+    Args:
+        costs (list of float): estimated cost of each task
+
+    Returns:
+        list of int: task indexes in dispatch order
+    """
+    costs = np.asarray(costs, dtype=float)
+    return list(np.argsort(-costs, kind='mergesort'))
+
+
+def share_rois_bold(rois_data):
+    """Get a shared memory buffer holding the BOLD signals of ROI data sets.
+
+    If all the ROI data sets already hold views on the same
+    :class:`~pyhrf.core.BoldBuffer` (see
+    :meth:`~pyhrf.core.FmriData.roi_split`), this buffer is returned.
+    Otherwise, the signals are copied into a new shared memory buffer to
+    which ROI data sets are attached. Worker processes forked afterwards see
+    the buffer without any copy.
+
+    Args:
+        rois_data (list of :class:`~pyhrf.core.FmriData`): single-ROI data sets
+
+    Returns:
+        :class:`~pyhrf.core.BoldBuffer`
+    """
+    bold_buffer = getattr(rois_data[0], 'bold_buffer', None)
+    if bold_buffer is not None and bold_buffer.data is not None and \
+            all(getattr(d, 'bold_buffer', None) is bold_buffer
+                for d in rois_data):
+        return bold_buffer
+
+    bolds = [roi_data.bold for roi_data in rois_data]
+    bold_buffer = BoldBuffer(bolds[0].shape[0], [b.shape[1] for b in bolds],
+                             np.result_type(*bolds))
+    for iroi, (roi_data, bold) in enumerate(zip(rois_data, bolds)):
+        bold_buffer.get(iroi)[:] = bold
+        roi_data.attach_bold_buffer(bold_buffer, iroi)
+    return bold_buffer
+
+
+def shared_zeros(shape, dtype=np.float64):
+    """Allocate an array of zeros in shared memory.
+
+    Processes forked after the allocation (eg the workers of a
+    :class:`multiprocessing.Pool`) see the same memory: what they write in
+    the array is seen by the parent process without any copy.
+
+    Args:
+        shape (tuple): shape of the array
+        dtype (numpy.dtype): data type of the array
+
+    Returns:
+        numpy.ndarray
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buf = RawArray('b', max(size * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=size).reshape(shape)
+
+
+_local_worker = {}
+
+
+def _init_local_worker(analyser, bold_buffer):
+    _local_worker['analyser'] = analyser
+    _local_worker['bold_buffer'] = bold_buffer
+
+
+def _analyse_local_roi(task):
+    iroi, roi_data = task
+    if _local_worker['bold_buffer'] is not None:
+        roi_data.attach_bold_buffer(_local_worker['bold_buffer'],
+                                    roi_data.bold_buffer_index)
+    _, result, report = _local_worker['analyser'].analyse_roi_wrap(roi_data)
+    return iroi, result, report
+
+
+def _detach_bold(roi_data):
+    # shallow copy of the ROI data set without its BOLD signal, sent to the
+    # worker processes which get the signal back from the shared buffer
+    light_data = copy(roi_data)
+    light_data.bold = light_data.bold_full = None
+    return light_data
+
+
+def imap_rois_local(analyser, rois_data, n_jobs):
+    """Analyse ROI data sets on a pool of local processes, longest first.
+
+    ROIs are dispatched by decreasing cost, as estimated by
+    :meth:`~pyhrf.ui.analyser_ui.FMRIAnalyser.estimate_roi_cost`. The analyser
+    is given once to each worker, and the BOLD signals of single-subject data
+    go through shared memory (see :func:`share_rois_bold`): only the light
+    ROI description is sent with each task, workers attach to the shared
+    buffer without copy. Results are yielded as soon as
+    they are available, in completion order.
+
+    Args:
+        analyser (:class:`~pyhrf.ui.analyser_ui.FMRIAnalyser`): the analyser
+            to run on each ROI
+        rois_data (list): ROI data sets, as returned by
+            :meth:`~pyhrf.ui.analyser_ui.FMRIAnalyser.split_data`
+        n_jobs (int): number of worker processes. If 1, ROIs are analysed in
+            the current process
+
+    Returns:
+        generator of tuple(int, tuple): index of the ROI in *rois_data* and
+        analysis result (see
+        :meth:`~pyhrf.ui.analyser_ui.FMRIAnalyser.analyse_roi_wrap`)
+    """
+    costs = [analyser.estimate_roi_cost(d) for d in rois_data]
+    order = schedule_longest_first(costs)
+    logger.info('Local scheduling of %d rois on %d processes (costs: %s)',
+                len(rois_data), n_jobs,
+                ', '.join('%d:%g' % (i, costs[i]) for i in order))
+
+    if n_jobs == 1 or len(rois_data) < 2:
+        for iroi in order:
+            yield iroi, analyser.analyse_roi_wrap(rois_data[iroi])
+        return
+
+    bold_buffer = None
+    if all(isinstance(d, FmriData) and d.bold.ndim == 2 for d in rois_data):
+        bold_buffer = share_rois_bold(rois_data)
+        tasks = ((i, _detach_bold(rois_data[i])) for i in order)
+    else:
+        tasks = ((i, rois_data[i]) for i in order)
+
+    pool = multiprocessing.Pool(min(n_jobs, len(rois_data)),
+                                _init_local_worker, (analyser, bold_buffer))
+    try:
+        for iroi, result, report in pool.imap_unordered(_analyse_local_roi,
+                                                        tasks):
+            yield iroi, (rois_data[iroi], result, report)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import multiprocessing
 
 from time import time
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import numpy
 import numpy as np
@@ -12,6 +13,7 @@ import scipy.stats
 from numpy import (array, int32, float32, fix, sqrt, eye, dot, linalg, kron,
                    newaxis, log, array2string)
 from numpy import zeros
+from numpy.lib.stride_tricks import as_strided
 
 import pyhrf
 
@@ -20,6 +22,7 @@ from pyhrf import xmlio
 from pyhrf.tools import format_duration
 from pyhrf.ndarray import xndarray, stack_cuboids
 from pyhrf.boldsynth.hrf import getCanoHRF
+from pyhrf.parallel import shared_zeros
 
 
 logger = logging.getLogger(__name__)
@@ -29,6 +32,105 @@ def init_dict():
     return defaultdict(list)
 
 
+# onset matrices of the last analysed paradigms (see `onset_matrix`):
+_onset_matrix_cache = OrderedDict()
+onset_matrix_cache_size = 8
+
+
+def onset_matrix_key(onsets, durations, nb_scans, tr, dt, nb_coeffs,
+                     block_design):
+    """Hashable key identifying the onset matrix built by `onset_matrix`."""
+    paradigm = tuple((np.asarray(o, dtype=float).tostring(),
+                      np.asarray(d, dtype=float).tostring())
+                     for o, d in zip(onsets, durations))
+    return (paradigm, int(nb_scans), float(tr), float(dt), int(nb_coeffs),
+            bool(block_design))
+
+
+def onset_matrix(onsets, durations, nb_scans, tr, dt, nb_coeffs,
+                 block_design, cache=True):
+    """Compute the onset matrix of one session.
+
+    Entry [m, n, k] relates the HRF coefficient k+1 of condition m (sampled at
+    `dt`) to scan n (sampled at `tr`):
+
+    - event-related design: 1 if an onset lies in ]n*tr - (k+1)*dt, n*tr - k*dt]
+    - block design: dt/tr if an onset lies in ]n*tr - (k+1)*dt - tr - duration,
+      n*tr - (k+1)*dt]
+
+    Parameters
+    ----------
+    onsets
+        list of onset arrays, one for each condition
+    durations
+        list of duration arrays, one for each condition (only used for block
+        designs)
+    nb_scans
+        number of scans of the session
+    tr
+        time of repetition
+    dt
+        time resolution of the HRF
+    nb_coeffs
+        number of HRF coefficients (including the first and the last ones,
+        which are zero and discarded)
+    block_design
+        if True, each stimulus lasts for its duration
+    cache
+        if True, reuse the matrix computed previously for the same paradigm
+
+    Returns
+    -------
+    numpy array of shape (nb_conditions, nb_scans, nb_coeffs - 1), float32.
+    Matrices taken from the cache are read-only.
+
+    """
+    if cache:
+        key = onset_matrix_key(onsets, durations, nb_scans, tr, dt,
+                               nb_coeffs, block_design)
+        if key in _onset_matrix_cache:
+            _onset_matrix_cache[key] = _onset_matrix_cache.pop(key)
+            return _onset_matrix_cache[key]
+
+    X = numpy.zeros((len(onsets), nb_scans, nb_coeffs - 1), dtype=np.float32)
+    k = np.arange(nb_coeffs - 1)
+    for m, (cond_onsets, cond_durations) in enumerate(zip(onsets, durations)):
+        o = np.asarray(cond_onsets, dtype=float).ravel()
+        if o.size == 0:
+            continue
+        if block_design:
+            d = np.asarray(cond_durations, dtype=float).ravel()
+            max_duration = d.max()
+        else:
+            max_duration = 0.
+        # window of the scans that may be affected by each onset:
+        # n[j, w], j: onset index, w: scan index in window
+        width = int(np.ceil((nb_coeffs * dt + max_duration + 0.002) / tr)) + 4
+        first_scan = np.maximum(np.floor((o - 0.001) / tr).astype(int) - 1, 0)
+        n = first_scan[:, newaxis] + np.arange(width)
+        o3 = o[:, newaxis, newaxis]
+        n3 = n[:, :, newaxis]
+        if block_design:
+            hit = ((o3 <= n3 * tr - (k + 1.) * dt + 0.001) &
+                   (o3 > (n3 - 1.) * tr - (k + 1.) * dt -
+                    d[:, newaxis, newaxis]))
+            value = dt / tr
+        else:
+            hit = ((o3 <= n3 * tr - k * dt + 0.001) &
+                   (o3 > n3 * tr - (k + 1.) * dt))
+            value = 1.
+        hit &= (n3 < nb_scans)
+        j, w, kk = np.nonzero(hit)
+        X[m, n[j, w], kk] = value
+
+    if cache:
+        X.flags.writeable = False
+        _onset_matrix_cache[key] = X
+        while len(_onset_matrix_cache) > onset_matrix_cache_size:
+            _onset_matrix_cache.popitem(last=False)
+    return X
+
+
 class RFIREstim(xmlio.XmlInitable):
     """
     Class handling the estimation of HRFs from fMRI data.
@@ -44,6 +146,7 @@ class RFIREstim(xmlio.XmlInitable):
         ' nb_hrf_coeffs * hrf_dt ',
         'hrf_dt': 'Required HRF temporal resolution',
         'drift_type': 'Basis type in the drift model. Either "cosine" or "poly"',
+        'n_jobs': 'Number of local processes solving blocks of voxels',
     }
 
     if pyhrf.__usemode__ == pyhrf.ENDUSER:
@@ -57,11 +160,14 @@ class RFIREstim(xmlio.XmlInitable):
         default_stop_crit2 = 0.0005
         default_nb_its = None
 
+    # memory used by the voxel-batch EM solver (see get_voxel_batch_size)
+    batch_memory = 256 * 2 ** 20
+
     def __init__(self, hrf_nb_coeffs=42, hrf_dt=0.6, drift_type='cosine',
                  stop_crit1=default_stop_crit1, stop_crit2=default_stop_crit2,
                  nb_its_max=5, nb_iterations=default_nb_its, nb_its_min=1,
                  average_bold=False, taum=0.01, lambda_reg=100., fixed_taum=False,
-                 discarded_scan_indexes=None, output_fit=False):
+                 discarded_scan_indexes=None, output_fit=False, n_jobs=1):
         """
            'discarded_scan_indexes' : None if no subsampling done, else give position that were removed after temporal subsampling as a 2d numpy array
 
@@ -90,6 +196,7 @@ class RFIREstim(xmlio.XmlInitable):
 
         self.pos_removed = discarded_scan_indexes or np.array(([0]))
         self.output_fit = output_fit
+        self.n_jobs = n_jobs
 
     def linkToData(self, data):
 
@@ -127,15 +234,51 @@ class RFIREstim(xmlio.XmlInitable):
         logger.info('Starting voxel-wise HRF estimation ...')
         logger.info('nvox=%d, ncond=%d, nscans=%d', self.nbVoxels, self.M,
                     self.ImagesNb)
+        nbVoxels = self.bold.shape[1]
+        n_jobs = self.get_nb_processes()
+        # results of the worker processes are directly written in storage
+        # matrices:
+        shared = n_jobs > 1 and not self.save_history
+
         # initialization of the matrices that will store all voxel resuls
         logger.info("Init storage ...")
-        self.InitStorageMat()
+        self.InitStorageMat(shared)
         logger.info("Compute onset matrix ...")
         self.Compute_onset_matrix3()
 
-        self.stop_iterations = np.zeros(self.bold.shape[1], dtype=int)
+        if shared:
+            self.stop_iterations = shared_zeros(nbVoxels, dtype=int)
+        else:
+            self.stop_iterations = np.zeros(nbVoxels, dtype=int)
+
+        if self.save_history:
+            # the history is recorded voxel by voxel
+            self.run_voxelwise()
+        else:
+            batch_size = self.get_voxel_batch_size()
+            if n_jobs > 1:
+                # enough blocks to balance the load between processes
+                batch_size = min(batch_size,
+                                 int(np.ceil(nbVoxels / (4. * n_jobs))))
+            blocks = [np.arange(start, min(start + batch_size, nbVoxels))
+                      for start in xrange(0, nbVoxels, batch_size)]
+            if n_jobs > 1:
+                self.run_blocks_local(blocks, n_jobs)
+            else:
+                for voxels in blocks:
+                    t0 = time()
+                    logger.info("Points %d-%d / %d", voxels[0], voxels[-1],
+                                nbVoxels)
+                    self.EM_solver_batch(voxels)
+                    logger.info("Done in %s", format_duration(time() - t0))
+
+        self.clean_memory()
+
+        logger.info('Nb of iterations to reach stop crit: %s',
+                    array_summary(self.stop_iterations))
 
-        # voxelwise analysis. This loop handles the currently analyzed voxels.
+    def run_voxelwise(self):
+        """Run the EM solver voxel by voxel (slow but handles the history of estimates)"""
         for POI in xrange(self.bold.shape[1]):  # POI = point of interest
             t0 = time()
             logger.info("Point %s / %s", str(POI), str(self.nbVoxels))
@@ -165,15 +308,62 @@ class RFIREstim(xmlio.XmlInitable):
             self.StoreRes(POI)
             logger.info("Done in %s", format_duration(time() - t0))
 
-        self.clean_memory()
+    def get_nb_processes(self):
+        """Number of local processes solving blocks of voxels: `n_jobs`,
+        within the number of voxels and of CPUs. Blocks are solved in the
+        current process if it is itself a pool worker (eg when parcels are
+        analysed in parallel), since daemonic processes cannot have children."""
+        if multiprocessing.current_process().daemon:
+            return 1
+        return max(1, min(self.n_jobs, self.bold.shape[1],
+                          multiprocessing.cpu_count()))
+
+    def run_blocks_local(self, blocks, n_jobs):
+        """Solve blocks of voxels with `EM_solver_batch` on a pool of local processes.
+
+        The onset matrix and the drift basis are computed once, before the
+        worker processes are forked, and are then shared read-only. Storage
+        matrices must have been allocated in shared memory (see
+        `InitStorageMat`): each worker writes the results of its blocks
+        directly in them.
 
-        logger.info('Nb of iterations to reach stop crit: %s',
-                    array_summary(self.stop_iterations))
+        Parameters
+        ----------
+        blocks
+            list of arrays of voxel indexes
+        n_jobs
+            number of worker processes
+        """
+        self.get_batch_design()
+        logger.info('Solving %d blocks of voxels on %d processes',
+                    len(blocks), n_jobs)
+        t0 = time()
+        pool = multiprocessing.Pool(min(n_jobs, len(blocks)),
+                                    _init_rfir_worker, (self,))
+        try:
+            for iblock, voxels in enumerate(
+                    pool.imap_unordered(_solve_rfir_block, blocks)):
+                logger.info("Points %d-%d done (%d/%d blocks), elapsed "
+                            "time: %s", voxels[0], voxels[-1], iblock + 1,
+                            len(blocks), format_duration(time() - t0))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def get_voxel_batch_size(self):
+        """Number of voxels solved at once by `EM_solver_batch`, so that the
+        stacked posterior covariance matrices hold in `batch_memory` bytes."""
+        SBS = self.K - 1
+        # InvSigma, Sigma and a temporary copy, in float32:
+        voxel_memory = 3 * 4 * (self.M * SBS) ** 2
+        return max(1, min(self.bold.shape[1],
+                          int(self.batch_memory / voxel_memory)))
 
     def clean_memory(self):
         """ Clean all objects that are useless for outputs
         """
-        pass
+        self._batch_design = None
         # del self.Sigma
         # del self.X
         # del self.R
@@ -182,29 +372,37 @@ class RFIREstim(xmlio.XmlInitable):
         # del self.h
 
     #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-    def InitStorageMat(self):
+    def InitStorageMat(self, shared=False):
         """Initialization of the matrices that will store all voxel results.
 
+        Parameters
+        ----------
+        shared
+            if True, the voxel result matrices are allocated in shared memory
+            so that worker processes can fill them (see `run_blocks_local`)
+
         Notes
         -----
         Input signals must have been read (in ReadRealSignal)
 
         """
+        zeros = shared_zeros if shared else numpy.zeros
         npos = self.bold.shape[1]
-        self.Pvalues = -0.1 * numpy.ones((self.M, npos), dtype=float)
-        self.ResponseFunctionsEvaluated = numpy.zeros(
+        self.Pvalues = zeros((self.M, npos), dtype=float)
+        self.Pvalues[:] = -0.1
+        self.ResponseFunctionsEvaluated = zeros(
             (self.M, self.K + 1, npos), dtype=np.float32)
         if self.compute_pct_change:
-            self.ResponseFunctionsEvaluated_PctChgt = numpy.zeros(
+            self.ResponseFunctionsEvaluated_PctChgt = zeros(
                 (self.M, self.K + 1, npos), dtype=np.float32)
         # sqrt of the diagonal of the covariance matrix
-        self.StdValEvaluated = numpy.zeros(
+        self.StdValEvaluated = zeros(
             (self.M, self.K + 1, npos), dtype=np.float32)
         if self.compute_pct_change:
             # sqrt of the diagonal of the covariance matrix
-            self.StdValEvaluated_PctChgt = numpy.zeros(
+            self.StdValEvaluated_PctChgt = zeros(
                 (self.M, self.K + 1, npos), dtype=np.float32)
-        self.SignalEvaluated = numpy.zeros(
+        self.SignalEvaluated = zeros(
             (self.ImagesNb, npos), dtype=np.float32)
 
         # orthonormal basis ('P') initialization: self.P[i][n,q] -> n^th value
@@ -218,7 +416,7 @@ class RFIREstim(xmlio.XmlInitable):
         # for i in xrange(self.I):
         #     self.l[i] = numpy.zeros((self.Qi[i]),dtype=float)
 
-        self.l = numpy.zeros((self.I, self.Qi[i], npos), dtype=np.float32)
+        self.l = zeros((self.I, self.Qi[i], npos), dtype=np.float32)
 
         # inverse of R
         self.InvR = numpy.zeros((self.K - 1, self.K - 1), dtype=np.float32)
@@ -358,6 +556,9 @@ class RFIREstim(xmlio.XmlInitable):
         - data nb n (\in 0:Ni[i]-1)
         - hrf coef nb k (\in 0:K-2)
 
+        Onset matrices are built by `onset_matrix` and shared by all the
+        analyses of the same paradigm.
+
         """
         # Onset matrix ('X') initialization: self.X[i][m,n,k] -> binary value of the onset matrix for session i / condition m / data nb n (real time) / hrf coef nb k (oversampled time)
         # Warning: since the first and the last values of the HRFs = 0, the nb
@@ -376,51 +577,16 @@ class RFIREstim(xmlio.XmlInitable):
             self.Ni = array([len(ss) + nb_removed for ss in self.sscans])
             # print self.Ni
 
-        for i in xrange(self.I):
-            self.X.append(
-                numpy.zeros((self.M, self.Ni[i], self.K - 1), dtype=np.float32))
-
-        # print np.array(self.X).shape, self.Ni[0]
-        # tests consistency between 'OnsetList' and the size of 'X'
-        I = len(self.X)
-        M = self.X[0].shape[0]
-        K = self.X[0].shape[2] + 1
-        Ni = numpy.zeros(I).astype(int32)
-        for i in xrange(I):
-            Ni[i] = self.X[i].shape[1]
-
-        if K != self.K or I != self.I or M != self.M or sum(abs(Ni - self.Ni)) > 0.01:
-            print 'OnsetList is not consitent with X'
-
         # computes the onset matrix X
-        # BLOCK DESIGNED STIMULI
-        if (self.LengthOnsets[0][0][0] > self.DeltaT):
-            for i in xrange(I):
-                for m in xrange(self.X[i].shape[0]):
-                    for j in xrange(self.OnsetList[i][m].shape[0]):
-                        # j^th onset of [session i / parameter m] is considered
-                        CurrentOnset = self.OnsetList[i][m][j]
-                        for n in xrange(Ni[i]):
-                            for k in xrange(K - 1):
-                                if CurrentOnset <= (n * self.TR - (k + 1.0) * self.DeltaT + 0.001) and CurrentOnset > ((n - 1.) * self.TR - (k + 1.) * self.DeltaT - self.LengthOnsets[m][i][j]):
-                                    self.X[i][m][n, k] = (
-                                        self.DeltaT / self.TR)
-
-        else:  # EVENT DESIGNED STIMULI
-            for i in xrange(I):
-                for m in xrange(self.X[i].shape[0]):
-                    for j in xrange(self.OnsetList[i][m].shape[0]):
-                        # j^th onset of [session i / parameter m] is considered
-                        CurrentOnset = self.OnsetList[i][m][j]
-                        # print 'onset:', CurrentOnset, CurrentOnset.shape
-                        for n in xrange(Ni[i]):
-                            for k in xrange(K - 1):
-                                if CurrentOnset <= (n * self.TR - (k) * self.DeltaT + 0.001) and CurrentOnset > ((n) * self.TR - (k + 1.) * self.DeltaT):
-                                    self.X[i][m][n, k] = 1.
-                                    # print 'cond ok'
-                                    # print '(n)*self.TR-(k+1.)*self.DeltaT:', (n)*self.TR-(k+1.)*self.DeltaT
-                                    # print 'n*self.TR-(k)*self.DeltaT+0.001:',
-                                    # n*self.TR-(k)*self.DeltaT+0.001
+        # BLOCK DESIGNED STIMULI if LengthOnsets > DeltaT, EVENT DESIGNED
+        # STIMULI otherwise
+        block_design = self.LengthOnsets[0][0][0] > self.DeltaT
+        for i in xrange(self.I):
+            self.X.append(onset_matrix(self.OnsetList[i],
+                                       [self.LengthOnsets[m][i]
+                                        for m in xrange(self.M)],
+                                       self.Ni[i], self.TR, self.DeltaT,
+                                       self.K, block_design))
 
         # Then remove the lines in X corresponding to removed positions
         # assuming same nb of scans per session and samed removed positions
@@ -1045,7 +1211,288 @@ class RFIREstim(xmlio.XmlInitable):
             "iteration: %s -> delta_h=%s", str(iteration), str(delta_h))
 
 
-def rfir(func_data, fir_duration=42, fir_dt=.6, nb_its_max=100, nb_its_min=5, fixed_taum=False, lambda_reg=100.):
+    #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_batch_design(self):
+        """Voxel-independent quantities of `EM_solver_batch`, computed once.
+
+        Returns
+        -------
+        InvR
+            inverse of the HRF regularization matrix (float32)
+        Xcat
+            onset matrix of each session with conditions concatenated along
+            columns: Xcat[i][n, m*SBS+k] = X[i][m][n, k]
+        XtX
+            Xcat[i].T Xcat[i] for each session
+
+        Notes
+        -----
+        `Compute_onset_matrix3` must have been called
+        """
+        if getattr(self, '_batch_design', None) is None:
+            self.epsilon = 1e-4
+            self.buildLowFreqMat()
+            self.Compute_INV_R_and_R_and_DET_R()
+            InvR = self.InvR.astype(np.float32)
+            Xcat = [np.hstack(np.asarray(self.X[i], dtype=np.float32))
+                    for i in xrange(self.I)]
+            XtX = [dot(Xc.T, Xc) for Xc in Xcat]
+            self._batch_design = (InvR, Xcat, XtX)
+        return self._batch_design
+
+    def EM_solver_batch(self, voxels):
+        """Solve the EM for all the given voxels at once.
+
+        Same algorithm as `EM_solver`, where the voxel-independent quantities
+        (onset matrix products, drift basis, InvR) are computed once and the
+        updates of all voxels are stacked. Voxels are removed from the active
+        set as soon as their stopping criterion is met and their results are
+        stored (see `StoreResBatch`).
+
+        Parameters
+        ----------
+        voxels
+            indexes of the voxels to analyse (in `self.bold`)
+
+        Notes
+        -----
+        `InitStorageMat` and `Compute_onset_matrix3` must have been called
+        """
+        SBS = self.K - 1
+        MS = self.M * SBS
+        I = self.I
+        InvR, Xcat, XtX = self.get_batch_design()
+        Ni = [float(n) for n in self.Ni]
+        trRR = dot(self.R, self.R).trace()
+        hRh = lambda h: np.einsum('kv,kl,lv->v', h, self.R, h)
+
+        # initial values:
+        nvox = len(voxels)
+        hcano = getCanoHRF(dt=self.DeltaT, duration=self.K * self.DeltaT)[1]
+        h = np.repeat(np.tile(hcano[1:self.K].astype(np.float32), self.M)
+                      [:, newaxis], nvox, axis=1)  # (M*SBS, nvox)
+        l = [numpy.zeros((self.P[i].shape[1], nvox), dtype=np.float32)
+             for i in xrange(I)]
+        y = [self.bold[self.sscans[i]][:, voxels] for i in xrange(I)]
+        TauM = numpy.zeros((self.M, nvox), dtype=np.float32) + self.taum_init
+        rb = numpy.ones((I, nvox), dtype=np.float32)
+
+        def cpt_sigma(TauM, rb):
+            # stacked version of CptSigma
+            InvSigma = numpy.zeros((TauM.shape[1], MS, MS), dtype=np.float32)
+            for m in xrange(self.M):
+                InvSigma[:, m * SBS:(m + 1) * SBS, m * SBS:(m + 1) * SBS] = \
+                    InvR / TauM[m][:, newaxis, newaxis]
+            for i in xrange(I):
+                InvSigma += XtX[i] / rb[i][:, newaxis, newaxis]
+            return InvSigma, linalg.inv(InvSigma)
+
+        def cpt_big_vector(y, l, rb=None):
+            BigVector = 0.
+            for i in xrange(I):
+                temp = dot(Xcat[i].T, y[i] - dot(self.P[i], l[i]))
+                if rb is not None:
+                    temp /= rb[i]
+                BigVector += temp
+            return BigVector
+
+        def cpt_drifts(y, h):
+            return [dot(self.P[i].T, y[i] - dot(Xcat[i], h)).astype(np.float32)
+                    for i in xrange(I)]
+
+        # each voxel is stored as soon as it stops
+        def store(stopped, iteration, h, l, InvSigma, Sigma):
+            self.stop_iterations[voxels[stopped]] = iteration
+            if InvSigma.ndim == 3:
+                InvSigma, Sigma = InvSigma[stopped], Sigma[stopped]
+            self.StoreResBatch(voxels[stopped], h[:, stopped],
+                               [li[:, stopped] for li in l], InvSigma, Sigma)
+
+        iteration = 1
+        if not self.fixed_taum:
+            InvSigma, Sigma = cpt_sigma(TauM, rb)
+            FctQ = numpy.zeros(nvox) + 1000000000.0
+            StopTest1 = numpy.ones(nvox)
+            StopTest2 = numpy.ones(nvox)
+        else:
+            # the posterior covariance does not depend on voxels:
+            InvSigma = numpy.zeros((MS, MS), dtype=np.float32)
+            for m in xrange(self.M):
+                InvSigma[m * SBS:(m + 1) * SBS, m * SBS:(m + 1) * SBS] = \
+                    InvR * self.lambda_reg
+            for i in xrange(I):
+                InvSigma += XtX[i]
+            Sigma = linalg.inv(InvSigma)
+            h_prev = np.ones((MS, nvox))
+            delta_h = numpy.ones(nvox)
+
+        while len(voxels) > 0:
+
+            # stopping criterion for each voxel
+            if self.nbIt is not None:
+                running = np.zeros(len(voxels), dtype=bool)
+                running[:] = iteration < self.nbIt
+            elif not self.fixed_taum:
+                running = (iteration < self.nbItMin) | \
+                    ((iteration < self.nbItMax) &
+                     ((StopTest1 > self.emStop1) | (StopTest2 > self.emStop2)))
+            else:
+                running = (iteration < self.nbItMin) | \
+                    ((iteration < self.nbItMax) & (delta_h > self.epsilon))
+
+            if not running.all():
+                store(~running, iteration, h, l, InvSigma, Sigma)
+                # remove stopped voxels from the active set
+                voxels, h, y = voxels[running], h[:, running], \
+                    [yi[:, running] for yi in y]
+                l = [li[:, running] for li in l]
+                if not self.fixed_taum:
+                    InvSigma, Sigma = InvSigma[running], Sigma[running]
+                    TauM, rb, FctQ = TauM[:, running], rb[:, running], \
+                        FctQ[running]
+                else:
+                    h_prev = h_prev[:, running]
+                if len(voxels) == 0:
+                    break
+
+            if not self.fixed_taum:
+                # 1 ) estimation of \hat{h^{MAP}}
+                BigVector2 = np.einsum('vab,bv->av', Sigma,
+                                       cpt_big_vector(y, l, rb))
+                h = BigVector2.astype(np.float32)
+
+                # 2 ) estimation of \hat{l_i}
+                l = cpt_drifts(y, h)
+
+                # 3 ) estimation of \hat{rb}
+                Old_rb = rb
+                rb = numpy.zeros_like(Old_rb)
+                for i in xrange(I):
+                    temp = y[i] - dot(self.P[i], l[i]) - dot(Xcat[i], h)
+                    term1 = (temp ** 2).sum(0)
+                    term2 = np.einsum('vab,ab->v', Sigma, XtX[i])
+                    rb[i] = (term1 + term2) / Ni[i]
+
+                # 4 ) reestimation of sigma
+                InvSigma, Sigma = cpt_sigma(TauM, rb)
+
+                # 5 ) estimation of \TauM
+                OldTauM = TauM
+                TauM = numpy.zeros_like(OldTauM)
+                for m in xrange(self.M):
+                    hm = h[m * SBS:(m + 1) * SBS]
+                    Sigma_mm = Sigma[:, m * SBS:(m + 1) * SBS,
+                                     m * SBS:(m + 1) * SBS]
+                    TauM[m] = (np.einsum('kv,kl,lv->v', hm, InvR, hm) +
+                               np.einsum('vkl,kl->v', Sigma_mm, InvR)) / SBS
+
+                # 6 ) Q function estimation (see CptFctQ)
+                FctQ_Km1_Km1 = FctQ
+                FctQ = dot(Ni, rb)
+                FctQ -= (SBS * log(TauM) / 2.).sum(0)
+                for m in xrange(self.M):
+                    FctQ -= TauM[m] * hRh(h[m * SBS:(m + 1) * SBS]) / 2.
+                    if self.OrthoBtype == 'cosine':
+                        FctQ -= OldTauM[m] * TauM[m] * trRR / 2
+                    else:
+                        FctQ -= TauM[m] * TauM[m] * trRR / 2
+                FctQ -= (self.M / 2.) * log(self.DetR)
+
+                # 7 ) Stopping criterion
+                StopTest1 = np.abs(FctQ - FctQ_Km1_Km1) / np.abs(FctQ)
+                dTauM2 = ((TauM - OldTauM) ** 2.0).sum(0)
+                TauM2 = (TauM ** 2.0).sum(0)
+                StopTest2 = np.sqrt(dTauM2 + (Old_rb - rb) ** 2.0) / \
+                    np.sqrt(TauM2 + rb ** 2.0)
+                StopTest2 = np.maximum(StopTest2.max(0), 0.)
+            else:
+                # 1 ) estimation of \hat{h^{MAP}}
+                BigVector2 = dot(Sigma, cpt_big_vector(y, l))
+                h = BigVector2.astype(np.float32)
+
+                # 2 ) estimation of \hat{l_i}
+                l = cpt_drifts(y, h)
+
+                # 7 ) Stopping criterion
+                delta_h = ((h_prev - BigVector2) ** 2).sum(0) ** .5
+                h_prev = BigVector2
+
+            iteration = iteration + 1
+
+    #++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    def StoreResBatch(self, voxels, h, l, InvSigma, Sigma):
+        """Store results of several voxels estimated by `EM_solver_batch`.
+
+        Parameters
+        ----------
+        voxels
+            indexes of the voxels (in `self.bold`)
+        h
+            HRF estimates, shape (M*(K-1), nb voxels)
+        l
+            drift coefficients of each session, shape (Qi, nb voxels)
+        InvSigma, Sigma
+            posterior precision and covariance, shape (nb voxels, M*(K-1), M*(K-1)),
+            or (M*(K-1), M*(K-1)) if they are the same for all voxels
+        """
+        SBS = self.K - 1
+        nvox = len(voxels)
+        if Sigma.ndim == 2:
+            # read-only views repeating the same matrices for all voxels:
+            Sigma = as_strided(Sigma, shape=(nvox,) + Sigma.shape,
+                               strides=(0,) + Sigma.strides)
+            InvSigma = as_strided(InvSigma, shape=(nvox,) + InvSigma.shape,
+                                  strides=(0,) + InvSigma.strides)
+        meanLoc = abs(self.bold[:, voxels].mean(0))
+
+        for m in xrange(self.M):
+            hm = h[m * SBS:(m + 1) * SBS]
+
+            # store evaluated response function (percentage of signal change)
+            if self.compute_pct_change:
+                self.ResponseFunctionsEvaluated_PctChgt[
+                    m, 1:self.K][:, voxels] = hm * 100 / meanLoc
+
+            # store evaluated response function (without normalization)
+            self.ResponseFunctionsEvaluated[m, 1:self.K][:, voxels] = hm
+
+            # store the P-value
+            block = slice(m * SBS, (m + 1) * SBS)
+            chi2 = np.einsum('kv,vkl,lv->v', hm.astype(float),
+                             InvSigma[:, block, block], hm.astype(float))
+            self.Pvalues[m, voxels] = 1 - scipy.stats.chi2.cdf(chi2, SBS)
+
+            # store the sqrt of the diagonal of the covariance matrix
+            errors = sqrt(np.diagonal(Sigma[:, block, block], axis1=1,
+                                      axis2=2)).T
+            if self.compute_pct_change:
+                self.StdValEvaluated_PctChgt[
+                    m, 1:self.K][:, voxels] = errors * 100 / meanLoc
+            self.StdValEvaluated[m, 1:self.K][:, voxels] = errors
+
+        for i in xrange(self.I):
+            self.l[i][:, voxels] = l[i]
+
+        # signal evaluated in the first session (see compute_fit)
+        fit = dot(self.P[0], l[0]) + \
+            dot(np.hstack(np.asarray(self.X[0], dtype=np.float32)), h)
+        self.SignalEvaluated[0:fit.shape[0], voxels] = fit
+
+
+_rfir_worker = {}
+
+
+def _init_rfir_worker(rfir_estim):
+    _rfir_worker['estim'] = rfir_estim
+
+
+def _solve_rfir_block(voxels):
+    _rfir_worker['estim'].EM_solver_batch(voxels)
+    return voxels
+
+
+def rfir(func_data, fir_duration=42, fir_dt=.6, nb_its_max=100, nb_its_min=5, fixed_taum=False, lambda_reg=100.,
+         n_jobs=1):
     """Fit a Regularized FIR on functional data `func_data`:
 
     - multisession voxel-based fwd model: y = \sum Xh + Pl + b
@@ -1073,6 +1520,8 @@ def rfir(func_data, fir_duration=42, fir_dt=.6, nb_its_max=100, nb_its_min=5, fi
         minimum number of iterations for the EM
     nb_its_max
         maximum number of iterations for the EM
+    n_jobs : int
+        number of local processes solving blocks of voxels
 
     Returns
     -------
@@ -1082,7 +1531,7 @@ def rfir(func_data, fir_duration=42, fir_dt=.6, nb_its_max=100, nb_its_min=5, fi
     rfir_estimator = RFIREstim(hrf_nb_coeffs=int(np.round(fir_duration / fir_dt)),
                                hrf_dt=fir_dt, nb_its_max=nb_its_max,
                                nb_its_min=nb_its_min, fixed_taum=fixed_taum,
-                               lambda_reg=lambda_reg)
+                               lambda_reg=lambda_reg, n_jobs=n_jobs)
     rfir_estimator.linkToData(func_data)
     rfir_estimator.run()
     outputs = rfir_estimator.getOutputs()
@@ -78,6 +78,45 @@ class FieldFuncsTest(unittest.TestCase):
         mapPotts = np.ones_like(mask)
         mapPotts[np.where(mask)] = labels
 
+    def _check_swendsenwang_distribution(self, method, weights=None):
+        """ Compare the distribution of U over Swendsen-Wang samples with
+        the exact one on a small 2D lattice """
+        np.random.seed(1)
+        beta, nb_labels, nb_samples = .8, 2, 4000
+        g = graph_from_lattice(np.ones((2, 3), dtype=int),
+                               kerMask=kerMask2D_4n)
+        csr_g = CSRGraph.from_lists(g)
+        if weights is not None:
+            csr_g = CSRGraph(csr_g.indptr, csr_g.indices, weights)
+        energies = []
+        for config in xrange(nb_labels ** len(g)):
+            labels = (config >> np.arange(len(g))) & 1
+            energies.append(Cpt_U_graph(csr_g, labels))
+        energies = np.array(energies)
+        p_exact = np.exp(beta * energies)
+        p_exact /= p_exact.sum()
+
+        if weights is not None:
+            weights = [weights[csr_g.indptr[i]:csr_g.indptr[i + 1]]
+                       for i in xrange(len(g))]
+        labels = np.zeros(len(g), dtype=int)
+        sampled = np.zeros(len(energies))
+        for i in xrange(nb_samples):
+            SwendsenWangSampler_graph(g, labels, beta, nb_labels,
+                                      method=method, weights=weights)
+            sampled[(labels << np.arange(len(g))).sum()] += 1
+        sampled /= nb_samples
+        self.assertLess(np.abs(sampled - p_exact).max(), .02)
+
+    def test_swendsenwang_distribution(self):
+        self._check_swendsenwang_distribution(LINK_CSR_METHOD)
+        self._check_swendsenwang_distribution(LINK_GRAPH_METHOD)
+
+    def test_swendsenwang_weighted_distribution(self):
+        # only the weights of edges (i, j) with i < j are used:
+        weights = np.linspace(.5, 1.5, 14)
+        self._check_swendsenwang_distribution(LINK_CSR_METHOD, weights)
+
     def test_potts_gibbs(self):
         nbLabels = 2
         shape = (15, 15)
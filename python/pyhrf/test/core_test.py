@@ -5,6 +5,7 @@ import unittest
 import tempfile
 import shutil
 import numpy as np
+import numpy.testing as npt
 
 import pyhrf
 from pyhrf.core import FmriData, merge_fmri_sessions
@@ -21,3 +22,50 @@ class FMRIDataTest(unittest.TestCase):
 
         fd_msession = merge_fmri_sessions([fd1, fd2])
         self.assertEqual(fd_msession.nbSessions, 2)
+
+    def _check_roi_split(self, fdata, rois_data):
+        mask = fdata.roiMask
+        in_mask = mask[np.where(mask != fdata.backgroundLabel)]
+        roi_ids = np.unique(in_mask)
+        self.assertEqual([d.get_roi_id() for d in rois_data], list(roi_ids))
+        for roi_id, roi_data in zip(roi_ids, rois_data):
+            npt.assert_array_equal(roi_data.roiMask != fdata.backgroundLabel,
+                                   mask == roi_id)
+            npt.assert_array_equal(roi_data.bold,
+                                   fdata.bold[:, np.where(in_mask == roi_id)[0]])
+
+    def test_roi_split(self):
+        fdata = FmriData.from_vol_files()
+        self._check_roi_split(fdata, fdata.roi_split())
+
+    def test_roi_split_shared_bold(self):
+        fdata = FmriData.from_vol_files()
+        rois_data = fdata.roi_split(bold_storage='shared')
+        self._check_roi_split(fdata, rois_data)
+        bold_buffer = rois_data[0].bold_buffer
+        for roi_data in rois_data:
+            self.assertIs(roi_data.bold_buffer, bold_buffer)
+            self.assertTrue(roi_data.bold.flags['C_CONTIGUOUS'])
+            self.assertTrue(np.may_share_memory(roi_data.bold,
+                                                bold_buffer.data))
+
+    def test_roi_split_memmap_bold(self):
+        tmp_dir = tempfile.mkdtemp(prefix='pyhrf_tests')
+        try:
+            fdata = FmriData.from_vol_files()
+            rois_data = fdata.roi_split(bold_storage=op.join(tmp_dir,
+                                                             'bold.dat'))
+            self._check_roi_split(fdata, rois_data)
+            self.assertIsInstance(rois_data[0].bold_buffer.data, np.memmap)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_roi_graph_from_cropped_mask(self):
+        fdata = FmriData.from_vol_files()
+        fdata.build_graphs()
+        for roi_data in fdata.roi_split():
+            roi_id = roi_data.get_roi_id()
+            roi_data.build_graphs(force=True)
+            for nl_cropped, nl in zip(roi_data.graphs[roi_id],
+                                      fdata.graphs[roi_id]):
+                npt.assert_array_equal(nl_cropped, nl)
@@ -101,6 +101,94 @@ class GraphTest(unittest.TestCase):
         for ip, pg in pgs.iteritems():
             assert graph_is_sane(pg)
 
+    def test_parcels_to_csr_graphs(self):
+        pgs = parcels_to_csr_graphs(self.lattice3D, kerMask=kerMask3D_6n)
+        self.assertEqual(sorted(pgs.keys()), [0, 1, 2])
+        for pid, pg in pgs.iteritems():
+            expected = lattice_graph(self.lattice3D == pid, kerMask3D_6n)
+            _np.testing.assert_array_equal(pg.indptr, expected.indptr)
+            _np.testing.assert_array_equal(pg.indices, expected.indices)
+        pgs = parcels_to_csr_graphs(self.lattice3D, kerMask=kerMask3D_6n,
+                                    toDiscard=[0])
+        self.assertEqual(sorted(pgs.keys()), [1, 2])
+
+    def test_csr_graph(self):
+        g = graph_from_lattice(self.lattice3D, kerMask=kerMask3D_6n)
+        csr_g = CSRGraph.from_lists(g)
+        self.assertEqual(len(csr_g), len(g))
+        self.assertTrue(csr_g.is_sane())
+        self.assertEqual(csr_g.nb_cliques(), graph_nb_cliques(g))
+        for nl, csr_nl in zip(g, csr_g.to_lists()):
+            _np.testing.assert_array_equal(nl, csr_nl)
+        for i in xrange(len(g)):
+            _np.testing.assert_array_equal(g[i], csr_g[i])
+
+    def test_csr_graph_not_sane(self):
+        bad = _np.array([_np.array([1, 3]), _np.array([0, 2, 4]),
+                         _np.array([1, 5]), _np.array([0, 4, 6]),
+                         _np.array([1, 5, 3, 7]), _np.array([2, 8]),
+                         _np.array([3, 7]), _np.array([6, 4, 8]),
+                         _np.array([7, 5])], dtype=object)
+        self.assertFalse(CSRGraph.from_lists(bad).is_sane())
+        bad[0] = _np.array([1, 3, 3])
+        self.assertFalse(CSRGraph.from_lists(bad).is_sane())
+
+    def test_csr_graph_padded(self):
+        vol = _np.array([[1, 1, 0],
+                         [0, 1, 0],
+                         [0, 0, 1]], dtype=int)
+        g = graph_from_lattice(vol, kerMask2D_4n)
+        csr_g = CSRGraph.from_lists(g)
+        padded = csr_g.to_padded()
+        _np.testing.assert_array_equal(padded, [[1, -1], [2, 0], [1, -1],
+                                                [-1, -1]])
+        back = as_csr_graph(padded)
+        _np.testing.assert_array_equal(back.indptr, csr_g.indptr)
+        _np.testing.assert_array_equal(back.indices, csr_g.indices)
+
+    def test_csr_graph_block_diag(self):
+        g1 = CSRGraph.from_lists([[1], [0]])
+        g2 = CSRGraph.from_lists([[], [2], [1]])
+        g = CSRGraph.block_diag([g1, g2])
+        self.assertEqual(len(g), 5)
+        self.assertTrue(g.is_sane())
+        for nl, expected in zip(g, [[1], [0], [], [4], [3]]):
+            _np.testing.assert_array_equal(nl, expected)
+
+    def test_csr_sum_over_neighbours(self):
+        g = graph_from_lattice(self.lattice3D, kerMask=kerMask3D_6n)
+        a = _np.random.randn(2, 3, len(g))
+        expected = _np.zeros_like(a)
+        for i in xrange(len(g)):
+            expected[..., i] = a[..., g[i]].sum(-1)
+        csr_g = CSRGraph.from_lists(g)
+        _np.testing.assert_allclose(csr_g.sum_over_neighbours(a), expected)
+
+        weights = _np.random.rand(len(csr_g.indices))
+        wg = CSRGraph(csr_g.indptr, csr_g.indices, weights)
+        for i in xrange(len(g)):
+            expected[..., i] = (a[..., wg[i]] *
+                                weights[wg.indptr[i]:wg.indptr[i + 1]]).sum(-1)
+        _np.testing.assert_allclose(wg.sum_over_neighbours(a), expected)
+
+    def test_csr_colouring(self):
+        mask = _np.random.rand(8, 7, 6) > .3
+        g = lattice_graph(mask, kerMask3D_6n)
+        colours = g.greedy_colouring()
+        rows = _np.repeat(_np.arange(len(g)), g.degrees())
+        self.assertFalse((colours[rows] == colours[g.indices]).any())
+        # 6-connectivity lattice is bipartite:
+        self.assertEqual(colours.max(), 1)
+        classes = g.colour_classes()
+        _np.testing.assert_array_equal(_np.sort(_np.concatenate(classes)),
+                                       _np.arange(len(g)))
+
+        # 26-connectivity:
+        g = lattice_graph(mask)
+        colours = g.greedy_colouring()
+        rows = _np.repeat(_np.arange(len(g)), g.degrees())
+        self.assertFalse((colours[rows] == colours[g.indices]).any())
+
     def test_bfs(self):
 
         vol = np.array([[1, 1, 0, 1, 1],
@@ -281,6 +281,139 @@ class DataLoadTest(unittest.TestCase):
             print h
 
 
+class BadDataTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.bold = rng.randn(4, 5, 6, 40) * 10 + 50
+        self.bold[1, 1, 1] = 7.3  # constant
+        self.bold[2, 2, 2, 5] = np.nan
+        self.mask = np.ones((4, 5, 6), dtype=int)
+        self.mask[0] = 0
+
+    def test_stats(self):
+        stats = pio.bold_stats(self.bold, time_axis=3,
+                               chunk_memory=7 * 4 * 5 * 6 * 8)
+        np.testing.assert_allclose(stats.mean[0], self.bold[0].mean(-1))
+        np.testing.assert_allclose(stats.var[0], self.bold[0].var(-1, ddof=1))
+        self.assertEqual(stats.var[1, 1, 1], 0.)
+        np.testing.assert_allclose(stats.mean[2, 2, 2],
+                                   np.nanmean(self.bold[2, 2, 2]))
+        np.testing.assert_allclose(stats.var[2, 2, 2],
+                                   np.nanvar(self.bold[2, 2, 2], ddof=1))
+        self.assertEqual(stats.nan_count.sum(), 1)
+        self.assertEqual(stats.count[2, 2, 2], 39)
+        np.testing.assert_array_equal(stats.first, self.bold[..., 0])
+
+    def test_discard_bad_data(self):
+        to_discard, stats = pio.discard_bad_data(self.bold, self.mask,
+                                                 time_axis=3)
+        self.assertEqual(zip(*np.where(to_discard)), [(1, 1, 1), (2, 2, 2)])
+        self.assertEqual(self.mask[1, 1, 1], 0)
+        self.assertEqual(self.mask[2, 2, 2], 0)
+        self.assertEqual(self.mask.sum(), 4 * 5 * 6 - 30 - 2)
+
+    def test_time_axis_0(self):
+        bold = np.rollaxis(self.bold, 3).reshape(40, -1)
+        to_discard, _ = pio.scan_bad_data(bold, self.mask.ravel(),
+                                          time_axis=0)
+        self.assertEqual(to_discard.sum(), 2)
+
+
+class BoldInMaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='pyhrf_tests',
+                                        dir=pyhrf.cfg['global']['tmp_path'])
+        bold, meta = pio.read_volume(
+            get_data_file_name('subj0_bold_session0.nii.gz'))
+        self.mask_file = get_data_file_name('subj0_parcellation.nii.gz')
+        mask = pio.read_volume(self.mask_file)[0].astype(np.int32)
+        # one in-mask voxel with constant signal in both sessions:
+        self.flat_voxel = tuple(p[5] for p in np.where(mask != 0))
+        bold[self.flat_voxel] = 0.
+        # one in-mask voxel with a NaN sample, kept with NaN set to 0:
+        self.nan_voxel = tuple(p[7] for p in np.where(mask != 0))
+        bold = bold.astype(np.float32)
+        bold[self.nan_voxel + (3,)] = np.nan
+        self.bold_files = [op.join(self.tmp_dir, 'bold_s%d.nii' % i)
+                           for i in xrange(2)]
+        pio.write_volume(bold, self.bold_files[0], meta)
+        pio.write_volume(bold[..., ::-1], self.bold_files[1], meta)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_as_full_volume(self):
+        from pyhrf.core import load_vol_bold_and_mask
+        mask, _, _, bold_vol, ss = load_vol_bold_and_mask(self.bold_files,
+                                                          self.mask_file)
+        mask2, _, _, bold, ss2 = load_vol_bold_and_mask(self.bold_files,
+                                                        self.mask_file,
+                                                        in_mask_only=True)
+        self.assertEqual(mask[self.flat_voxel], 0)
+        self.assertNotEqual(mask[self.nan_voxel], 0)
+        self.assertEqual(bold_vol[self.nan_voxel + (3,)], 0.)
+        np.testing.assert_array_equal(mask2, mask)
+        np.testing.assert_array_equal(np.concatenate(ss2),
+                                      np.concatenate(ss))
+        m = np.where(mask != 0)
+        np.testing.assert_array_equal(bold, bold_vol[m].T)
+
+    def test_computed_mask(self):
+        from pyhrf.core import load_vol_bold_and_mask
+        mask_files = [op.join(self.tmp_dir, 'mask%d.nii' % i)
+                      for i in xrange(2)]
+        mask, _, from_file, bold_vol, _ = \
+            load_vol_bold_and_mask(self.bold_files, mask_files[0])
+        self.assertFalse(from_file)
+        # each BOLD file is read once, including the one the mask is
+        # computed from:
+        loaded = []
+        nibabel_load = pio.nibabel.load
+
+        def load(fn, *args, **kwargs):
+            loaded.append(fn)
+            return nibabel_load(fn, *args, **kwargs)
+        pio.nibabel.load = load
+        try:
+            mask2, _, _, bold, _ = load_vol_bold_and_mask(self.bold_files,
+                                                          mask_files[1],
+                                                          in_mask_only=True)
+        finally:
+            pio.nibabel.load = nibabel_load
+        self.assertEqual([fn for fn in loaded if fn in self.bold_files],
+                         self.bold_files)
+        np.testing.assert_array_equal(pio.read_volume(mask_files[1])[0],
+                                      pio.read_volume(mask_files[0])[0])
+        np.testing.assert_array_equal(mask2, mask)
+        np.testing.assert_array_equal(bold, bold_vol[np.where(mask != 0)].T)
+
+    def test_chunks_and_dtype(self):
+        mask = pio.read_volume(self.mask_file)[0].astype(np.int32)
+        mask_ref = mask.copy()
+        bold_ref, ss_ref, _ = pio.read_bold_in_mask(self.bold_files,
+                                                    mask_ref)
+        # chunks of one scan:
+        bold, ss, _ = pio.read_bold_in_mask(self.bold_files, mask,
+                                            dtype=np.float32,
+                                            chunk_memory=1)
+        self.assertEqual(bold.dtype, np.float32)
+        self.assertTrue(bold.flags.c_contiguous)
+        np.testing.assert_array_equal(mask, mask_ref)
+        np.testing.assert_array_equal(bold, bold_ref)
+        self.assertEqual(bold.shape, (250, (mask != 0).sum()))
+
+    def test_dtype_instance(self):
+        mask = pio.read_volume(self.mask_file)[0].astype(np.int32)
+        bold = pio.read_bold_in_mask(self.bold_files, mask,
+                                     dtype=np.dtype('float32'))[0]
+        self.assertEqual(bold.dtype, np.float32)
+        bold = pio.read_bold_in_mask(self.bold_files, mask,
+                                     dtype=np.dtype('float64'))[0]
+        self.assertEqual(bold.dtype, np.float64)
+
+
 class xndarrayIOTest(unittest.TestCase):
 
     def setUp(self):
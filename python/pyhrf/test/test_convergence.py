@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+
+from pyhrf.core import FmriData
+from pyhrf.jde.convergence import ConvergenceMonitor
+from pyhrf.jde.models import BOLDGibbsSampler
+from pyhrf.ui.jde import JDEMCMCAnalyser
+
+
+class ConvergenceMonitorTest(unittest.TestCase):
+
+    def _ar1(self, rho, n, dim=2):
+        x = np.zeros((n, dim))
+        x[0] = np.random.randn(dim)
+        for i in xrange(1, n):
+            x[i] = rho * x[i - 1] + np.sqrt(1 - rho ** 2) * np.random.randn(dim)
+        return x
+
+    def _monitor(self, chain, **kwargs):
+        monitor = ConvergenceMonitor(**kwargs)
+        for x in chain:
+            monitor.update({'x': x, 'c': np.ones(3)})
+        return monitor
+
+    def test_batches(self):
+        monitor = self._monitor(np.random.randn(1000, 2), batch_size=5,
+                                max_batches=16)
+        # batches were merged 4 times: 5 * 2**4 = 80 iterations per batch
+        self.assertEqual(monitor.batch_size, 80)
+        self.assertEqual(monitor.nb_batches, 12)
+        self.assertEqual(monitor.batch_sums['x'].shape, (16, 2))
+        chain = np.random.randn(1000, 2)
+        monitor = self._monitor(chain, batch_size=5, max_batches=16)
+        n = monitor.nb_batches * monitor.batch_size
+        npt.assert_allclose(monitor.batch_sums['x'][:monitor.nb_batches]
+                            .sum(0), (chain[:n] - chain[0]).sum(0))
+
+    def test_iid(self):
+        np.random.seed(1)
+        n = 4000
+        monitor = self._monitor(np.random.randn(n, 2))
+        ess, z, rhat = monitor.get_diagnostics()['x']
+        # only an even number of batches is used:
+        nb = (monitor.nb_batches - monitor.nb_batches % 2) * monitor.batch_size
+        self.assertTrue((ess > .5 * nb).all())
+        self.assertTrue((np.abs(z) < 3).all())
+        npt.assert_allclose(rhat, 1., atol=.02)
+        # constant summaries are converged:
+        ess, z, rhat = monitor.get_diagnostics()['c']
+        npt.assert_array_equal(ess, nb)
+        npt.assert_array_equal(z, 0)
+        npt.assert_array_equal(rhat, 1)
+
+    def test_correlated(self):
+        np.random.seed(1)
+        rho = .9
+        monitor = self._monitor(self._ar1(rho, 20000))
+        ess = monitor.get_diagnostics()['x'][0]
+        n = (monitor.nb_batches - monitor.nb_batches % 2) * monitor.batch_size
+        expected = n * (1 - rho) / (1 + rho)
+        npt.assert_allclose(ess, expected, rtol=.5)
+
+    def test_not_converged(self):
+        np.random.seed(1)
+        chain = np.random.randn(2000, 2) * .1 + \
+            np.linspace(0, 5, 2000)[:, np.newaxis]
+        monitor = self._monitor(chain, max_geweke=2., max_rhat=1.1)
+        ess, z, rhat = monitor.get_diagnostics()['x']
+        self.assertTrue((np.abs(z) > 2).all())
+        self.assertTrue((rhat > 1.1).all())
+        self.assertFalse(monitor.converged)
+
+    def test_converged(self):
+        np.random.seed(1)
+        monitor = self._monitor(np.random.randn(2000, 2), min_ess=100,
+                                max_geweke=3., max_rhat=1.1)
+        self.assertTrue(monitor.converged)
+        self.assertTrue(monitor.converged_at < 2000)
+
+    def test_early_stop(self):
+        sampler = BOLDGibbsSampler(nb_iterations=1000, stop_min_ess=5,
+                                   stop_max_rhat=10.)
+        roi_data = FmriData.from_vol_files().roi_split()[0]
+        np.random.seed(1)
+        sampler = JDEMCMCAnalyser(sampler=sampler).analyse_roi(roi_data)
+        self.assertTrue(sampler.final_iteration < 999)
+        outputs = sampler.getGlobalOutputs()
+        self.assertEqual(outputs['convergence_nb_iterations'].data[0],
+                         sampler.final_iteration + 1)
+        ess = outputs['convergence_ess']
+        self.assertEqual(ess.axes_names, ['variable'])
+        self.assertTrue((ess.data >= 5).all())
+        self.assertTrue((outputs['convergence_rhat'].data <= 10.).all())
@@ -14,6 +14,8 @@ from pyhrf import FmriData
 from pyhrf.ui.treatment import FMRITreatment
 from pyhrf.jde.models import simulate_bold
 from pyhrf.ui.vb_jde_analyser import JDEVEMAnalyser
+from pyhrf.vbjde.vem_bold import jde_vem_bold
+from pyhrf.vbjde.vem_bold_parcels import jde_vem_bold_parcels
 from pyhrf.vbjde.vem_bold_constrained import (Main_vbjde_Extension_constrained,
                                               Main_vbjde_Python_constrained)
 
@@ -53,6 +55,53 @@ class VEMBOLDTest(unittest.TestCase):
                                  output_dir=None)
         tjde_vem.run()
 
+    def _split_in_two_parcels(self):
+        mask = self.data_simu.roiMask.copy()
+        m = np.where(mask != 0)
+        nb_first = len(m[0]) // 3
+        mask[m[0][:nb_first], m[1][:nb_first], m[2][:nb_first]] = 2
+        return self.data_simu.roi_split(mask)
+
+    def test_vem_bold_parcels(self):
+        """ Test that the multi-parcel VEM gives the same results as the
+        parcel-wise VEM.
+        """
+        rois_data = self._split_in_two_parcels()
+        graphs = [d.get_graph() for d in rois_data]
+        bolds = [d.bold for d in rois_data]
+        onsets = self.data_simu.get_joined_onsets()
+        durations = self.data_simu.get_joined_durations()
+
+        results = jde_vem_bold_parcels(graphs, bolds, onsets, durations, 25., 2,
+                                       self.data_simu.tr, 1., .5, it_max=5)
+        self.assertEqual(len(results), 2)
+        for graph, bold, result in zip(graphs, bolds, results):
+            expected = jde_vem_bold(graph, bold, onsets, durations, 25., 2,
+                                    self.data_simu.tr, 1., .5, it_max=5)
+            self.assertEqual(result[0], expected[0])
+            for i in [1, 2, 3, 4, 5, 8, 9, 15, 26]:
+                np.testing.assert_allclose(result[i], expected[i],
+                                           rtol=1e-4, atol=1e-6)
+
+    def test_jdevemanalyser_batch(self):
+        """ Test the VEM analyser running parcels by batches """
+        rois_data = self._split_in_two_parcels()
+        data = FmriData(self.data_simu.paradigm.stimOnsets, self.data_simu.bold,
+                        self.data_simu.tr, self.data_simu.sessionsScans,
+                        rois_data[0].roiMask + rois_data[1].roiMask,
+                        stimDurations=self.data_simu.paradigm.stimDurations,
+                        data_type=self.data_simu.data_type)
+        jde_vem_analyser = JDEVEMAnalyser(beta=.8, dt=.5, hrfDuration=25.,
+                                          nItMax=3, nItMin=1, fast=True,
+                                          computeContrast=False, PLOT=False,
+                                          batch_parcels=2)
+        results = jde_vem_analyser.analyse(data)
+        self.assertEqual(len(results), 2)
+        for roi_data, outputs, report in results:
+            self.assertEqual(report, 'ok')
+            self.assertEqual(outputs['nrls'].data.shape[1],
+                             roi_data.get_nb_vox_in_mask())
+
     @unittest.skipIf(not tools.is_importable('cvxpy'),
                      'cvxpy (optional dep) is N/A')
     def test_vem_bold_constrained(self):
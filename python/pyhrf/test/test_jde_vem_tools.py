@@ -14,6 +14,9 @@ import pyhrf.vbjde.vem_tools as vt
 from pyhrf import FmriData
 from pyhrf.jde.models import simulate_bold
 from pyhrf.boldsynth.hrf import getCanoHRF
+from pyhrf.vbjde.design import DesignCache
+from pyhrf.vbjde.noise import (IdentityNoiseStruct, DiagonalNoiseStruct, AR1NoiseStruct, DenseNoiseStruct,
+                               as_noise_struct)
 try:
     from collections import OrderedDict
 except ImportError:
@@ -267,6 +270,94 @@ class VEMToolsTest(unittest.TestCase):
         m_H, Sigma_H = vt.hrf_expectation(Sigma_A, m_A, occurence_matrix, Gamma, R,
                                           sigmaH, J, y_tilde, sigma_epsilone)
 
+    def test_expectH_voxel_sum(self):
+        """ Check the E-H step against the explicit sum over voxels """
+        M, N, D, J = 2, 50, 7, 20
+        random_state = np.random.RandomState(42)
+        occurence_matrix = (random_state.rand(M, N, D) < .1).astype(float)
+        nrls_mean = random_state.randn(J, M)
+        nrls_covar = random_state.rand(M, M, J)
+        noise_var = random_state.rand(J) + .5
+        y_tilde = random_state.randn(N, J)
+        hrf_regu_prior_inv = np.identity(D)
+        for noise_struct in [np.identity(N), np.diag(random_state.rand(N) + .5)]:
+            hrf_covar_inv = hrf_regu_prior_inv / .1
+            y_bar_tilde = np.zeros(D)
+            for i in xrange(J):
+                s_tilde = np.tensordot(nrls_mean[i], occurence_matrix, axes=(0, 0))
+                hrf_covar_inv += s_tilde.T.dot(noise_struct).dot(s_tilde) / noise_var[i]
+                for m in xrange(M):
+                    for n in xrange(M):
+                        hrf_covar_inv += (nrls_covar[m, n, i] * occurence_matrix[m].T.dot(noise_struct)
+                                          .dot(occurence_matrix[n]) / noise_var[i])
+                y_bar_tilde += s_tilde.T.dot(noise_struct).dot(y_tilde[:, i]) / noise_var[i]
+            hrf_covar = np.linalg.inv(hrf_covar_inv)
+            hrf_mean, hrf_covar_vem = vt.hrf_expectation(nrls_covar, nrls_mean, occurence_matrix, noise_struct,
+                                                         hrf_regu_prior_inv, .1, J, y_tilde, noise_var)
+            np.testing.assert_allclose(hrf_covar_vem, hrf_covar)
+            np.testing.assert_allclose(hrf_mean, hrf_covar.dot(y_bar_tilde))
+
+    def test_noise_struct(self):
+        """ Check the noise structures against their dense matrices """
+        N = 40
+        random_state = np.random.RandomState(42)
+        x = random_state.randn(N, 3)
+        ar1_corr = 0.3 ** np.abs(np.arange(N)[:, np.newaxis] - np.arange(N))
+        for noise_struct, dense in [(IdentityNoiseStruct(N), np.identity(N)),
+                                    (DiagonalNoiseStruct(np.arange(1., N + 1)), np.diag(np.arange(1., N + 1))),
+                                    (AR1NoiseStruct(N, 0.3), np.linalg.inv(ar1_corr))]:
+            np.testing.assert_allclose(noise_struct.to_array(), dense, atol=1e-12)
+            np.testing.assert_allclose(noise_struct.apply(x), dense.dot(x), atol=1e-12)
+            np.testing.assert_allclose(noise_struct.quad_form(x), x.T.dot(dense).dot(x), atol=1e-12)
+            np.testing.assert_allclose(noise_struct.log_det(), np.log(np.linalg.det(dense)))
+        self.assertIsInstance(as_noise_struct(np.identity(N)), IdentityNoiseStruct)
+        self.assertIsInstance(as_noise_struct(np.diag(np.arange(1., N + 1))), DiagonalNoiseStruct)
+        self.assertIsInstance(as_noise_struct(ar1_corr), DenseNoiseStruct)
+
+    def test_max_sigma_noise_ar1(self):
+        """ Check the M-sigma_epsilon step with an AR(1) noise structure """
+        M, N, D, J = 2, 50, 7, 20
+        random_state = np.random.RandomState(42)
+        occurence_matrix = (random_state.rand(M, N, D) < .1).astype(float)
+        hrf_mean = random_state.randn(D)
+        hrf_covar = np.identity(D) * .1
+        nrls_mean = random_state.randn(J, M)
+        nrls_covar = random_state.rand(M, M, J) * .1
+        data_drift = random_state.randn(N, J)
+        noise_struct = AR1NoiseStruct(N, .5)
+        dense = noise_struct.to_array()
+        noise_var = vt.maximization_noise_var(occurence_matrix, hrf_mean, hrf_covar, nrls_mean, nrls_covar,
+                                              noise_struct, data_drift, N)
+        g = occurence_matrix.dot(hrf_mean).T
+        g_cov = np.array([[np.trace(dense.dot(occurence_matrix[m]).dot(hrf_covar).dot(occurence_matrix[n].T))
+                           for n in xrange(M)] for m in xrange(M)])
+        lambda_tilde = g.T.dot(dense).dot(g) + g_cov
+        for j in xrange(J):
+            expected = (nrls_mean[j].dot(lambda_tilde).dot(nrls_mean[j])
+                        + np.trace(nrls_covar[:, :, j].dot(lambda_tilde))
+                        - 2 * nrls_mean[j].dot(g.T).dot(dense).dot(data_drift[:, j])
+                        + data_drift[:, j].dot(dense).dot(data_drift[:, j])) / N
+            np.testing.assert_allclose(noise_var[j], expected)
+
+    def test_design_cache(self):
+        """ Check the drift M-step using the design cache and its invalidation """
+        data = self.data_simu
+        nb_scans, nb_voxels = data.bold.shape
+        design_cache = DesignCache.from_paradigm(data.get_joined_onsets(), data.paradigm.stimDurations, nb_scans,
+                                                 25., data.tr, .5, zero_constraint=True)
+        occurence_matrix = design_cache.occurence_matrix
+        hrf_mean = np.random.randn(occurence_matrix.shape[2])
+        nrls_mean = np.random.randn(nb_voxels, occurence_matrix.shape[0])
+        for noise_struct in [np.identity(nb_scans), AR1NoiseStruct(nb_scans, .3)]:
+            design_cache.set_noise_struct(noise_struct)
+            drift_coeffs = vt.maximization_drift_coeffs(data.bold, nrls_mean, occurence_matrix, hrf_mean,
+                                                        noise_struct, design_cache.drift_basis)
+            drift_coeffs_cache = vt.maximization_drift_coeffs(data.bold, nrls_mean, occurence_matrix, hrf_mean,
+                                                              noise_struct, design_cache.drift_basis,
+                                                              design_cache=design_cache)
+            np.testing.assert_allclose(drift_coeffs_cache, drift_coeffs, atol=1e-8)
+            np.testing.assert_allclose(design_cache.gram, vt.design_gram_blocks(occurence_matrix, noise_struct))
+
     def test_expectA(self):
         M = 51
         K = 2
@@ -352,6 +443,17 @@ class VEMToolsTest(unittest.TestCase):
         graph = self.data_simu.get_graph()
         neighbours_indexes = vt.create_neighbours(graph)
 
+    def test_sum_over_neighbours(self):
+        graph = self.data_simu.get_graph()
+        neighbours_indexes = vt.create_neighbours(graph)
+        labels_proba = np.random.rand(2, 2, len(graph))
+        max_neighbours = max(len(nl) for nl in graph)
+        padded = -np.ones((len(graph), max_neighbours), dtype=int)
+        for i, nl in enumerate(graph):
+            padded[i, :len(nl)] = nl
+        np.testing.assert_allclose(vt.sum_over_neighbours(neighbours_indexes, labels_proba),
+                                   vt.sum_over_neighbours(padded, labels_proba))
+
     def test_create_conditions(self):
         nb_conditions = self.data_simu.nbConditions
         nb_scans = 325
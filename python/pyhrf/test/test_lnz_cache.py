@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import shutil
+import os
+import time
+
+import numpy as np
+import numpy.testing as npt
+
+import pyhrf
+
+from pyhrf.graph import graph_from_lattice, kerMask3D_6n
+from pyhrf.jde.beta import (Cpt_Vec_Estim_lnZ_Graph_cached,
+                            Cpt_Vec_Estim_lnZ_Graph_ref,
+                            Cpt_Vec_Estim_lnZ_Graph_fast3)
+from pyhrf.jde.lnz_cache import LnZCache, graph_lnz_key, get_lnz_cache
+
+
+class LnZCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = pyhrf.get_tmp_path()
+        mask = np.zeros((6, 6, 3), dtype=int)
+        mask[1:4, 1:5, 1] = 1
+        self.graph = graph_from_lattice(mask, kerMask3D_6n)
+        self.cache = LnZCache(self.tmp_dir, max_entries=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_key(self):
+        mask = np.zeros((6, 6, 3), dtype=int)
+        mask[2:5, 1:5, 0] = 1  # same shape, translated
+        graph = graph_from_lattice(mask, kerMask3D_6n)
+        key = graph_lnz_key(self.graph, 2, 'ps')
+        self.assertEqual(graph_lnz_key(graph, 2, 'ps'), key)
+        self.assertNotEqual(graph_lnz_key(self.graph, 3, 'ps'), key)
+        self.assertNotEqual(graph_lnz_key(self.graph, 2, 'es'), key)
+        self.assertNotEqual(graph_lnz_key(self.graph[:-1], 2, 'ps'), key)
+
+    def test_lru_eviction(self):
+        grid = (np.arange(3.), np.arange(3.) / 10)
+        self.cache.put('a', grid)
+        self.cache.put('b', grid)
+        # make 'a' the most recently used:
+        os.utime(self.cache._filename('b'), (time.time() - 10,) * 2)
+        npt.assert_array_equal(self.cache.get('a')[0], grid[0])
+        self.cache.put('c', grid)
+        self.assertEqual(len(self.cache), 2)
+        self.assertTrue('a' in self.cache)
+        self.assertFalse('b' in self.cache)
+        self.assertTrue(self.cache.get('b') is None)
+
+    def test_cached_path_sampling(self):
+        lnz, beta = Cpt_Vec_Estim_lnZ_Graph_cached(self.graph, 2, 'ps',
+                                                   cache=self.cache)
+        self.assertEqual(len(self.cache), 1)
+        np.random.seed(0)  # cached grid does not depend on sampling anymore
+        lnz2, beta2 = Cpt_Vec_Estim_lnZ_Graph_cached(self.graph, 2, 'ps',
+                                                     cache=self.cache)
+        npt.assert_array_equal(lnz2, lnz)
+        npt.assert_array_equal(beta2, beta)
+
+    def test_reference_fallback(self):
+        # small regular graph -> matches a reference partition function
+        self.assertTrue(Cpt_Vec_Estim_lnZ_Graph_ref(self.graph, 2) is not None)
+        lnz, beta = Cpt_Vec_Estim_lnZ_Graph_cached(self.graph, 2, 'es',
+                                                   cache=self.cache)
+        lnz_es, beta_es = Cpt_Vec_Estim_lnZ_Graph_fast3(self.graph, 2)
+        npt.assert_array_equal(lnz, lnz_es)
+        npt.assert_array_equal(beta, beta_es)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_random_state(self):
+        # a cache miss and a cache hit leave the global random stream in the
+        # same state:
+        np.random.seed(2)
+        Cpt_Vec_Estim_lnZ_Graph_cached(self.graph, 2, 'ps', cache=self.cache)
+        after_miss = np.random.rand()
+        np.random.seed(2)
+        Cpt_Vec_Estim_lnZ_Graph_cached(self.graph, 2, 'ps', cache=self.cache)
+        self.assertEqual(np.random.rand(), after_miss)
+
+    def test_configured_cache(self):
+        cfg = pyhrf.cfg['lnz-cache']
+        prev_dir = cfg['cache_dir']
+        cfg['cache_dir'] = self.tmp_dir
+        try:
+            Cpt_Vec_Estim_lnZ_Graph_cached(self.graph, 2, 'ps')
+            self.assertEqual(len(get_lnz_cache()), 1)
+        finally:
+            cfg['cache_dir'] = prev_dir
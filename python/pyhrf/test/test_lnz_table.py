@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import shutil
+
+import numpy as np
+import numpy.testing as npt
+
+import pyhrf
+
+from pyhrf.graph import graph_from_lattice, kerMask3D_6n, CSRGraph
+from pyhrf.jde.beta import (LoadBaseLogPartFctRef, Cpt_Vec_Estim_lnZ_Graph,
+                            Cpt_Vec_Estim_lnZ_Graph_ref,
+                            Cpt_Vec_Estim_lnZ_Graph_cached)
+from pyhrf.jde.lnz_cache import LnZCache
+from pyhrf.jde.lnz_table import (load_lnz_table, interpolate_lnz,
+                                 interpolate_lnz_from_descriptors,
+                                 LNZ_TABLE_DTYPE, LNZ_TABLE_BETAS)
+
+
+class LnZTableTest(unittest.TestCase):
+
+    def setUp(self):
+        mask = np.zeros((7, 7, 4), dtype=int)
+        mask[1:6, 1:5, 1:3] = 1
+        self.graph = graph_from_lattice(mask, kerMask3D_6n)
+
+    def test_load(self):
+        table = load_lnz_table()
+        self.assertTrue(isinstance(table, np.memmap))
+        self.assertEqual(table.dtype, LNZ_TABLE_DTYPE)
+        self.assertTrue(load_lnz_table() is table)
+
+        refs, betas = LoadBaseLogPartFctRef()
+        self.assertEqual(len(refs), len(table))
+        npt.assert_array_equal(refs[5]['LogPF'], table[5]['log_pf'])
+        self.assertEqual(refs[5]['NbSites'], table[5]['nb_sites'])
+        self.assertEqual(refs[5]['NbLabels'], table[5]['nb_labels'])
+        npt.assert_array_equal(betas, LNZ_TABLE_BETAS)
+
+    def test_interpolate(self):
+        lnz, betas = interpolate_lnz(self.graph, 2)
+        npt.assert_array_equal(betas, LNZ_TABLE_BETAS)
+        self.assertAlmostEqual(lnz[0], len(self.graph) * np.log(2))
+        self.assertTrue((np.diff(lnz) >= 0).all())
+
+        nb_cliques = CSRGraph.from_lists(self.graph).nb_cliques()
+        lnz_ref = Cpt_Vec_Estim_lnZ_Graph_ref(self.graph, 2)[0]
+        self.assertTrue(np.abs(lnz - lnz_ref).max() / nb_cliques < .02)
+        np.random.seed(1)
+        lnz_ps = Cpt_Vec_Estim_lnZ_Graph(self.graph, 2)[0][:len(betas)]
+        self.assertTrue(np.abs(lnz - lnz_ps).max() / nb_cliques < .02)
+
+    def test_interpolate_leave_one_out(self):
+        table = load_lnz_table()
+        ref = table[table['nb_labels'] == 3][20]
+        others = table[(table['nb_labels'] != 3) |
+                       (table['nb_sites'] != ref['nb_sites']) |
+                       (table['nb_cliques'] != ref['nb_cliques'])]
+        lnz = interpolate_lnz_from_descriptors(3, ref['nb_sites'],
+                                               ref['nb_cliques'],
+                                               ref['std_ngbh'], table=others)[0]
+        self.assertTrue(np.abs(lnz - ref['log_pf']).max() /
+                        ref['nb_cliques'] < .02)
+
+    def test_out_of_range(self):
+        # a chain is sparser than all reference graphs:
+        chain = [[1]] + [[i - 1, i + 1] for i in xrange(1, 99)] + [[98]]
+        self.assertTrue(interpolate_lnz(chain, 2) is None)
+        self.assertTrue(interpolate_lnz(self.graph, 5) is None)
+
+    def test_cached_interp(self):
+        tmp_dir = pyhrf.get_tmp_path()
+        try:
+            cache = LnZCache(tmp_dir)
+            lnz, beta = Cpt_Vec_Estim_lnZ_Graph_cached(self.graph, 2, 'interp',
+                                                       cache=cache)
+            npt.assert_array_equal(lnz, interpolate_lnz(self.graph, 2)[0])
+            self.assertEqual(len(cache), 0)
+        finally:
+            shutil.rmtree(tmp_dir)
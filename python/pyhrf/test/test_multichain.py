@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+
+from pyhrf.core import FmriData
+from pyhrf.jde.convergence import gelman_rubin
+from pyhrf.jde.models import BOLDGibbsSampler
+from pyhrf.jde.multichain import MultiChainSampler
+from pyhrf.jde.samplerbase import GibbsSamplerVariable
+from pyhrf.jde import asl as jde_asl
+from pyhrf.ui.jde import JDEMCMCAnalyser
+
+
+class MultiChainTest(unittest.TestCase):
+
+    def setUp(self):
+        self.roi_data = FmriData.from_vol_files().roi_split()[0]
+
+    def _variable(self, samples):
+        v = GibbsSamplerVariable('x', valIni=samples[0])
+        v.nbItObservables = len(samples)
+        v.cumul = samples.sum(0)
+        v.mean = samples.mean(0)
+        v.cumul3 = ((samples - v.mean) ** 2).sum(0)
+        v.error = v.cumul3 / len(samples)
+        return v
+
+    def test_pool_observables(self):
+        samples = [np.random.randn(30, 3), np.random.randn(50, 3) + 1.]
+        v = self._variable(samples[0])
+        v.pool_observables([self._variable(samples[1])])
+        all_samples = np.vstack(samples)
+        self.assertEqual(v.nbItObservables, 80)
+        npt.assert_allclose(v.mean, all_samples.mean(0))
+        npt.assert_allclose(v.error, all_samples.var(0))
+
+    def _response_levels(self, samples, labels):
+        # samples, labels: (nb_its, nb_conditions, nb_voxels)
+        v = jde_asl.BOLDResponseLevelSampler()
+        v.nbItObservables = len(samples)
+        v.cumul = samples.sum(0)
+        v.cumul3 = ((samples - samples.mean(0)) ** 2).sum(0)
+        classes = np.array([labels == c for c in (0, 1)])
+        v.final_labeled_vars_it_count = classes.sum(1)
+        v.final_labeled_vars_cumul = (classes * samples).sum(1)
+        means = v.final_labeled_vars_cumul / \
+            np.maximum(v.final_labeled_vars_it_count, 1)
+        v.final_labeled_vars_cumul2 = \
+            (classes * (samples - means[:, np.newaxis]) ** 2).sum(1)
+        return v
+
+    def test_pool_asl_labeled_vars(self):
+        np.random.seed(1)
+        samples = [np.random.randn(40, 2, 5), np.random.randn(60, 2, 5) + 2.]
+        labels = [np.random.rand(*s.shape) > .5 for s in samples]
+        v = self._response_levels(samples[0], labels[0])
+        v.pool_observables([self._response_levels(samples[1], labels[1])])
+        ref = self._response_levels(np.concatenate(samples),
+                                    np.concatenate(labels))
+        npt.assert_array_equal(v.final_labeled_vars_it_count,
+                               ref.final_labeled_vars_it_count)
+        npt.assert_allclose(v.final_labeled_vars_cumul,
+                            ref.final_labeled_vars_cumul)
+        npt.assert_allclose(v.final_labeled_vars_cumul2,
+                            ref.final_labeled_vars_cumul2)
+
+    def test_asl_chains(self):
+        np.random.seed(8652761)
+        simu = jde_asl.simulate_asl(spatial_size='random_small')
+        roi_data = FmriData.from_simulation_dict(simu).roi_split()[0]
+        sampler = jde_asl.ASLSampler(nb_iterations=10)
+        analyser = JDEMCMCAnalyser(sampler=sampler, dt=.5, nb_chains=2)
+        result = analyser.analyse_roi(roi_data)
+        self.assertEqual(result.chains_nb_iterations, [10, 10])
+        roi_result = analyser.make_roi_result(result)
+        self.assertTrue('convergence_chains_rhat' in roi_result)
+        self.assertTrue('brl_mcmc_MAPlab_var' in roi_result)
+
+    def test_gelman_rubin(self):
+        np.random.seed(1)
+        chains = np.random.randn(4, 1000, 2)
+        rhat = gelman_rubin(chains.mean(1), chains.var(1, ddof=1), 1000)
+        npt.assert_allclose(rhat, 1., atol=.01)
+        chains[0] += 1.
+        rhat = gelman_rubin(chains.mean(1), chains.var(1, ddof=1), 1000)
+        self.assertTrue((rhat > 1.1).all())
+
+    def _run(self, n_jobs):
+        sampler = MultiChainSampler(BOLDGibbsSampler(nb_iterations=20),
+                                    nb_chains=2, n_jobs=n_jobs,
+                                    random_seed=3)
+        analyser = JDEMCMCAnalyser(copy_sampler=False)
+        sampler.linkToData(analyser.packSamplerInput(self.roi_data))
+        sampler.runSampling(self.roi_data)
+        return sampler
+
+    def test_chains_random_streams(self):
+        sampler = MultiChainSampler(BOLDGibbsSampler(), nb_chains=3,
+                                    random_seed=3)
+        chains, random_states = sampler.make_chains()
+        self.assertEqual(len(chains), 3)
+        draws = [rs.rand() for rs in random_states]
+        self.assertEqual(len(set(draws)), 3)
+        _, random_states = sampler.make_chains()
+        self.assertEqual([rs.rand() for rs in random_states], draws)
+
+    def test_run_chains(self):
+        state = np.random.get_state()
+        sampler = self._run(n_jobs=1)
+        # the global random generator is left untouched:
+        npt.assert_array_equal(np.random.get_state()[1], state[1])
+        self.assertEqual(sampler.chains_nb_iterations, [20, 20])
+        outputs = sampler.getOutputs()
+        rhat = outputs['convergence_chains_rhat']
+        self.assertEqual(rhat.axes_names, ['variable'])
+        self.assertTrue('nrl' in rhat.axes_domains['variable'])
+        self.assertTrue((rhat.data >= 0).all())
+
+    def test_parallel_same_as_serial(self):
+        serial = self._run(n_jobs=1)
+        parallel = self._run(n_jobs=2)
+        for vn in ['nrl', 'hrf']:
+            npt.assert_allclose(parallel.get_variable(vn).finalValue,
+                                serial.get_variable(vn).finalValue)
+
+    def test_analyser(self):
+        sampler = BOLDGibbsSampler(nb_iterations=20)
+        analyser = JDEMCMCAnalyser(sampler=sampler, nb_chains=2)
+        result = analyser.analyse_roi(self.roi_data)
+        self.assertTrue(isinstance(result, MultiChainSampler))
+        roi_result = analyser.make_roi_result(result)
+        self.assertTrue('convergence_chains_rhat' in roi_result)
+        self.assertTrue('nrl_pm' in roi_result)
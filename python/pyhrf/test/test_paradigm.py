@@ -99,3 +99,25 @@ class ParadigmTest(unittest.TestCase):
         self.assertIsInstance(o['audio'][0], np.ndarray)
         self.assertEqual(o['audio'][0].ndim, 1)
         self.assertEqual(o['audio'][0].size, 30)
+
+    def test_paradigm_operator(self):
+
+        from pyhrf.vbjde.vem_tools import create_conditions
+
+        onsets = dict((c, o[0]) for c, o in pdgm.onsets_loc_av.iteritems())
+        durations = dict((c, np.zeros_like(o)) for c, o in onsets.iteritems())
+        nb_scans, hrf_len, tr, dt = 150, 21, 2., .5
+        _, occurence_matrix, _ = create_conditions(onsets, durations, len(onsets), nb_scans, hrf_len, tr, dt)
+        operator = pdgm.ParadigmOperator.from_onsets(onsets, durations, nb_scans, hrf_len, tr, dt)
+
+        self.assertEqual(operator.shape, occurence_matrix.shape)
+        np.testing.assert_array_equal(operator.toarray(), occurence_matrix)
+        hrf = np.random.randn(hrf_len)
+        y = np.random.randn(nb_scans, 3)
+        np.testing.assert_allclose(operator.dot(hrf), occurence_matrix.dot(hrf))
+        np.testing.assert_allclose(operator.rdot(y), np.tensordot(occurence_matrix, y, axes=(1, 0)))
+        np.testing.assert_allclose(operator.gram(), np.einsum('mnd,lne->mlde', occurence_matrix, occurence_matrix))
+        np.testing.assert_array_equal(operator.select_columns(slice(1, -1)).toarray(),
+                                      occurence_matrix[:, :, 1:-1])
+        np.testing.assert_array_equal(pdgm.ParadigmOperator.concatenate([operator, operator]).toarray(),
+                                      np.concatenate((occurence_matrix, occurence_matrix), axis=1))
@@ -2,9 +2,15 @@
 
 import unittest
 
+import numpy as np
+import numpy.testing as npt
+
 import pyhrf
 
-from pyhrf.parallel import remote_map, RemoteException
+from pyhrf.core import FmriData
+from pyhrf.ui.analyser_ui import FMRIAnalyser
+from pyhrf.parallel import (remote_map, RemoteException, imap_rois_local,
+                            schedule_longest_first, share_rois_bold)
 from pyhrf.configuration import cfg
 from pyhrf import tools
 
@@ -17,6 +23,16 @@ def foo_raise(a, b):
     raise Exception('raised by a foo')
 
 
+class BoldMeanAnalyser(FMRIAnalyser):
+
+    parametersToShow = []
+
+    def analyse_roi(self, roiData):
+        if roiData.get_nb_vox_in_mask() < 50:
+            raise Exception('ROI too small')
+        return roiData.bold.mean(0)
+
+
 class ParallelTest(unittest.TestCase):
 
     def _test_remote_map_basic(self, mode):
@@ -46,6 +62,35 @@ class ParallelTest(unittest.TestCase):
             print 'result:'
             print r
 
+    def test_schedule_longest_first(self):
+        self.assertEqual(schedule_longest_first([3., 10., 1., 10.]),
+                         [1, 3, 0, 2])
+
+    def test_share_rois_bold(self):
+        rois_data = FmriData.from_vol_files().roi_split()
+        bolds = [d.bold.copy() for d in rois_data]
+        bold_buffer = share_rois_bold(rois_data)
+        for iroi, (roi_data, bold) in enumerate(zip(rois_data, bolds)):
+            self.assertIs(roi_data.bold_buffer, bold_buffer)
+            self.assertTrue(np.may_share_memory(roi_data.bold,
+                                                bold_buffer.data))
+            npt.assert_array_equal(roi_data.bold, bold)
+        # already shared -> no copy:
+        self.assertIs(share_rois_bold(rois_data), bold_buffer)
+
+    def test_imap_rois_local(self):
+        analyser = BoldMeanAnalyser()
+        rois_data = FmriData.from_vol_files().roi_split()
+        expected = [analyser.analyse_roi_wrap(d) for d in rois_data]
+        results = dict(imap_rois_local(analyser, rois_data, n_jobs=2))
+        self.assertEqual(sorted(results.keys()), range(len(rois_data)))
+        for iroi, (roi_data, result, report) in results.iteritems():
+            self.assertIs(roi_data, rois_data[iroi])
+            self.assertEqual(report == 'ok', expected[iroi][2] == 'ok')
+            if report == 'ok':
+                npt.assert_allclose(result, expected[iroi][1], rtol=1e-6)
+            npt.assert_array_equal(roi_data.bold, expected[iroi][0].bold)
+
     if cfg['parallel-cluster']['enable_unit_test'] == 1:
 
         def test_remote_map_cluster_many_jobs(self):
@@ -2,11 +2,15 @@
 
 import unittest
 import shutil
+import multiprocessing
+
+import numpy as np
+import numpy.testing as npt
 
 import pyhrf
 import pyhrf.boldsynth.scenarios as simu
 
-from pyhrf.rfir import rfir
+from pyhrf.rfir import rfir, RFIREstim, onset_matrix
 
 
 class RFIRTest(unittest.TestCase):
@@ -31,3 +35,137 @@ class RFIRTest(unittest.TestCase):
             assert outputs.has_key(k)
 
         # TODO: test shape consistency
+
+    def _run_estim(self, fdata, voxelwise=False, batch_memory=None, **params):
+        estim = RFIREstim(**params)
+        estim.linkToData(fdata)
+        if batch_memory is not None:
+            estim.batch_memory = batch_memory
+        if voxelwise:
+            estim.InitStorageMat()
+            estim.Compute_onset_matrix3()
+            estim.stop_iterations = np.zeros(fdata.bold.shape[1], dtype=int)
+            estim.run_voxelwise()
+        else:
+            estim.run()
+        return estim
+
+    def _check_batch_solver(self, **params):
+        fdata = simu.create_small_bold_simulation()
+        expected = self._run_estim(fdata, voxelwise=True, **params)
+        estim = self._run_estim(fdata, **params)
+        # one voxel per batch:
+        estim_1vox = self._run_estim(fdata, batch_memory=1, **params)
+
+        for e in (estim, estim_1vox):
+            npt.assert_array_equal(e.stop_iterations, expected.stop_iterations)
+            npt.assert_allclose(e.ResponseFunctionsEvaluated,
+                                expected.ResponseFunctionsEvaluated,
+                                atol=1e-4)
+            npt.assert_allclose(e.StdValEvaluated, expected.StdValEvaluated,
+                                atol=1e-5)
+            npt.assert_allclose(e.Pvalues, expected.Pvalues, atol=1e-3)
+            npt.assert_allclose(e.SignalEvaluated, expected.SignalEvaluated,
+                                atol=1e-4)
+
+    def test_batch_solver(self):
+        self._check_batch_solver(nb_iterations=None, nb_its_max=10)
+
+    def test_batch_solver_fixed_taum(self):
+        self._check_batch_solver(nb_iterations=None, nb_its_max=50,
+                                 fixed_taum=True)
+
+    def test_parallel_blocks(self):
+        fdata = simu.create_small_bold_simulation()
+        params = dict(nb_iterations=None, nb_its_max=10)
+        expected = self._run_estim(fdata, **params)
+        # several blocks per process:
+        estim = self._run_estim(fdata, batch_memory=1, n_jobs=2, **params)
+
+        npt.assert_array_equal(estim.stop_iterations,
+                               expected.stop_iterations)
+        for name in ('ResponseFunctionsEvaluated', 'StdValEvaluated',
+                     'Pvalues', 'SignalEvaluated'):
+            npt.assert_allclose(getattr(estim, name),
+                                getattr(expected, name), atol=1e-5,
+                                err_msg=name)
+        outputs = estim.getOutputs()
+        self.assertTrue('ehrf' in outputs)
+
+    def test_parallel_blocks_in_worker(self):
+        # blocks are solved serially in a daemonic worker process, which
+        # cannot start its own pool:
+        fdata = simu.create_small_bold_simulation()
+        params = dict(nb_iterations=None, nb_its_max=10)
+        expected = self._run_estim(fdata, **params)
+        pool = multiprocessing.Pool(1)
+        try:
+            stop_its, rfs = pool.apply(_run_estim_in_worker,
+                                       (fdata, dict(params, n_jobs=2)))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        npt.assert_array_equal(stop_its, expected.stop_iterations)
+        npt.assert_allclose(rfs, expected.ResponseFunctionsEvaluated,
+                            atol=1e-5)
+
+
+def _run_estim_in_worker(fdata, params):
+    estim = RFIREstim(**params)
+    estim.linkToData(fdata)
+    estim.batch_memory = 1
+    estim.run()
+    return estim.stop_iterations, estim.ResponseFunctionsEvaluated
+
+
+def _onset_matrix_loops(onsets, durations, nb_scans, tr, dt, K, block_design):
+    # reference implementation of rfir.onset_matrix
+    X = np.zeros((len(onsets), nb_scans, K - 1), dtype=np.float32)
+    for m in xrange(len(onsets)):
+        for j, o in enumerate(onsets[m]):
+            for n in xrange(nb_scans):
+                for k in xrange(K - 1):
+                    if block_design:
+                        if o <= (n * tr - (k + 1.0) * dt + 0.001) and \
+                           o > ((n - 1.) * tr - (k + 1.) * dt -
+                                durations[m][j]):
+                            X[m, n, k] = dt / tr
+                    elif o <= (n * tr - k * dt + 0.001) and \
+                            o > (n * tr - (k + 1.) * dt):
+                        X[m, n, k] = 1.
+    return X
+
+
+class OnsetMatrixTest(unittest.TestCase):
+
+    def _check_onset_matrix(self, block_design, tr, dt):
+        rng = np.random.RandomState(5)
+        nb_scans, K = 60, 16
+        onsets = [np.sort(rng.uniform(0, nb_scans * tr, 12)),
+                  np.round(np.sort(rng.uniform(0, nb_scans * tr, 8))),
+                  np.array([])]
+        durations = [rng.uniform(1, 10, 12), np.zeros(8) + 3., np.array([])]
+
+        X = onset_matrix(onsets, durations, nb_scans, tr, dt, K,
+                         block_design, cache=False)
+        expected = _onset_matrix_loops(onsets, durations, nb_scans, tr, dt,
+                                       K, block_design)
+        npt.assert_array_equal(X, expected)
+
+    def test_event_design(self):
+        self._check_onset_matrix(False, 2., .5)
+        self._check_onset_matrix(False, 2.4, .6)
+
+    def test_block_design(self):
+        self._check_onset_matrix(True, 2., .5)
+        self._check_onset_matrix(True, 2.4, .6)
+
+    def test_cache(self):
+        onsets, durations = [np.array([0., 10., 20.])], [np.zeros(3)]
+        X = onset_matrix(onsets, durations, 30, 2., .5, 10, False)
+        self.assertTrue(onset_matrix(onsets, durations, 30, 2., .5, 10,
+                                     False) is X)
+        self.assertFalse(X.flags.writeable)
+        X2 = onset_matrix(onsets, durations, 30, 2., 1., 10, False)
+        self.assertFalse(X2 is X)
@@ -1,12 +1,29 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import os
+import cPickle
+import shutil
+import os.path as op
 
 import numpy as np
 
-from numpy.testing import assert_array_equal, assert_almost_equal
+from numpy.testing import (assert_array_equal, assert_almost_equal,
+                           assert_allclose)
 
-from pyhrf.jde.samplerbase import Trajectory
+import pyhrf
+
+from pyhrf import xmlio
+from pyhrf.core import FmriData
+from pyhrf.jde.models import BOLDGibbsSampler, simulate_bold
+from pyhrf.jde.nrl.bigaussian import (NRLSampler, BiGaussMixtureParamsSampler,
+                                      MixtureWeightsSampler)
+from pyhrf.jde.hrf import HRFSampler, RHSampler, ScaleSampler
+from pyhrf.jde.noise import NoiseVarianceSampler
+from pyhrf.jde.beta import BetaSampler
+from pyhrf.jde.samplerbase import (Trajectory, SampleHistory,
+                                   GSDefaultCallbackHandler)
+from pyhrf.ui.jde import JDEMCMCAnalyser
 
 
 class TrajectoryTest(unittest.TestCase):
@@ -44,7 +61,283 @@ class TrajectoryTest(unittest.TestCase):
         self.assertEqual(t.saved_iterations, range(start, nb_its))
 
 
+class SampleHistoryTest(unittest.TestCase):
+
+    def _fill(self, history, nb_samples):
+        values = np.arange(nb_samples * 6.).reshape(nb_samples, 2, 3)
+        for i, v in enumerate(values):
+            history.append(v, i - 1)
+        return values
+
+    def test_grow(self):
+        h = SampleHistory(3)
+        values = self._fill(h, 10)
+        self.assertEqual(len(h), 10)
+        assert_array_equal(h.get_data(), values)
+        assert_array_equal(h.get_iterations(), np.arange(-1, 9))
+
+    def test_ring(self):
+        h = SampleHistory(10, max_samples=4)
+        values = self._fill(h, 3)
+        assert_array_equal(h.get_data(), values)
+        values = self._fill(h, 11)
+        self.assertEqual(len(h), 4)
+        self.assertEqual(len(h.data), 8)
+        assert_array_equal(h.get_data(), values[-4:])
+        assert_array_equal(h.get_iterations(), np.arange(6, 10))
+
+    def test_memmap(self):
+        tmp_dir = pyhrf.get_tmp_path()
+        try:
+            h = SampleHistory(2, directory=tmp_dir)
+            values = self._fill(h, 5)
+            self.assertTrue(isinstance(h.data, np.memmap))
+            assert_array_equal(h.get_data(), values)
+            self.assertEqual(os.listdir(tmp_dir), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_pickle(self):
+        h = SampleHistory(8)
+        self._fill(h, 3)
+        state = h.__getstate__()
+        self.assertEqual(len(state['data']), 3)
+        h2 = cPickle.loads(cPickle.dumps(h, cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(len(h2.data), 8)
+        self._fill(h2, 12)
+        self._fill(h, 12)
+        assert_array_equal(h2.get_data(), h.get_data())
+        assert_array_equal(h2.get_iterations(), h.get_iterations())
+
+    def test_pickle_ring(self):
+        h = SampleHistory(10, max_samples=4)
+        self._fill(h, 6)
+        h2 = cPickle.loads(cPickle.dumps(h, cPickle.HIGHEST_PROTOCOL))
+        assert_array_equal(h2.get_data(), h.get_data())
+        # appending goes on as in the original history:
+        for h_ in (h, h2):
+            h_.append(np.zeros((2, 3)) - 1, 100)
+            h_.append(np.zeros((2, 3)) - 2, 101)
+        assert_array_equal(h2.get_data(), h.get_data())
+        assert_array_equal(h2.get_iterations(), h.get_iterations())
+
+    def test_pickle_memmap(self):
+        tmp_dir = pyhrf.get_tmp_path()
+        try:
+            h = SampleHistory(2, directory=tmp_dir)
+            values = self._fill(h, 5)
+            h2 = cPickle.loads(cPickle.dumps(h, cPickle.HIGHEST_PROTOCOL))
+            self.assertTrue(isinstance(h2.data, np.memmap))
+            assert_array_equal(h2.get_data(), values)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_storage_xml(self):
+        sampler = BOLDGibbsSampler(history_max_samples=3,
+                                   history_dir='/tmp')
+        sampler = xmlio.from_xml(xmlio.to_xml(sampler))
+        self.assertEqual(sampler.history_max_samples, 3)
+        self.assertEqual(sampler.history_dir, '/tmp')
+
+    def test_sampler_histories(self):
+        sampler = BOLDGibbsSampler(nb_iterations=10, history_max_samples=3)
+        sampler.smplHistoryPace = 2
+        sampler.obsHistoryPace = 1
+        roi_data = FmriData.from_vol_files().roi_split()[0]
+        sampler = JDEMCMCAnalyser(sampler=sampler).analyse_roi(roi_data)
+        nrl = sampler.get_variable('nrl')
+        self.assertEqual(nrl.smplHistory.shape, (3,) + nrl.finalValue.shape)
+        assert_array_equal(nrl.smplHistoryIts, [4, 6, 8])
+        self.assertEqual(nrl.labelsSmplHistory.shape, nrl.smplHistory.shape)
+        assert_array_equal(nrl.obsHistoryIts, [7, 8, 9])
+        self.assertEqual(len(nrl.errorHistory), 3)
+
+        # histories are pickled once, in their buffers:
+        state = nrl.__getstate__()
+        self.assertFalse('smplHistory' in state)
+        self.assertFalse('labelsSmplHistory' in state)
+        nrl2 = cPickle.loads(cPickle.dumps(nrl, cPickle.HIGHEST_PROTOCOL))
+        assert_array_equal(nrl2.smplHistory, nrl.smplHistory)
+        assert_array_equal(nrl2.obsHistoryIts, nrl.obsHistoryIts)
+
+
 class GibbsTest(unittest.TestCase):
 
     def test_var_tracking(self):
         pass
+
+    def _run(self, diagnostics_pace):
+        np.random.seed(1)
+        sampler = BOLDGibbsSampler(nb_iterations=6,
+                                   diagnostics_pace=diagnostics_pace)
+        roi_data = FmriData.from_vol_files().roi_split()[0]
+        return roi_data, JDEMCMCAnalyser(sampler=sampler).analyse_roi(roi_data)
+
+    def test_diagnostics(self):
+        roi_data, sampler = self._run(1)
+        self.assertEqual(len(sampler.converror), 6)
+        self.assertEqual(len(sampler.loglikelihood), 6)
+
+        np.random.seed(1)
+        sampler = BOLDGibbsSampler(nb_iterations=1)
+        sampler.linkToData(JDEMCMCAnalyser(sampler=sampler)
+                           .packSamplerInput(roi_data))
+        sampler.init_sampling()
+        # same as the loop over voxels:
+        bold = roi_data.bold
+        r = bold - sampler.computeFit()
+        var_noise = sampler.get_variable('noise_var').currentValue
+        N = r.shape[0]
+        loglh = 0
+        for j in xrange(r.shape[1]):
+            loglh -= (np.log(np.abs(2 * np.pi * var_noise[j] * N)) +
+                      np.dot(r[:, j], r[:, j]) / var_noise[j] / 2)
+        rec_error = (r ** 2).sum(0).mean() / (bold ** 2).sum(0).mean()
+        assert_allclose(sampler.compute_diagnostics(bold),
+                        (rec_error, loglh))
+
+    def test_diagnostics_pace(self):
+        sampler = self._run(4)[1]
+        self.assertEqual(len(sampler.converror), 2)
+        sampler = self._run(-1)[1]
+        self.assertFalse(hasattr(sampler, 'converror'))
+        self.assertFalse('conv_error' in sampler.getOutputs())
+
+    def test_diagnostics_pace_xml(self):
+        sampler = BOLDGibbsSampler(diagnostics_pace=5)
+        sampler = xmlio.from_xml(xmlio.to_xml(sampler))
+        self.assertEqual(sampler.diagnostics_pace, 5)
+
+
+class InterruptCallback(GSDefaultCallbackHandler):
+
+    interrupt_at = None
+
+    def callback(self, it, variables, samplerEngine):
+        if it == InterruptCallback.interrupt_at:
+            raise KeyboardInterrupt()
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = pyhrf.get_tmp_path()
+        self.roi_data = FmriData.from_vol_files().roi_split()[0]
+
+    def tearDown(self):
+        InterruptCallback.interrupt_at = None
+        shutil.rmtree(self.tmp_dir)
+
+    def _analyser(self, checkpoint_dir=None):
+        sampler = BOLDGibbsSampler(nb_iterations=6)
+        sampler.callbacker = InterruptCallback()
+        analyser = JDEMCMCAnalyser(sampler=sampler)
+        analyser.sampling_checkpoint_pace = 2
+        analyser.set_checkpoint_dir(checkpoint_dir)
+        return analyser
+
+    def test_resume_sampling(self):
+        np.random.seed(1)
+        expected = self._analyser().analyse_roi(self.roi_data).getOutputs()
+
+        analyser = self._analyser(self.tmp_dir)
+        sampler_checkpoint = analyser.get_roi_checkpoint_file(self.roi_data,
+                                                              'sampler')
+        InterruptCallback.interrupt_at = 4
+        np.random.seed(1)
+        self.assertRaises(KeyboardInterrupt, analyser.analyse_roi,
+                          self.roi_data)
+        self.assertTrue(op.exists(sampler_checkpoint))
+
+        # sampling restarts after iteration 3, with the random state saved
+        # at that time:
+        InterruptCallback.interrupt_at = None
+        np.random.seed(2)
+        sampler = self._analyser(self.tmp_dir).analyse_roi(self.roi_data)
+        self.assertEqual(sampler.final_iteration, 5)
+        self.assertFalse(op.exists(sampler_checkpoint))
+        outputs = sampler.getOutputs()
+        for name in ['nrl_pm', 'hrf_pm', 'noise_var_pm', 'conv_error']:
+            assert_almost_equal(outputs[name].data, expected[name].data)
+
+
+class ChromaticGibbsTest(unittest.TestCase):
+
+    def _sampler(self, nb_iterations, **variables):
+        # new instances of all variables, as default ones are shared by
+        # samplers and bound to the last one created:
+        all_variables = {'response_levels': NRLSampler(),
+                         'hrf': HRFSampler(), 'hrf_var': RHSampler(),
+                         'mixt_weights': MixtureWeightsSampler(),
+                         'mixt_params': BiGaussMixtureParamsSampler(),
+                         'beta': BetaSampler(), 'scale': ScaleSampler(),
+                         'noise_var': NoiseVarianceSampler()}
+        all_variables.update(variables)
+        return BOLDGibbsSampler(nb_iterations=nb_iterations, **all_variables)
+
+    def test_sweep_same_as_serial(self):
+        """ With one class per voxel, the chromatic sweep visits voxels in
+        the same order as the serial C version and must give the same state.
+        """
+        np.random.seed(3)
+        sampler = self._sampler(
+            1, response_levels=NRLSampler(gibbs_mode='chromatic'))
+        roi_data = FmriData.from_vol_files().roi_split()[0]
+        sampler.linkToData(JDEMCMCAnalyser(sampler=sampler)
+                           .packSamplerInput(roi_data))
+        sampler.init_sampling()
+        for v in sampler.variables:
+            v.sampleNext(sampler.variables)
+
+        nrl = sampler.get_variable('nrl')
+        self.assertEqual(len(nrl.colourClasses), 2)
+        nrl.initColourClasses([np.array([i]) for i in xrange(nrl.nbVox)])
+        gTQg = np.diag(np.dot(nrl.varXhtQ, sampler.get_variable('hrf').varXh))
+        init_state = (nrl.currentValue.copy(), nrl.labels.copy(),
+                      nrl.varYtilde.copy())
+
+        np.random.seed(10)
+        nrl.sampleNrlsChromatic(gTQg)
+        chromatic = (nrl.currentValue.copy(), nrl.labels.copy(),
+                     nrl.varYtilde.copy(), nrl.meanClassApost.copy(),
+                     nrl.varClassApost.copy())
+
+        nrl.currentValue[:], nrl.labels[:], nrl.varYtilde[:] = init_state
+        np.random.seed(10)
+        nrl.sampleNrlsSerial(None, None, None, None, None, gTQg, None)
+        serial = (nrl.currentValue, nrl.labels, nrl.varYtilde,
+                  nrl.meanClassApost, nrl.varClassApost)
+        for c, s in zip(chromatic, serial):
+            assert_allclose(c, s, rtol=1e-10, atol=1e-10)
+
+    def _posterior(self, gibbs_mode, seed):
+        # only NRLs and labels are sampled:
+        np.random.seed(seed)
+        sampler = self._sampler(
+            1000, response_levels=NRLSampler(gibbs_mode=gibbs_mode),
+            hrf=HRFSampler(do_sampling=False, use_true_value=True),
+            hrf_var=RHSampler(do_sampling=False),
+            noise_var=NoiseVarianceSampler(do_sampling=False,
+                                           use_true_value=True),
+            mixt_params=BiGaussMixtureParamsSampler(do_sampling=False,
+                                                    use_true_value=True),
+            beta=BetaSampler(do_sampling=False, val_ini=np.array([0.6])))
+        analyser = JDEMCMCAnalyser(sampler=sampler, dt=self.simu['dt'])
+        nrl = analyser.analyse_roi(self.fdata).get_variable('nrl')
+        return nrl.mean, nrl.meanLabels[nrl.L_CA]
+
+    def test_posterior_same_as_serial(self):
+        np.random.seed(5)
+        self.simu = simulate_bold(spatial_size='random_small',
+                                  noise_scenario='low_snr')
+        self.fdata = FmriData.from_simulation_dict(self.simu)
+
+        serial_nrls, serial_labels = self._posterior('serial', 1)
+        nrls, labels = self._posterior('chromatic', 1)
+        # Monte Carlo error between two serial chains is ~0.1 for NRLs
+        # (max ~3.5) and ~0.05 for label probabilities:
+        assert_allclose(nrls, serial_nrls, atol=.25)
+        assert_allclose(labels, serial_labels, atol=.15)
+
+    def test_unknown_gibbs_mode(self):
+        self.assertRaises(Exception, NRLSampler, gibbs_mode='parallel')
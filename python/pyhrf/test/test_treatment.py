@@ -6,6 +6,7 @@ import cPickle
 import os.path as op
 import shutil
 
+import numpy as np
 import numpy.testing as npt
 
 import pyhrf
@@ -14,6 +15,11 @@ import pyhrf.paradigm as ppar
 
 from pyhrf.configuration import cfg
 from pyhrf import tools
+from pyhrf.core import FmriData
+from pyhrf.ndarray import xndarray, MRI3Daxes
+from pyhrf.ui.analyser_ui import ROIOutputsWriter, ROIResult
+from pyhrf.ui.jde import JDEMCMCAnalyser
+from pyhrf.jde.models import BOLDGibbsSampler
 
 
 class CmdInputTest(unittest.TestCase):
@@ -87,8 +93,6 @@ class TreatmentTest(unittest.TestCase):
         t.enable_draft_testing()
         t.run()
 
-    @unittest.skipIf(not tools.is_importable('joblib'),
-                     'joblib (optional dep) is N/A')
     def test_parallel_local(self):
 
         t = ptr.FMRITreatment(make_outputs=False, result_dump_file=None)
@@ -121,15 +125,11 @@ class TreatmentTest(unittest.TestCase):
         if os.system(cmd) != 0:
             raise Exception('"' + cmd + '" did not execute correctly')
 
-    @unittest.skipIf(not tools.is_importable('joblib'),
-                     'joblib (optional dep) is N/A')
     def test_default_treatment_parallel_local(self):
         t = ptr.FMRITreatment(make_outputs=False, result_dump_file=None)
         t.enable_draft_testing()
         t.run(parallel='local')
 
-    @unittest.skipIf(not tools.is_importable('joblib'),
-                     'joblib (optional dep) is N/A')
     def test_default_jde_cmd_parallel_local(self):
         t = ptr.FMRITreatment(make_outputs=False, result_dump_file=None)
         t.enable_draft_testing()
@@ -178,3 +178,143 @@ class TreatmentTest(unittest.TestCase):
         else:
             print 'Cluster testing is off '\
                 '([cluster-LAN][enable_unit_test] = 0 in config.cfg'
+
+
+class ROIOutputsWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = pyhrf.get_tmp_path()
+        self.fdata = FmriData.from_vol_files()
+        self.rois_data = self.fdata.roi_split()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _roi_outputs(self, roi_data):
+        nvox = roi_data.get_nb_vox_in_mask()
+        roi_id = roi_data.get_roi_id()
+        nrls = np.arange(2 * nvox, dtype=float).reshape(2, nvox) + 100 * roi_id
+        return {'nrls': xndarray(nrls, ['condition', 'voxel'],
+                                 {'condition': ['audio', 'video']}),
+                'roi_size': xndarray(np.array([nvox]), ['dim'])}
+
+    def _check_outputs(self, gzip_outputs):
+        writer = ROIOutputsWriter(self.tmp_dir, 'test_',
+                                  self.fdata.spatial_shape,
+                                  self.fdata.meta_obj, gzip_outputs)
+        expected = None
+        for roi_data in self.rois_data:
+            outputs = self._roi_outputs(roi_data)
+            writer.add(roi_data, outputs)
+            expected = outputs['nrls'].expand(roi_data.roiMask != 0, 'voxel',
+                                              MRI3Daxes, dest=expected)
+        coutputs, output_fns = writer.close()
+        ext = '.nii.gz' if gzip_outputs else '.nii'
+        self.assertEqual(sorted(output_fns),
+                         [op.join(self.tmp_dir, 'test_%s%s' % (o, ext))
+                          for o in ['nrls', 'roi_size']])
+        expected.set_MRI_orientation()
+        nrls = xndarray.load(op.join(self.tmp_dir, 'test_nrls' + ext))
+        self.assertEqual(nrls.axes_names, expected.axes_names)
+        npt.assert_array_equal(nrls.data, expected.data)
+        roi_size = xndarray.load(op.join(self.tmp_dir, 'test_roi_size' + ext))
+        npt.assert_array_equal(roi_size.data.squeeze(),
+                               [d.get_nb_vox_in_mask() for d in self.rois_data])
+        self.assertEqual([f for f in os.listdir(self.tmp_dir)
+                          if f.endswith('.partial')], [])
+
+    def test_outputs(self):
+        self._check_outputs(gzip_outputs=False)
+
+    def test_outputs_gzip(self):
+        self._check_outputs(gzip_outputs=True)
+
+    def test_outputs_readable_while_running(self):
+        writer = ROIOutputsWriter(self.tmp_dir, 'test_',
+                                  self.fdata.spatial_shape,
+                                  self.fdata.meta_obj)
+        roi_data = self.rois_data[0]
+        writer.add(roi_data, self._roi_outputs(roi_data))
+        nrls = xndarray.load(op.join(self.tmp_dir, 'test_nrls.nii'))
+        m = roi_data.np_roi_mask
+        npt.assert_array_equal(nrls.data[m[0], m[1], m[2], :].T,
+                               self._roi_outputs(roi_data)['nrls'].data)
+        writer.close()
+
+
+class ROIResultTest(unittest.TestCase):
+
+    def test_outputs(self):
+        outputs = {'nrls': xndarray(np.arange(6.).reshape(2, 3).T,
+                                    ['voxel', 'condition'],
+                                    {'condition': ['audio', 'video']},
+                                    value_label='nrl'),
+                   'roi_size': xndarray(np.array([3]), ['dim'])}
+        result = cPickle.loads(cPickle.dumps(ROIResult.from_outputs(outputs),
+                                             cPickle.HIGHEST_PROTOCOL))
+        self.assertEqual(len(result), 2)
+        self.assertTrue('nrls' in result)
+        self.assertTrue(all(d.flags.c_contiguous for d in result.data))
+        new_outputs = result.getOutputs()
+        self.assertEqual(new_outputs.keys(), ['nrls', 'roi_size'])
+        for name, c in outputs.iteritems():
+            self.assertEqual(new_outputs[name], c)
+        self.assertEqual(new_outputs['nrls'].value_label, 'nrl')
+
+    def test_analyse_roi_wrap(self):
+        roi_data = FmriData.from_vol_files().roi_split()[0]
+        analyser = JDEMCMCAnalyser(sampler=BOLDGibbsSampler(nb_iterations=3))
+        np.random.seed(1)
+        sampler = analyser.analyse_roi(roi_data)
+        np.random.seed(1)
+        _, result, report = analyser.analyse_roi_wrap(roi_data)
+        self.assertEqual(report, 'ok')
+        self.assertTrue(isinstance(result, ROIResult))
+        outputs = result.getOutputs()
+        expected = sampler.getOutputs()
+        self.assertEqual(sorted(outputs.keys()), sorted(expected.keys()))
+        for name in ['nrl_pm', 'hrf_pm', 'noise_var_pm']:
+            npt.assert_array_equal(outputs[name].data, expected[name].data)
+        self.assertTrue(len(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)) <
+                        len(cPickle.dumps(sampler, cPickle.HIGHEST_PROTOCOL)))
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = pyhrf.get_tmp_path()
+        self.checkpoint_dir = op.join(self.tmp_dir, 'checkpoints')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _run_treatment(self, output_dir, crash=False):
+        t = ptr.FMRITreatment(output_dir=output_dir, result_dump_file=None)
+        t.enable_draft_testing()
+        t.output_dir = output_dir
+        if crash:
+            def analyse_roi(roi_data):
+                raise Exception('ROI %d analysed again' % roi_data.get_roi_id())
+            t.analyser.analyse_roi = analyse_roi
+            t.analyser.set_pass_errors(False)
+        t.run(checkpoint_dir=self.checkpoint_dir)
+
+    def test_resume(self):
+        dir_run = op.join(self.tmp_dir, 'run')
+        dir_resume = op.join(self.tmp_dir, 'resume')
+        os.makedirs(dir_run)
+        os.makedirs(dir_resume)
+        self._run_treatment(dir_run)
+
+        nb_rois = len(FmriData.from_vol_files().roi_split())
+        self.assertEqual(len(os.listdir(self.checkpoint_dir)), nb_rois)
+
+        # every ROI is loaded from checkpoints, none is analysed again:
+        self._run_treatment(dir_resume, crash=True)
+        self.assertEqual(sorted(os.listdir(dir_run)),
+                         sorted(os.listdir(dir_resume)))
+        for fn in os.listdir(dir_run):
+            if fn.endswith('.nii'):
+                npt.assert_array_equal(
+                    xndarray.load(op.join(dir_run, fn)).data,
+                    xndarray.load(op.join(dir_resume, fn)).data)
@@ -622,34 +622,281 @@ def load_fmri_vol_data(boldFiles, roiMaskFile, keepBackground=False,
     return graphs, roiBold, sessionScans, roiMask, mask_meta_data
 
 
-def discard_bad_data(bold, roiMask, time_axis=None):
-    """ Discard positions in 'roiMask' where 'bold' has zero variance or
-    contains NaNs
+class BoldStats(object):
+    """ Per-voxel running statistics of time series.
+
+    Samples are accumulated by chunks of scans (see :meth:`update`): mean
+    and sum of squared deviations are combined with Welford/Chan updates so
+    that each sample is read once and no full-size temporary is built. NaN
+    samples are counted and excluded from the other statistics.
+
+    Args:
+        - shape (tuple): spatial shape (eg volume shape or (nb_voxels,))
+
+    Attributes:
+        - count (np.ndarray of int): number of non-NaN samples
+        - mean (np.ndarray): mean of non-NaN samples
+        - nan_count (np.ndarray of int): number of NaN samples
+        - first (np.ndarray): first sample (eg first scan)
+    """
+
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.nan_count = np.zeros(shape, dtype=np.int64)
+        self.min = np.zeros(shape) + np.inf
+        self.max = np.zeros(shape) - np.inf
+        self.first = None
+
+    def update(self, chunk, time_axis=0):
+        """ Accumulate a chunk of samples along *time_axis*
+        """
+        chunk = np.rollaxis(np.asarray(chunk), time_axis)
+        if chunk.shape[0] == 0:
+            return
+        if self.first is None:
+            self.first = chunk[0].copy()
+        nans = np.isnan(chunk)
+        chunk_nan_count = nans.sum(0)
+        has_nans = chunk_nan_count.any()
+        if has_nans:
+            chunk = np.where(nans, 0., chunk)
+        chunk_count = chunk.shape[0] - chunk_nan_count
+        chunk_mean = (chunk.sum(0, dtype=np.float64) /
+                      np.maximum(chunk_count, 1))
+        dev = chunk - chunk_mean
+        if has_nans:
+            dev[nans] = 0.
+            self.min = np.fmin(self.min, np.where(nans, np.inf, chunk).min(0))
+            self.max = np.fmax(self.max,
+                               np.where(nans, -np.inf, chunk).max(0))
+        else:
+            self.min = np.fmin(self.min, chunk.min(0))
+            self.max = np.fmax(self.max, chunk.max(0))
+        chunk_m2 = (dev ** 2).sum(0, dtype=np.float64)
+
+        # combine with previous chunks (Chan et al.):
+        count = self.count + chunk_count
+        delta = chunk_mean - self.mean
+        ratio = chunk_count / np.maximum(count, 1).astype(np.float64)
+        self.mean += delta * ratio
+        self.m2 += chunk_m2 + delta ** 2 * self.count * ratio
+        self.count = count
+        self.nan_count += chunk_nan_count
+
+    def get_var(self):
+        """ Unbiased variance of non-NaN samples, exactly 0 for constant
+        time series and time series with less than two samples """
+        var = self.m2 / np.maximum(self.count - 1, 1)
+        var[np.bitwise_or(self.min >= self.max, self.count < 2)] = 0.
+        return var
+    var = property(get_var)
+
+
+def bold_stats(bold, time_axis=None, chunk_memory=64 * 2 ** 20):
+    """ Compute the statistics (:class:`BoldStats`) of *bold* along
+    *time_axis* (default is pyhrf.ndarray.TIME_AXIS), by chunks of scans of
+    at most *chunk_memory* bytes.
     """
     from pyhrf.ndarray import TIME_AXIS
 
     if time_axis is None:
         time_axis = TIME_AXIS
 
+    nb_scans = bold.shape[time_axis]
+    scan_size = max(1, bold.size // max(nb_scans, 1)) * bold.itemsize
+    chunk_size = max(1, chunk_memory // scan_size)
+    stats = BoldStats(bold.shape[:time_axis] + bold.shape[time_axis + 1:])
+    index = [slice(None)] * bold.ndim
+    for t0 in xrange(0, nb_scans, chunk_size):
+        index[time_axis] = slice(t0, t0 + chunk_size)
+        stats.update(bold[tuple(index)], time_axis)
+    return stats
+
+
+def read_volume_stats(fileName, chunk_memory=64 * 2 ** 20, copy_file=None):
+    """ Compute the statistics (:class:`BoldStats`) of the 4D volume stored
+    in 'fileName', which is read by chunks of scans.
+    Return a tuple: (stats, meta_data)
+
+    If *copy_file* (file name or file object) is given, scans are also
+    copied to it while they are read, as a memory-mapped array of shape
+    (nx, ny, nz, nb_scans) that can be read again without decoding
+    'fileName' (eg by :func:`read_bold_in_mask`). The returned tuple is
+    then: (stats, meta_data, copy)
+    """
+    nim = nibabel.load(fileName)
+    scan_size = np.prod(nim.shape[:3]) * nim.get_data_dtype().itemsize
+    chunk_size = max(1, chunk_memory // scan_size)
+    stats = BoldStats(nim.shape[:3])
+    copy = None
+    for t0 in xrange(0, nim.shape[3], chunk_size):
+        chunk = np.asarray(nim.dataobj[..., t0:t0 + chunk_size])
+        stats.update(chunk, time_axis=3)
+        if copy_file is not None:
+            if copy is None:
+                # scans are stored contiguously, time first:
+                copy = np.memmap(copy_file, dtype=chunk.dtype, mode='w+',
+                                 shape=(nim.shape[3],) + nim.shape[:3])
+            copy[t0:t0 + chunk.shape[3]] = np.rollaxis(chunk, 3)
+    meta_data = (nim.get_affine(), nim.get_header())
+    if copy_file is None:
+        return stats, meta_data
+    if copy is None:  # no scan
+        copy = np.empty((0,) + nim.shape[:3], dtype=nim.get_data_dtype())
+    return stats, meta_data, np.rollaxis(copy, 0, 4)
+
+
+def scan_bad_data(bold, roiMask, time_axis=None, stats=None):
+    """ Find positions in 'roiMask' where 'bold' has zero variance or
+    contains NaNs.
+
+    Args:
+        - bold (np.ndarray): time series
+        - roiMask (np.ndarray of int): labels of positions, with the shape
+          of bold without its time axis. Only positions with label >= 1 can
+          be discarded.
+        - time_axis (int): default is pyhrf.ndarray.TIME_AXIS
+        - stats (BoldStats): statistics of *bold* if already computed
+
+    Return: (to_discard, stats)
+        - to_discard (np.ndarray of bool): positions to discard
+        - stats (BoldStats): per-position statistics of *bold*
+    """
+    if stats is None:
+        stats = bold_stats(bold, time_axis)
+
     m = roiMask
-    var_bold = (bold ** 2).sum(time_axis) / (bold.shape[time_axis] - 1) - \
-        bold.mean(time_axis) ** 2
-    zeroVarianceVoxels = np.bitwise_and(m >= 1, var_bold == 0.)
+    zeroVarianceVoxels = np.bitwise_and(m >= 1, stats.var == 0.)
     if zeroVarianceVoxels.any():
         logger.debug('discarded voxels (std=0):')
         logger.debug(np.where(zeroVarianceVoxels == True))
         logger.info('!! discarded voxels (std=0): %d/%d',
                     zeroVarianceVoxels.sum(), (m != 0).sum())
 
-    nanVoxels = np.bitwise_and(m >= 1, np.isnan(bold.sum(time_axis)))
+    nanVoxels = np.bitwise_and(m >= 1, stats.nan_count > 0)
     if nanVoxels.any():
         logger.debug('discarded voxels (nan values):')
         logger.debug(np.where(nanVoxels == True))
         logger.info('!! discarded voxels (nan values): %d/%d', nanVoxels.sum(),
                     (m != 0).sum())
 
-    toDiscard = np.bitwise_or(zeroVarianceVoxels, nanVoxels)
+    return np.bitwise_or(zeroVarianceVoxels, nanVoxels), stats
+
+
+def discard_bad_data(bold, roiMask, time_axis=None, stats=None):
+    """ Discard positions in 'roiMask' where 'bold' has zero variance or
+    contains NaNs: their label is set to 0 (in place).
+    See :func:`scan_bad_data` for arguments and returned value.
+    """
+    toDiscard, stats = scan_bad_data(bold, roiMask, time_axis, stats)
     roiMask *= np.bitwise_not(toDiscard)
+    return toDiscard, stats
+
+
+def read_bold_in_mask(bold_files, mask, background_label=0, dtype=None,
+                      chunk_memory=64 * 2 ** 20, remove_nans=True):
+    """ Read the in-mask time series of 4D volumes, session by session.
+
+    Volumes are not loaded as a whole: they are read through nibabel array
+    proxies (memory-mapped for uncompressed files) by chunks of scans, and
+    in-mask voxels are directly stored in a preallocated
+    (nb_scans, nb_voxels) array. Voxels with zero variance are detected in
+    the same pass and discarded as in :func:`discard_bad_data`: *mask* is
+    set to 0 at their positions (in place) and they are removed from the
+    returned time series. If *remove_nans* is False, voxels containing NaNs
+    are discarded as well.
+
+    Args:
+        - bold_files (list of str or np.ndarray): 4D volume of each session,
+          as a file name or an array (eg a copy made by
+          :func:`read_volume_stats`)
+        - mask (np.ndarray of int): 3D label volume (modified in place)
+        - background_label (int): label of voxels that are not read
+        - dtype (np.dtype): storage type of the time series. If None, the
+          type of the data of the first file is used.
+        - chunk_memory (int): maximum size in bytes of a chunk of scans
+        - remove_nans (bool): replace NaNs with 0 (as :func:`read_volume`
+          does), before voxels with zero variance are detected.
+
+    Return: (bold, session_scans, stats)
+        - bold (np.ndarray): time series of in-mask voxels,
+          shape (nb_scans, nb_voxels) where voxels are ordered as
+          np.where(mask != background_label)
+        - session_scans (list of np.ndarray): scan indexes of each session
+        - stats (BoldStats): statistics of all voxels initially in mask
+    """
+    sources = [_bold_source(b) for b in bold_files]
+    for fn, data, _ in sources:
+        if data.shape[:3] != mask.shape:
+            raise Exception('Shape of BOLD volume %s (%s) does not match '
+                            'shape of mask (%s)' % (fn, str(data.shape[:3]),
+                                                    str(mask.shape)))
+    positions = np.where(mask != background_label)
+    nb_voxels = len(positions[0])
+    nb_scans = sum(data.shape[3] for _, data, _ in sources)
+
+    bold = None
+    stats = BoldStats(nb_voxels)
+    session_scans = []
+    last_scan = 0
+    for fn, data, itemsize in sources:
+        logger.info('Read in-mask BOLD from %s (%d scans)', fn, data.shape[3])
+        chunk_size = max(1, chunk_memory // (np.prod(mask.shape) * itemsize))
+        for t0 in xrange(0, data.shape[3], chunk_size):
+            t1 = min(t0 + chunk_size, data.shape[3])
+            chunk = np.asarray(data[..., t0:t1])[positions].T
+            # same NaN policy as read_volume, before bad data are scanned:
+            if remove_nans:
+                chunk[np.isnan(chunk)] = 0
+            stats.update(chunk)
+            if bold is None:
+                if dtype is None:
+                    dtype = chunk.dtype
+                bold = np.empty((nb_scans, nb_voxels), dtype=dtype)
+            bold[last_scan + t0:last_scan + t1] = chunk
+        session_scans.append(np.arange(last_scan, last_scan + data.shape[3],
+                                       dtype=int))
+        last_scan += data.shape[3]
+    if bold is None:  # no scan
+        if dtype is None:
+            dtype = np.float64
+        bold = np.empty((0, nb_voxels), dtype=dtype)
+
+    to_discard = scan_bad_data(bold, mask[positions], stats=stats)[0]
+    if to_discard.any():
+        mask[tuple(p[to_discard] for p in positions)] = 0
+        kept = np.where(mask[positions] != background_label)[0]
+        bold = _compact_columns(bold, kept, chunk_memory)
+
+    return bold, session_scans, stats
+
+
+def _bold_source(bold):
+    """ Return (name, data, itemsize) of a 4D volume given as a file name,
+    where data is a nibabel array proxy, or as an array.
+    """
+    if isinstance(bold, basestring):
+        nim = nibabel.load(bold)
+        return bold, nim.dataobj, nim.get_data_dtype().itemsize
+    return '<array>', bold, bold.dtype.itemsize
+
+
+def _compact_columns(array, columns, chunk_memory):
+    """ Return array[:, columns] (with increasing *columns*) stored in the
+    buffer of *array*, which must be C-contiguous. Rows are moved by chunks
+    so that no full copy is made.
+    """
+    flat = array.reshape(-1)
+    nb_rows, nb_cols = array.shape
+    nb_kept = len(columns)
+    chunk_size = max(1, chunk_memory // max(1, nb_cols * array.itemsize))
+    for r0 in xrange(0, nb_rows, chunk_size):
+        r1 = min(r0 + chunk_size, nb_rows)
+        # destination rows never overlap source rows not read yet:
+        flat[r0 * nb_kept:r1 * nb_kept] = array[r0:r1, columns].ravel()
+    return flat[:nb_rows * nb_kept].reshape(nb_rows, nb_kept)
 
 
 def has_ext_gzsafe(fn, ext):
@@ -6,19 +6,295 @@ import sys
 import traceback
 import StringIO
 import logging
+import hashlib
+import itertools
+import cPickle
+
+from collections import OrderedDict
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 from pyhrf import xmlio, FmriData, FmriGroupData
 from pyhrf.ndarray import MRI3Daxes
 from pyhrf.tools import stack_trees, add_prefix
 from pyhrf.tools._io import read_volume, read_texture
-from pyhrf.ndarray import stack_cuboids
+from pyhrf.ndarray import stack_cuboids, xndarray
 
 
 logger = logging.getLogger(__name__)
 
 
+def roi_data_digest(roiData):
+    """Digest of the parcel-specific data analysed for a ROI
+
+    It covers the BOLD signals, the voxel positions, the TR and the paradigm,
+    so that a checkpoint saved for a ROI is not reused on different data.
+
+    Args:
+        roiData (~pyhrf.core.FmriData): parcel-specific fMRI data set
+
+    Return:
+        str (hexadecimal md5 digest)
+    """
+    if isinstance(roiData, FmriGroupData):
+        return hashlib.md5(''.join(roi_data_digest(d) for d in
+                                   roiData.data_subjects)).hexdigest()
+    md5 = hashlib.md5()
+    md5.update(np.ascontiguousarray(roiData.bold).data)
+    for positions in roiData.np_roi_mask:
+        md5.update(np.ascontiguousarray(positions).data)
+    md5.update(repr(float(roiData.tr)))
+    paradigm = roiData.paradigm
+    for cond in sorted(paradigm.stimOnsets.keys()):
+        md5.update(cond)
+        for onsets, durations in zip(paradigm.stimOnsets[cond],
+                                     paradigm.stimDurations[cond]):
+            md5.update(np.asarray(onsets, dtype=float).tostring())
+            md5.update(np.asarray(durations, dtype=float).tostring())
+    return md5.hexdigest()
+
+
+class ROIResult(object):
+    """Compact result of a ROI analysis, holding only its outputs.
+
+    Outputs are stored column-wise: one contiguous array per output, along
+    with its axes names, axes domains, value label and meta data. This is
+    what ROI analyses return from worker processes and what is pickled into
+    result dumps and checkpoints, instead of the whole estimation object
+    (eg a Gibbs sampler with its variables, histories and input data).
+
+    The outputs are rebuilt as xndarray objects by :meth:`getOutputs`, so
+    that a ROIResult can be used wherever an estimation object with a
+    getOutputs method is expected.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.data = []
+        self.axes = []  # (axes_names, axes_domains, value_label, meta_data)
+
+    @classmethod
+    def from_outputs(cls, outputs):
+        """Build a ROIResult from a dict of xndarray objects (eg as returned
+        by the getOutputs method of samplers)"""
+        result = cls()
+        for name in sorted(outputs.keys()):
+            result.add(name, outputs[name])
+        return result
+
+    def add(self, name, c):
+        """Store output *c* (xndarray) under *name*"""
+        self.names.append(name)
+        self.data.append(np.ascontiguousarray(c.data))
+        self.axes.append((list(c.axes_names), dict(c.axes_domains),
+                          c.value_label, c.meta_data))
+
+    def getOutputs(self):
+        """Return the outputs as an ordered dict of xndarray objects"""
+        outputs = OrderedDict()
+        for name, data, (axes_names, axes_domains, value_label, meta_data) \
+                in zip(self.names, self.data, self.axes):
+            outputs[name] = xndarray(data, axes_names, axes_domains.copy(),
+                                     value_label, meta_data=meta_data)
+        return outputs
+
+    @property
+    def nbytes(self):
+        """Size of the output arrays, in bytes"""
+        return sum(d.nbytes for d in self.data)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.names
+
+
+class ROIOutputsWriter(object):
+    """Merge the outputs of ROI analyses as soon as each ROI result comes.
+
+    Each voxel-mapped output (ie with a 'voxel' axis) is written into a
+    memory-mapped destination array covering the whole spatial domain, where
+    the values of each ROI are scattered when it is added. For uncompressed
+    NIfTI outputs, the destination is the data block of the final file, whose
+    header is written when the output is first seen: outputs of finished ROIs
+    can be read while the analysis is still running. Other formats are
+    buffered in a raw memory-mapped file and saved when the writer is closed.
+    ROI-level outputs (without 'voxel' axis) are stacked along a 'ROI' axis
+    when the writer is closed.
+
+    Only one ROI result and the memory-mapped destinations are then needed
+    at once.
+
+    Args:
+        output_dir (str): directory where outputs are written
+        prefix (str): tag to prefix every output file name
+        spatial_shape (tuple): shape of the spatial domain (3D for volumes,
+            1D for surfaces)
+        meta_data (tuple): (affine, header) of the input data, used to save
+            volumes
+        gzip_outputs (bool): compress output files
+    """
+
+    def __init__(self, output_dir, prefix, spatial_shape, meta_data=None,
+                 gzip_outputs=False):
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.spatial_shape = tuple(spatial_shape)
+        self.meta_data = meta_data
+
+        if len(self.spatial_shape) == 3:  # Volumic data:
+            self.target_axes = MRI3Daxes  # ['axial','coronal', 'sagittal']
+            self.ext = '.nii'
+        else:  # surfacic
+            self.target_axes = ['voxel']
+            self.ext = '.gii'
+        self.in_place = (self.ext == '.nii' and not gzip_outputs)
+        if gzip_outputs:
+            self.ext += '.gz'
+
+        # voxel-mapped outputs -> (destination xndarray, scatter view, raw file)
+        self.destinations = OrderedDict()
+        # ROI-level outputs -> list of (ROI id, xndarray)
+        self.roi_outputs = OrderedDict()
+        self.failed = set()
+
+    def get_output_file_name(self, output_name):
+        output_fn = op.join(self.output_dir, output_name + self.ext)
+        return add_prefix(output_fn, self.prefix)
+
+    def add(self, roi_data, outputs):
+        """Merge the outputs of one ROI
+
+        Args:
+            roi_data (~pyhrf.core.FmriData): the ROI data set
+            outputs (dict of ~pyhrf.ndarray.xndarray): the ROI outputs
+        """
+        roi_id = roi_data.get_roi_id()
+        for output_name, c in outputs.iteritems():
+            if output_name in self.failed:
+                continue
+            try:
+                if c.has_axis('voxel'):
+                    if output_name not in self.destinations:
+                        self.destinations[output_name] = \
+                            self._open_destination(output_name, c)
+                    scatter_view = self.destinations[output_name][1]
+                    flat_axis = c.get_axis_id('voxel')
+                    scatter_view[(slice(None),) * flat_axis +
+                                 tuple(roi_data.np_roi_mask)] = c.data
+                else:
+                    self.roi_outputs.setdefault(output_name, []).append(
+                        (roi_id, c))
+            except Exception:
+                logger.error('Could not merge outputs for %s', output_name,
+                             exc_info=True)
+                self.failed.add(output_name)
+                self._discard_destination(output_name)
+
+    def _open_destination(self, output_name, c):
+        flat_axis = c.get_axis_id('voxel')
+        axes = c.axes_names[:flat_axis] + self.target_axes + \
+            c.axes_names[flat_axis + 1:]
+        shape = c.data.shape[:flat_axis] + self.spatial_shape + \
+            c.data.shape[flat_axis + 1:]
+        domains = c.axes_domains.copy()
+        domains.pop('voxel')
+        domains.update((a, np.arange(n)) for a, n in zip(self.target_axes,
+                                                         self.spatial_shape))
+
+        # virtual zero array (all items share the same memory), only used to
+        # set axes and write the header:
+        zero = np.zeros(1, dtype=c.data.dtype)
+        dest = xndarray(as_strided(zero, shape=shape,
+                                   strides=(0,) * len(shape)),
+                        axes, domains, c.value_label, meta_data=c.meta_data)
+        dest.set_MRI_orientation()
+        output_fn = self.get_output_file_name(output_name)
+
+        data = None
+        raw_fn = None
+        if self.in_place:
+            from nibabel.nifti1 import Nifti1Header
+            self._save(dest, output_fn)
+            fheader = open(output_fn, 'rb')
+            header = Nifti1Header.from_fileobj(fheader)
+            fheader.close()
+            slope, inter = header.get_slope_inter()
+            if header.get_data_shape() == dest.data.shape and \
+                    slope in (None, 1.) and inter in (None, 0.):
+                data = np.memmap(output_fn, dtype=header.get_data_dtype(),
+                                 mode='r+', offset=header.get_data_offset(),
+                                 shape=dest.data.shape, order='F')
+        if data is None:
+            raw_fn = output_fn + '.partial'
+            data = np.memmap(raw_fn, dtype=c.data.dtype, mode='w+',
+                             shape=dest.data.shape)
+        dest.data = data
+        scatter_view = data.transpose([dest.axes_names.index(a) for a in axes])
+        return dest, scatter_view, raw_fn
+
+    def _discard_destination(self, output_name):
+        if output_name in self.destinations:
+            raw_fn = self.destinations.pop(output_name)[2]
+            for fn in [raw_fn, self.get_output_file_name(output_name)]:
+                if fn is not None and op.exists(fn):
+                    os.remove(fn)
+
+    def _save(self, c, output_fn):
+        logger.debug('Save output to %s', output_fn)
+        try:
+            if c.meta_data:
+                tmp_meta_data = (self.meta_data[0], self.meta_data[1].copy())
+                tmp_meta_data[1]["descrip"] = c.meta_data[1]["descrip"]
+                c.meta_data = tmp_meta_data
+                c.save(output_fn, set_MRI_orientation=True)
+            else:
+                c.save(output_fn, meta_data=self.meta_data,
+                       set_MRI_orientation=True)
+        except Exception:
+            print 'Could not save output "%s", error stack was:' % output_fn
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            traceback.print_exception(exc_type, exc_value, exc_traceback,
+                                      limit=4, file=sys.stdout)
+
+    def close(self):
+        """Finalize all outputs
+
+        Return: a tuple (dictionary of outputs, output file names)
+        """
+        coutputs = {}
+        output_fns = []
+
+        for output_name, (dest, _, raw_fn) in self.destinations.iteritems():
+            output_fn = self.get_output_file_name(output_name)
+            dest.data.flush()
+            if raw_fn is not None:
+                self._save(dest, output_fn)
+                os.remove(raw_fn)
+            output_fns.append(output_fn)
+            coutputs[output_name] = dest
+
+        for output_name, roi_outputs in self.roi_outputs.iteritems():
+            irois = [roi_id for roi_id, _ in roi_outputs]
+            logger.debug('Merge as stack (%d elements)...', len(irois))
+            try:
+                dest_c = stack_cuboids([roi_outputs[i][1]
+                                        for i in np.argsort(irois)],
+                                       domain=sorted(irois), axis='ROI')
+            except Exception:
+                logger.error('Could not merge outputs for %s', output_name,
+                             exc_info=True)
+                continue
+            output_fn = self.get_output_file_name(output_name)
+            self._save(dest_c, output_fn)
+            output_fns.append(output_fn)
+            coutputs[output_name] = dest_c
+
+        return coutputs, output_fns
+
+
 class FMRIAnalyser(xmlio.XmlInitable):
 
     P_OUTPUT_PREFIX = 'outputPrefix'
@@ -31,6 +307,9 @@ class FMRIAnalyser(xmlio.XmlInitable):
         P_OUTPUT_PREFIX: 'Tag to prefix every output name',
     }
 
+    # directory where ROI results are checkpointed (see set_checkpoint_dir)
+    checkpoint_dir = None
+
     def __init__(self, outputPrefix='', roiAverage=False, pass_error=True,
                  gzip_outputs=False):
         xmlio.XmlInitable.__init__(self)
@@ -51,10 +330,102 @@ class FMRIAnalyser(xmlio.XmlInitable):
     def set_gzip_outputs(self, gzip_outputs):
         self.gzip_outputs = gzip_outputs
 
+    def set_checkpoint_dir(self, checkpoint_dir):
+        """Checkpoint the result of each ROI analysis in *checkpoint_dir*
+
+        Each ROI result is saved as soon as the ROI is analysed, in a file
+        keyed by the ROI id and by a hash of the analyser configuration
+        (see :meth:`get_config_hash`). When a treatment is run again with
+        the same checkpoint directory, ROIs that already have a result are
+        not analysed again.
+
+        Args:
+            checkpoint_dir (str): directory of ROI results (created if
+                needed). If None, checkpointing is disabled.
+        """
+        if checkpoint_dir is not None and not op.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        self.checkpoint_dir = checkpoint_dir
+
+    def get_config_hash(self):
+        """Hash of the analyser configuration, used to key ROI checkpoints"""
+        config = xmlio.to_xml(self) + str(self.get_nb_iterations())
+        return hashlib.md5(config).hexdigest()[:12]
+
+    def get_roi_checkpoint_file(self, roiData, tag='result'):
+        """Checkpoint file of the ROI analysis of *roiData*
+
+        Args:
+            roiData (~pyhrf.core.FmriData): parcel-specific fMRI data set
+            tag (str): kind of checkpoint ('result' for the final ROI
+                result)
+
+        Return:
+            str
+        """
+        fn = 'roi_%04d_%s_%s.pck' % (roiData.get_roi_id(),
+                                     self.get_config_hash(), tag)
+        return op.join(self.checkpoint_dir, fn)
+
+    def load_roi_result(self, roiData):
+        """Load the checkpointed result of the ROI analysis of *roiData*
+
+        Return:
+            tuple(FmriData, output of analyse_roi, str) as returned by
+            :meth:`analyse_roi_wrap`, or None if there is no valid checkpoint
+        """
+        if self.checkpoint_dir is None:
+            return None
+        fn = self.get_roi_checkpoint_file(roiData)
+        if not op.exists(fn):
+            return None
+        try:
+            fin = open(fn, 'rb')
+            digest, result, report = cPickle.load(fin)
+            fin.close()
+        except Exception:
+            logger.warning('Could not load ROI checkpoint %s', fn,
+                           exc_info=True)
+            return None
+        if digest != roi_data_digest(roiData):
+            logger.warning('ROI checkpoint %s does not match ROI data, '
+                           'ignoring it', fn)
+            return None
+        logger.info('ROI %d already analysed, result loaded from %s',
+                    roiData.get_roi_id(), fn)
+        return (roiData, result, report)
+
+    def save_roi_result(self, roi_result):
+        """Checkpoint a ROI result as returned by :meth:`analyse_roi_wrap`
+
+        Results of crashed analyses are not saved.
+        """
+        roiData, result, report = roi_result
+        if self.checkpoint_dir is None or report != 'ok':
+            return
+        fn = self.get_roi_checkpoint_file(roiData)
+        logger.info('Saving result of ROI %d to %s', roiData.get_roi_id(), fn)
+        fout = open(fn + '.tmp', 'wb')
+        cPickle.dump((roi_data_digest(roiData), result, report), fout,
+                     cPickle.HIGHEST_PROTOCOL)
+        fout.close()
+        os.rename(fn + '.tmp', fn)
+
     def __call__(self, *args, **kargs):
         return self.analyse_roi_wrap(*args, **kargs)
 
-    def split_data(self, fdata, output_dir=None):
+    def split_data(self, fdata, output_dir=None, bold_storage=None):
+        """Split data into parcel-specific data sets
+
+        Args:
+            fdata (~pyhrf.core.FmriData): the input fMRI data set
+            output_dir (str): unused
+            bold_storage (str): where to store parcel BOLD signals
+                (see :meth:`~pyhrf.core.FmriData.roi_split`)
+
+        Return:
+            list of parcel-specific data sets
+        """
 
         if self.roiAverage:
             logger.info('Averaging ROI ...')
@@ -63,7 +434,7 @@ class FMRIAnalyser(xmlio.XmlInitable):
             logger.info('Explode data ...')
 
         fdata.build_graphs()
-        return fdata.roi_split()
+        return fdata.roi_split(bold_storage=bold_storage)
 
     def analyse_roi_wrap_bak(self, roiData):
 
@@ -89,12 +460,19 @@ class FMRIAnalyser(xmlio.XmlInitable):
 
     def analyse_roi_wrap(self, roiData):
         """
-        Wrap the analyse_roi method to catch potential exception
+        Wrap the analyse_roi method to catch potential exception.
+        The result of analyse_roi is packed by :meth:`make_roi_result`.
+        If a checkpoint directory is set, a ROI result already saved there
+        is reused and new results are saved.
         """
+        roi_result = self.load_roi_result(roiData)
+        if roi_result is not None:
+            return roi_result
+
         report = 'ok'
         if self.pass_error:
             try:
-                res = self.analyse_roi(roiData)
+                res = self.make_roi_result(self.analyse_roi(roiData))
             except Exception:
                 logger.error('!! Sampling crashed !!')
                 logger.error('Exception traceback :')
@@ -110,10 +488,47 @@ class FMRIAnalyser(xmlio.XmlInitable):
                 logger.error(report)
                 res = None
         else:
-            res = self.analyse_roi(roiData)
+            res = self.make_roi_result(self.analyse_roi(roiData))
 
+        self.save_roi_result((roiData, res, report))
         return (roiData, res, report)
 
+    def make_roi_result(self, result):
+        """Pack the output of :meth:`analyse_roi` into what is returned by
+        :meth:`analyse_roi_wrap`.
+
+        Estimation objects providing a getOutputs method (eg samplers) are
+        replaced by a :class:`ROIResult` holding only their outputs, so that
+        they do not have to be transferred from workers nor pickled. Other
+        results are returned as is.
+        """
+        if result is not None and hasattr(result, 'getOutputs') and \
+                not isinstance(result, ROIResult):
+            return ROIResult.from_outputs(result.getOutputs())
+        return result
+
+    def get_nb_iterations(self):
+        """Number of iterations run by the estimation method (1 if not iterative)."""
+        return 1
+
+    def estimate_roi_cost(self, roiData):
+        """Rough estimate of the computation cost of analysing *roiData*
+
+        The cost is taken proportional to nb voxels x nb scans x nb conditions
+        x nb iterations. It is only used to schedule ROI analyses, so only
+        its relative value between ROIs matters.
+
+        Args:
+            roiData (~pyhrf.core.FmriData): parcel-specific fMRI data set
+
+        Return:
+            float
+        """
+        if isinstance(roiData, FmriGroupData):
+            return sum(self.estimate_roi_cost(d) for d in roiData.data_subjects)
+        return (float(roiData.get_nb_vox_in_mask()) * roiData.bold.shape[0] *
+                roiData.nbConditions * self.get_nb_iterations())
+
     def analyse_roi(self, roiData):
         raise NotImplementedError('%s does not implement roi analysis.'
                                   % self.__class__)
@@ -158,64 +573,6 @@ class FMRIAnalyser(xmlio.XmlInitable):
 
         return results
 
-    def make_outputs_single_subject(self, data_rois, irois, all_outputs,
-                                    targetAxes, ext, meta_data, output_dir):
-
-        coutputs = {}
-        output_fns = []
-
-        roi_masks = [(data_roi.roiMask != data_roi.backgroundLabel)
-                     for data_roi in data_rois]
-        np_roi_masks = [np.where(roi_mask) for roi_mask in roi_masks]
-
-        for output_name, roi_outputs in all_outputs.iteritems():
-            logger.info('Merge output %s ...', output_name)
-            try:
-                if roi_outputs[0].has_axis('voxel'):
-                    logger.debug('Merge as expansion ...')
-                    dest_c = None
-                    for i_roi, c in enumerate(roi_outputs):
-                        dest_c = c.expand(roi_masks[i_roi],
-                                          'voxel', targetAxes,
-                                          dest=dest_c, do_checks=False,
-                                          m=np_roi_masks[i_roi])
-                else:
-                    logger.debug('Merge as stack (%d elements)...', len(irois))
-                    c_to_stack = [roi_outputs[i] for i in np.argsort(irois)]
-                    # print 'c_to_stack:', c_to_stack
-                    # print 'sorted(irois):', sorted(irois)
-                    dest_c = stack_cuboids(c_to_stack, domain=sorted(irois),
-                                           axis='ROI')
-            except Exception, e:
-                print "Could not merge outputs for %s" % output_name
-                print "Exception was:"
-                print e
-                # raise e #stop here
-            if 0 and dest_c is not None:
-                print '-> ', dest_c.data.shape
-            output_fn = op.join(output_dir, output_name + ext)
-            output_fn = add_prefix(output_fn, self.outPrefix)
-            output_fns.append(output_fn)
-            logger.debug('Save output %s to %s', output_name, output_fn)
-            try:
-                if dest_c.meta_data:
-                    tmp_meta_data = (meta_data[0], meta_data[1].copy())
-                    tmp_meta_data[1]["descrip"] = dest_c.meta_data[1]["descrip"]
-                    dest_c.meta_data = tmp_meta_data
-                    dest_c.save(output_fn, set_MRI_orientation=True)
-                else:
-                    dest_c.save(output_fn, meta_data=meta_data,
-                                set_MRI_orientation=True)
-            except Exception:
-                print 'Could not save output "%s", error stack was:' \
-                    % output_name
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                traceback.print_exception(exc_type, exc_value, exc_traceback,
-                                          limit=4, file=sys.stdout)
-            coutputs[output_name] = dest_c
-
-        return coutputs, output_fns
-
     def make_outputs_multi_subjects(self, data_rois, irois, all_outputs,
                                     targetAxes, ext, meta_data, output_dir):
 
@@ -283,15 +640,65 @@ class FMRIAnalyser(xmlio.XmlInitable):
 
     def outputResults(self, results, output_dir, filter='.\A',):
         """
+        Merge and save the outputs of all ROI analyses.
+
+        *results* may be any iterable, eg a generator yielding ROI results as
+        they are computed. Outputs of single-subject analyses are merged on
+        the fly (see ROIOutputsWriter).
+
         Return: a tuple (dictionary of outputs, output file names)
         """
         if output_dir is None:
             return {}, []
-        # print results
-        if not isinstance(results[0][0], (FmriData, FmriGroupData)):
-            self.outputResults_back_compat(results, output_dir, filter)
+
+        results = iter(results)
+        first_result = next(results, None)
+        if first_result is None:
+            logger.error('No result to treat. Did everything crash ?')
+            return {}, []
+        results = itertools.chain([first_result], results)
+
+        if not isinstance(first_result[0], (FmriData, FmriGroupData)):
+            self.outputResults_back_compat(list(results), output_dir, filter)
+            return {}, []
+
+        if isinstance(first_result[0], FmriGroupData):
+            return self.outputResults_multi_subjects(list(results), output_dir)
+
+        logger.info('Building outputs ...')
+        writer = None
+        nb_results = 0
+        for roi_data, result, report in results:
+            roi_id = roi_data.get_roi_id()
+            # Handle analyses that crashed
+            if report != 'ok':
+                logger.error('-> Sampling crashed, roi %d!', roi_id)
+                logger.error(report)
+                continue
+            elif result is None:
+                logger.error('-> Sampling crashed (result is None), roi %d!',
+                             roi_id)
+                continue
+
+            if writer is None:
+                writer = ROIOutputsWriter(output_dir, self.outPrefix,
+                                          roi_data.spatial_shape,
+                                          roi_data.meta_obj, self.gzip_outputs)
+            if hasattr(result, 'getOutputs'):
+                writer.add(roi_data, result.getOutputs())
+            else:
+                writer.add(roi_data, result)
+            nb_results += 1
+
+        if writer is None:
+            logger.error('No result to treat. Did everything crash ?')
             return {}, []
 
+        logger.info('Outputs built from %d results', nb_results)
+        return writer.close()
+
+    def outputResults_multi_subjects(self, results, output_dir):
+
         logger.info('Building outputs from %d results ...', len(results))
         logger.debug('results :')
         logger.debug(results)
@@ -325,14 +732,9 @@ class FMRIAnalyser(xmlio.XmlInitable):
         data_rois = [r[0] for r in results]
         irois = [d.get_roi_id() for d in data_rois]
 
-        if isinstance(results[0][0], FmriData):
-            return self.make_outputs_single_subject(data_rois, irois, all_outputs,
-                                                    targetAxes, ext, meta_data,
-                                                    output_dir)
-        else:
-            return self.make_outputs_multi_subjects(data_rois, irois, all_outputs,
-                                                    targetAxes, ext, meta_data,
-                                                    output_dir)
+        return self.make_outputs_multi_subjects(data_rois, irois, all_outputs,
+                                                targetAxes, ext, meta_data,
+                                                output_dir)
 
     def enable_draft_testing(self):
         raise NotImplementedError(
@@ -9,10 +9,11 @@ import numpy as np
 
 import pyhrf
 
-from pyhrf.ui.analyser_ui import FMRIAnalyser
+from pyhrf.ui.analyser_ui import FMRIAnalyser, roi_data_digest
 from pyhrf.jde.beta import BetaSampler
 from pyhrf.jde.nrl.bigaussian import NRLSampler  # , NRLSamplerWithRelVar
 from pyhrf.jde.models import BOLDGibbsSampler
+from pyhrf.jde.multichain import MultiChainSampler
 from pyhrf.xmlio import XmlInitable
 from pyhrf.tools._io import read_volume
 
@@ -46,13 +47,18 @@ class JDEMCMCAnalyser(JDEAnalyser):
     P_DRIFT_LFD_PARAM = 'driftParam'
     P_DRIFT_LFD_TYPE = 'driftType'
     P_RANDOM_SEED = 'randomSeed'
+    P_NB_CHAINS = 'nb_chains'
+
+    # nb of iterations between two checkpoints of the sampling state, when
+    # a checkpoint directory is set (see FMRIAnalyser.set_checkpoint_dir)
+    sampling_checkpoint_pace = 100
 
     if pyhrf.__usemode__ == pyhrf.DEVEL:
         parametersToShow = [P_DT, P_DTMIN, P_DRIFT_LFD_TYPE, P_DRIFT_LFD_PARAM,
-                            P_RANDOM_SEED, P_SAMPLER]
+                            P_RANDOM_SEED, P_NB_CHAINS, P_SAMPLER]
     elif pyhrf.__usemode__ == pyhrf.ENDUSER:
         parametersToShow = [P_DTMIN, P_DT, P_DRIFT_LFD_TYPE,
-                            P_DRIFT_LFD_PARAM, P_SAMPLER]
+                            P_DRIFT_LFD_PARAM, P_NB_CHAINS, P_SAMPLER]
 
     parametersComments = {
         P_DTMIN: 'Minimum time resolution for the oversampled estimated signal',
@@ -65,12 +71,15 @@ class JDEMCMCAnalyser(JDEAnalyser):
         'cut-off period in second.',
         P_DRIFT_LFD_TYPE: 'Either "cosine" or "polynomial" or "None"',
         P_SAMPLER: 'Set of parameters for the sampling scheme',
+        P_NB_CHAINS: 'Number of independent sampling chains run on each '
+        'parcel (in parallel processes).\nTheir posterior estimates are '
+        'pooled and their Rhat is reported.',
     }
 
     def __init__(self, sampler=BOLDGibbsSampler(), osfMax=4, dtMin=.4,
                  dt=.6, driftParam=4, driftType='polynomial',
                  outputPrefix='jde_mcmc_', randomSeed=None, pass_error=True,
-                 copy_sampler=True):
+                 copy_sampler=True, nb_chains=1):
 
         XmlInitable.__init__(self)
         JDEAnalyser.__init__(self, outputPrefix, pass_error=pass_error)
@@ -82,26 +91,43 @@ class JDEMCMCAnalyser(JDEAnalyser):
         self.driftLfdParam = driftParam
         self.driftLfdType = driftType
         self.copy_sampler = copy_sampler
+        self.nb_chains = nb_chains
 
     def enable_draft_testing(self):
         self.sampler.set_nb_iterations(3)
 
+    def get_nb_iterations(self):
+        return self.sampler.nbIterations
+
     def analyse_roi(self, atomData):
         """
         Launch the JDE Gibbs Sampler on a parcel-specific data set *atomData*
         Args:
             - atomData (pyhrf.core.FmriData): parcel-specific data
         Returns:
-            JDE sampler object
+            JDE sampler object (replaced by a ROIResult holding its outputs
+            in :meth:`~pyhrf.ui.analyser_ui.FMRIAnalyser.analyse_roi_wrap`),
+            or :class:`~pyhrf.jde.multichain.MultiChainSampler` if several
+            chains are run
         """
 
         if self.copy_sampler:
             sampler = copyModule.deepcopy(self.sampler)
         else:
             sampler = self.sampler
+        if self.nb_chains > 1:
+            sampler = MultiChainSampler(sampler, self.nb_chains)
         sInput = self.packSamplerInput(atomData)
         sampler.linkToData(sInput)
 
+        if self.checkpoint_dir is not None:
+            sampler.set_checkpoint(self.get_roi_checkpoint_file(atomData,
+                                                                'sampler'),
+                                   self.sampling_checkpoint_pace,
+                                   roi_data_digest(atomData))
+        else:
+            sampler.set_checkpoint(None)
+
         logger.info('Treating region %d', atomData.get_roi_id())
         sampler.runSampling(atomData)
         logger.info('Cleaning memory ...')
@@ -7,7 +7,6 @@ import shutil
 import time
 import string
 import cPickle
-import itertools
 import cProfile
 import logging
 
@@ -192,27 +191,21 @@ class FMRITreatment(xmlio.XmlInitable):
         logger.info('End date is : %s', time.strftime('%c'))
         return result
 
-    def run(self, parallel=None, n_jobs=None):
+    def run(self, parallel=None, n_jobs=None, checkpoint_dir=None):
         """
-        Run the analysis: load data, run estimation, output results
+        Run the analysis: load data, run estimation, output results.
+        If *checkpoint_dir* is given, each ROI result is saved there as soon
+        as it is computed, and ROIs already analysed in a previous run are
+        skipped (see FMRIAnalyser.set_checkpoint_dir).
         """
+        if checkpoint_dir is not None:
+            self.analyser.set_checkpoint_dir(checkpoint_dir)
+
         if parallel is None:
             result = self.execute()
         elif parallel == 'local':
+            from pyhrf.parallel import imap_rois_local
             cfg_parallel = pyhrf.cfg['parallel-local']
-            try:
-                from joblib import Parallel, delayed
-            except ImportError:
-                raise Exception('Can not import joblib. It is required to '
-                                'enable parallel processing on a local machine.')
-
-            effective_level = logger.getEffectiveLevel()
-            if effective_level == logging.DEBUG:
-                parallel_verb = 11
-            elif effective_level == logging.INFO:
-                parallel_verb = 2
-            else:
-                parallel_verb = 0
 
             if n_jobs is None:
                 if cfg_parallel["nb_procs"]:
@@ -220,10 +213,32 @@ class FMRITreatment(xmlio.XmlInitable):
                 else:
                     n_jobs = available_cpu_count()
 
-            p = Parallel(n_jobs=n_jobs, verbose=parallel_verb)
-            result = p(delayed(exec_t)(t) for t in self.split(output_dir=None))
-            # join list of lists:
-            result = list(itertools.chain.from_iterable(result))
+            rois_data = self.analyser.split_data(self.data,
+                                                 bold_storage='shared')
+            result = [None] * len(rois_data)
+
+            def stream_results():
+                tIni = time.time()
+                for iresult, (iroi, roi_result) in \
+                        enumerate(imap_rois_local(self.analyser, rois_data,
+                                                  n_jobs)):
+                    result[iroi] = roi_result
+                    logger.info('ROI %d done (%d/%d), elapsed time: %s',
+                                rois_data[iroi].get_roi_id(), iresult + 1,
+                                len(rois_data),
+                                format_duration(time.time() - tIni))
+                    yield roi_result
+
+            # outputs are merged as soon as ROI results come:
+            results_stream = stream_results()
+            outputs = self.output(results_stream, dump_result=False,
+                                  outputs=self.make_outputs)
+            for _ in results_stream:
+                pass
+            logger.info('Retrieved %d results', len(result))
+            if self.result_dump_file is not None:
+                self.pickle_result(result)
+            return outputs
 
         elif parallel == 'LAN':
 
@@ -692,6 +707,12 @@ def run_pyhrf_cmd_treatment(cfg_cmd, exec_cmd, default_cfg_file,
                       help='Parallel processing. Choices are %s'
                       % string.join(parallel_choices, ', '))
 
+    parser.add_option('-k', '--checkpoint-dir', metavar='DIRECTORY',
+                      dest='checkpoint_dir', default=None,
+                      help='Save each ROI result in DIRECTORY as soon as it is '
+                      'computed. If the treatment is run again with the same '
+                      'directory, ROIs already analysed are skipped.')
+
     (options, args) = parser.parse_args()
 
     # pyhrf.verbose.set_verbosity(options.verbose)
@@ -723,6 +744,8 @@ def run_pyhrf_cmd_treatment(cfg_cmd, exec_cmd, default_cfg_file,
                 fOut.close()
 
     treatment.analyser.set_pass_errors(not options.stop_on_error)
+    if options.checkpoint_dir is not None:
+        treatment.analyser.set_checkpoint_dir(options.checkpoint_dir)
 
     if options.parallel is not None:
 
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import traceback
 
 from time import time
 from collections import OrderedDict
@@ -12,6 +13,8 @@ from pyhrf.ndarray import xndarray
 from pyhrf.ui.jde import JDEAnalyser
 from pyhrf.vbjde.vem_tools import roc_curve
 from pyhrf.vbjde.vem_bold import jde_vem_bold
+from pyhrf.vbjde.vem_bold_parcels import jde_vem_bold_parcels
+from pyhrf.vbjde.design import DesignCache, design_key
 from pyhrf.vbjde.vem_bold_constrained import Main_vbjde_Python_constrained
 from pyhrf.xmlio import XmlInitable
 from pyhrf.tools import format_duration
@@ -71,6 +74,8 @@ class JDEVEMAnalyser(JDEAnalyser):
         zero_constraint (bool): if true, add zeros at the beginning and the end of the HRF.
         output_drifts (bool): save the estimated drifts.
         drifts_type (str): type of the drift basis ('poly' or 'cos'). 
+        batch_parcels (int): number of parcels analyzed together by the multi-parcel VEM engine (only with fast VEM).
+            If lower than 2, parcels are analyzed one at a time.
     """
 
     parametersComments = {
@@ -103,6 +108,7 @@ class JDEVEMAnalyser(JDEAnalyser):
         'MiniVemFlag': 'if true, estimate the best initialisation of MixtParam and gamma_h',
         'NbItMiniVem': 'number of iterations in Mini VEM algorithm',
         'constrained': 'adding constrains: positivity and norm = 1 ',
+        'batch_parcels': 'number of parcels analyzed together (fast VEM only, disabled if lower than 2)',
         }
 
     parametersToShow = ['dt', 'hrfDuration', 'nItMax', 'nItMin',
@@ -123,7 +129,7 @@ class JDEVEMAnalyser(JDEAnalyser):
                  estimateLabels=True, LabelsFilename=None,
                  MFapprox=False, estimateMixtParam=True, constrained=False,
                  InitVar=0.5, InitMean=2.0, MiniVemFlag=False, NbItMiniVem=5,
-                 zero_constraint=True, output_drifts=False, drifts_type="poly"):
+                 zero_constraint=True, output_drifts=False, drifts_type="poly", batch_parcels=0):
 
         XmlInitable.__init__(self)
         JDEAnalyser.__init__(self, outputPrefix='jde_vem_')
@@ -161,6 +167,8 @@ class JDEVEMAnalyser(JDEAnalyser):
         self.zero_constraint = zero_constraint
         self.output_drifts = output_drifts
         self.drifts_type = drifts_type
+        self.batch_parcels = batch_parcels
+        self._design_cache = None
 
         logger.info("VEM analyzer:")
         logger.info(" - estimate sigma H: %s", str(self.estimateSigmaH))
@@ -168,6 +176,9 @@ class JDEVEMAnalyser(JDEAnalyser):
         logger.info(" - hyper_prior_sigma_H: %f", self.hyper_prior_sigma_H)
         logger.info(" - estimate drift: %s", str(self.estimateDrifts))
 
+    def get_nb_iterations(self):
+        return self.nItMax
+
     def analyse_roi(self, roiData):
         """ROI analysis of the fMRI data.
         
@@ -189,24 +200,20 @@ class JDEVEMAnalyser(JDEAnalyser):
         logger.info("JDE VEM - roi %d, nvox=%d, nconds=%d, nItMax=%d", rid, nvox, len(Onsets), self.nItMax)
 
         self.contrasts.pop('dummy_example', None)
-        cNames = roiData.paradigm.get_stimulus_names()
         graph = roiData.get_graph()
 
         t_start = time()
 
+        vem_results = None
         if self.fast:
             logger.info("fast VEM with drift estimation" + ("and a constraint"*self.constrained))
 
-            (nb_iter, nrls_mean, hrf_mean, hrf_covar, labels_proba, noise_var, nrls_class_mean, nrls_class_var, beta,
-             drift_coeffs, drift, contrasts_mean, contrasts_var, _, _, nrls_covar, _, density_ratio,
-             density_ratio_cano, density_ratio_diff, density_ratio_prod, ppm_a_nrl, ppm_g_nrl, ppm_a_contrasts,
-             ppm_g_contrasts, variation_coeff, free_energy, free_energy_crit, beta_list, delay_of_response,
-             delay_of_undershoot, dispersion_of_response, dispersion_of_undershoot, ratio_resp_under,
-             delay) = jde_vem_bold(graph, data, Onsets, durations, self.hrfDuration, self.nbClasses, TR, self.beta,
-                                   self.dt, self.estimateSigmaH, self.sigmaH, self.nItMax, self.nItMin,
-                                   self.estimateBeta, self.contrasts, self.computeContrast, self.hyper_prior_sigma_H,
-                                   self.estimateHRF, constrained=self.constrained, zero_constraint=self.zero_constraint,
-                                   drifts_type=self.drifts_type)
+            vem_results = jde_vem_bold(graph, data, Onsets, durations, self.hrfDuration, self.nbClasses, TR,
+                                       self.beta, self.dt, self.estimateSigmaH, self.sigmaH, self.nItMax,
+                                       self.nItMin, self.estimateBeta, self.contrasts, self.computeContrast,
+                                       self.hyper_prior_sigma_H, self.estimateHRF, constrained=self.constrained,
+                                       zero_constraint=self.zero_constraint, drifts_type=self.drifts_type,
+                                       design_cache=self.get_design_cache(roiData))
 
         elif self.estimateDrifts:  # if not self.fast
             logger.info("not fast VEM")
@@ -220,7 +227,127 @@ class JDEVEMAnalyser(JDEAnalyser):
         self.analysis_duration = time() - t_start
         logger.info('JDE VEM analysis took: %s', format_duration(self.analysis_duration))
 
+        return self.pack_outputs(roiData, vem_results)
+
+    def get_design_cache(self, roiData):
+        """Get the paradigm-dependent VEM products, shared by all the ROIs with the same paradigm.
+
+        Args:
+            roiData (:obj:`~pyhrf.core.FmriData`): fMRI data to be analyzed.
+
+        Returns:
+            :obj:`~pyhrf.vbjde.design.DesignCache`: design cache of the ROI paradigm.
+        """
+        design_args = (roiData.get_joined_onsets(), roiData.get_joined_durations(), roiData.bold.shape[0],
+                       self.hrfDuration, roiData.tr, self.dt, self.drifts_type,
+                       self.estimateHRF and self.zero_constraint)
+        if self._design_cache is None or self._design_cache.key != design_key(*design_args):
+            self._design_cache = DesignCache.from_paradigm(*design_args)
+        return self._design_cache
+
+    def analyse(self, data, output_dir=None):
+        """Launch the analysis, running the multi-parcel VEM engine by batches of `batch_parcels` ROIs if enabled.
+
+        See :meth:`~pyhrf.ui.analyser_ui.FMRIAnalyser.analyse`.
+        """
+        if not self.fast or self.batch_parcels < 2:
+            return JDEAnalyser.analyse(self, data, output_dir)
+
+        logger.info("Split data ...")
+        explodedData = self.split_data(data, output_dir)
+        logger.info("Data splitting returned %d rois", len(explodedData))
+        # ROIs already checkpointed are not analysed again
+        results = [self.load_roi_result(d) for d in explodedData]
+        todo = [i for i, r in enumerate(results) if r is None]
+        for ibatch in xrange(0, len(todo), self.batch_parcels):
+            batch = todo[ibatch:ibatch + self.batch_parcels]
+            batch_results = self.analyse_rois_batch([explodedData[i] for i in batch])
+            for i, roi_result in zip(batch, batch_results):
+                results[i] = roi_result
+        return results
+
+    def analyse_rois_batch(self, roisData):
+        """Analyse several ROIs at once with the multi-parcel VEM engine.
+
+        If the batch analysis crashes and errors are passed, every ROI of the
+        batch is analysed again on its own.
+
+        Args:
+            roisData (list of :obj:`~pyhrf.core.FmriData`): parcel-specific data sets sharing the same paradigm.
+
+        Returns:
+            list of tuple(:obj:`~pyhrf.core.FmriData`, :obj:`dict`, :obj:`str`): see
+            :meth:`~pyhrf.ui.analyser_ui.FMRIAnalyser.analyse_roi_wrap`.
+        """
+        roiData = roisData[0]
+        Onsets = roiData.get_joined_onsets()
+        logger.info("JDE VEM - batch of %d rois, nvox=%d, nconds=%d, nItMax=%d", len(roisData),
+                    sum(d.get_nb_vox_in_mask() for d in roisData), len(Onsets), self.nItMax)
+
+        self.contrasts.pop('dummy_example', None)
+
+        t_start = time()
+        try:
+            all_vem_results = jde_vem_bold_parcels(
+                [d.get_graph() for d in roisData], [d.bold for d in roisData], Onsets,
+                roiData.get_joined_durations(), self.hrfDuration, self.nbClasses, roiData.tr, self.beta, self.dt,
+                self.estimateSigmaH, self.sigmaH, self.nItMax, self.nItMin, self.estimateBeta, self.contrasts,
+                self.computeContrast, self.hyper_prior_sigma_H, self.estimateHRF, constrained=self.constrained,
+                zero_constraint=self.zero_constraint, drifts_type=self.drifts_type,
+                design_cache=self.get_design_cache(roiData)
+            )
+        except Exception:
+            if not self.pass_error:
+                raise
+            logger.error('!! Multi-parcel VEM crashed, analysing rois one by one !!', exc_info=True)
+            return [self.analyse_roi_wrap(d) for d in roisData]
+
+        batch_duration = time() - t_start
+        logger.info('JDE VEM analysis of %d rois took: %s', len(roisData), format_duration(batch_duration))
+
+        # The batch duration is shared between ROIs according to their size
+        nb_vox_total = float(sum(d.get_nb_vox_in_mask() for d in roisData))
+        results = []
+        for d, vem_results in zip(roisData, all_vem_results):
+            self.analysis_duration = batch_duration * d.get_nb_vox_in_mask() / nb_vox_total
+            if not self.pass_error:
+                results.append((d, self.pack_outputs(d, vem_results), 'ok'))
+                continue
+            try:
+                results.append((d, self.pack_outputs(d, vem_results), 'ok'))
+            except Exception:
+                report = traceback.format_exc()
+                logger.error('!! Output packing crashed for roi %d !!', d.get_roi_id())
+                logger.error(report)
+                results.append((d, None, report))
+
+        for roi_result in results:
+            self.save_roi_result(roi_result)
+        return results
+
+    def pack_outputs(self, roiData, vem_results):
+        """Pack the results of the VEM analysis of one ROI.
+
+        Args:
+            roiData (:obj:`~pyhrf.core.FmriData`): analyzed fMRI data.
+            vem_results (tuple): output of :func:`~pyhrf.vbjde.vem_bold.jde_vem_bold`.
+
+        Returns:
+            :obj:`dict` of :obj:`~pyhrf.ndarray.xndarray`: packed outputs.
+
+        """
+        Onsets = roiData.get_joined_onsets()
+        nvox = roiData.get_nb_vox_in_mask()
+        cNames = roiData.paradigm.get_stimulus_names()
+
         if self.fast:
+            (nb_iter, nrls_mean, hrf_mean, hrf_covar, labels_proba, noise_var, nrls_class_mean, nrls_class_var, beta,
+             drift_coeffs, drift, contrasts_mean, contrasts_var, _, _, nrls_covar, _, density_ratio,
+             density_ratio_cano, density_ratio_diff, density_ratio_prod, ppm_a_nrl, ppm_g_nrl, ppm_a_contrasts,
+             ppm_g_contrasts, variation_coeff, free_energy, free_energy_crit, beta_list, delay_of_response,
+             delay_of_undershoot, dispersion_of_response, dispersion_of_undershoot, ratio_resp_under,
+             delay) = vem_results
+
             # OUTPUTS: Pack all outputs within a dict
             outputs = {}
             hrf_time = np.arange(len(hrf_mean)) * self.dt
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""Paradigm-dependent products of the VEM JDE models.
+
+The occurrence matrix :math:`X` and the drift basis :math:`P` only depend on
+the experimental paradigm, the TR and the HRF sampling. All the products that
+involve them and the noise structure :math:`\\Gamma` (:math:`X^{t}_{m} \\Gamma
+X_{m'}`, :math:`X^{t}_{m} \\Gamma P`, :math:`P^{t} \\Gamma P`) are therefore
+constant along the VEM iterations and can be shared by all the parcels of a
+subject. :class:`DesignCache` computes them lazily and keeps them until the
+noise structure changes.
+"""
+
+import logging
+
+import numpy as np
+
+import pyhrf.vbjde.vem_tools as vt
+
+from pyhrf.paradigm import ParadigmOperator
+from pyhrf.vbjde.noise import IdentityNoiseStruct, as_noise_struct
+
+
+logger = logging.getLogger(__name__)
+
+
+def design_key(onsets, durations, nb_scans, hrf_duration, tr, dt, drifts_type="poly", zero_constraint=False):
+    """Build a hashable key identifying the design built by :meth:`DesignCache.from_paradigm`.
+
+    Parameters
+    ----------
+    see :meth:`DesignCache.from_paradigm`
+
+    Returns
+    -------
+    key : tuple
+    """
+
+    paradigm = tuple((condition, np.asarray(onsets[condition], dtype=float).tostring(),
+                      np.asarray(durations[condition], dtype=float).tostring())
+                     for condition in onsets)
+    return (paradigm, nb_scans, float(hrf_duration), float(tr), float(dt), drifts_type, bool(zero_constraint))
+
+
+class DesignCache(object):
+    """Cache of the products of the occurrence matrix and the drift basis.
+
+    Parameters
+    ----------
+    occurence_matrix : ndarray, shape (nb_conditions, nb_scans, hrf_len) or ParadigmOperator
+    drift_basis : ndarray, shape (nb_scans, nb_drift_coeffs)
+    noise_struct : NoiseStruct or ndarray, shape (nb_scans, nb_scans), optional
+        defaults to white noise
+    X : dict or ParadigmOperator, optional
+        occurrence matrix of each condition without the zero constraint (as
+        returned by :func:`pyhrf.vbjde.vem_tools.create_conditions`)
+    condition_names : list, optional
+    key : tuple, optional
+        see :func:`design_key`
+    """
+
+    def __init__(self, occurence_matrix, drift_basis, noise_struct=None, X=None, condition_names=None, key=None):
+        self.occurence_matrix = occurence_matrix
+        self.drift_basis = drift_basis
+        self.X = X
+        self.condition_names = condition_names
+        self.key = key
+        if noise_struct is None:
+            noise_struct = IdentityNoiseStruct(occurence_matrix.shape[1])
+        self.noise_struct = as_noise_struct(noise_struct)
+        self._products = {}
+
+    @classmethod
+    def from_paradigm(cls, onsets, durations, nb_scans, hrf_duration, tr, dt, drifts_type="poly",
+                      zero_constraint=False, noise_struct=None, sparse_paradigm=True):
+        """Build the occurrence matrix and the drift basis of a paradigm.
+
+        Parameters
+        ----------
+        onsets : dict
+            dictionary of onsets for each condition.
+        durations : dict
+            dictionary of durations for each condition.
+        nb_scans : int
+        hrf_duration : float
+        tr : float
+        dt : float
+        drifts_type : str, optional
+            "poly" or "cos"
+        zero_constraint : bool, optional
+            if True, the first and last HRF coefficients are removed from the occurrence matrix
+        noise_struct : NoiseStruct or ndarray, optional
+        sparse_paradigm : bool, optional
+            if True, the occurrence matrix is a :class:`pyhrf.paradigm.ParadigmOperator`
+            instead of a dense array
+
+        Returns
+        -------
+        design_cache : DesignCache
+        """
+
+        hrf_len = np.int(np.ceil(hrf_duration / dt)) + 1
+        if sparse_paradigm:
+            X = ParadigmOperator.from_onsets(onsets, durations, nb_scans, hrf_len, tr, dt)
+            occurence_matrix = X
+            condition_names = list(onsets.keys())
+            if zero_constraint:
+                occurence_matrix = X.select_columns(slice(1, -1))
+        else:
+            X, occurence_matrix, condition_names = vt.create_conditions(onsets, durations, len(onsets), nb_scans,
+                                                                        hrf_len, tr, dt)
+            if zero_constraint:
+                occurence_matrix = occurence_matrix[:, :, 1:-1]
+
+        if drifts_type == "poly":
+            drift_basis = vt.poly_drifts_basis(nb_scans, 4, tr)
+        elif drifts_type == "cos":
+            drift_basis = vt.cosine_drifts_basis(nb_scans, 64, tr)
+        else:
+            raise Exception('drift type "%s" is not supported' % drifts_type)
+
+        key = design_key(onsets, durations, nb_scans, hrf_duration, tr, dt, drifts_type, zero_constraint)
+        return cls(occurence_matrix, drift_basis, noise_struct, X, condition_names, key)
+
+    def set_noise_struct(self, noise_struct):
+        """Change the noise structure, dropping the cached products if it differs from the current one."""
+        noise_struct = as_noise_struct(noise_struct)
+        unchanged = (noise_struct is self.noise_struct
+                     or (isinstance(noise_struct, IdentityNoiseStruct)
+                         and isinstance(self.noise_struct, IdentityNoiseStruct)
+                         and noise_struct.nb_scans == self.noise_struct.nb_scans))
+        if not unchanged:
+            logger.debug("Noise structure changed, clearing the design cache")
+            self._products.clear()
+        self.noise_struct = noise_struct
+
+    def _cached(self, name, compute):
+        if name not in self._products:
+            self._products[name] = compute()
+        return self._products[name]
+
+    @property
+    def gram(self):
+        """ndarray, shape (nb_conditions, nb_conditions, hrf_len, hrf_len): :math:`X^{t}_{m} \\Gamma X_{m'}`"""
+        return self._cached('gram', lambda: vt.design_gram_blocks(self.occurence_matrix, self.noise_struct))
+
+    @property
+    def om_drift(self):
+        """ndarray, shape (nb_conditions, hrf_len, nb_drift_coeffs): :math:`X^{t}_{m} \\Gamma P`"""
+        return self._cached('om_drift', lambda: vt.occurence_rdot(self.occurence_matrix,
+                                                                  self.noise_struct.apply(self.drift_basis)))
+
+    @property
+    def drift_gram_inv(self):
+        """ndarray, shape (nb_drift_coeffs, nb_drift_coeffs): :math:`(P^{t} \\Gamma P)^{-1}`"""
+        return self._cached('drift_gram_inv', lambda: np.linalg.inv(self.noise_struct.quad_form(self.drift_basis)))
+
+    @property
+    def drift_projector(self):
+        """ndarray, shape (nb_drift_coeffs, nb_scans): :math:`(P^{t} \\Gamma P)^{-1} P^{t} \\Gamma`"""
+        return self._cached('drift_projector', lambda: self.drift_gram_inv.dot(
+            self.noise_struct.apply(self.drift_basis).T))
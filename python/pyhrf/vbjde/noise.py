@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""Noise structures of the VEM JDE models.
+
+The kernels of :mod:`pyhrf.vbjde.vem_tools` only need products with the noise
+structure :math:`\\Lambda` (the inverse of the noise autocorrelation matrix,
+of shape (nb_scans, nb_scans)). The classes of this module provide these
+products without building the dense matrix when it has a simple structure:
+
+- :class:`IdentityNoiseStruct`: white noise (the default of the BOLD VEM),
+- :class:`DiagonalNoiseStruct`: independent noise with scan-dependent weights,
+- :class:`AR1NoiseStruct`: AR(1) noise whose inverse autocorrelation matrix
+  is tridiagonal,
+- :class:`DenseNoiseStruct`: any other matrix.
+
+All of them share the same interface: ``apply`` (:math:`\\Lambda x`),
+``quad_form`` (:math:`x^{t} \\Lambda y`), ``log_det`` and ``to_array``. Arrays
+always have the scans on their first axis.
+"""
+
+import numpy as np
+
+
+def is_identity(noise_struct):
+    """Check if the noise structure is the identity matrix (white noise).
+
+    Parameters
+    ----------
+    noise_struct : ndarray, shape (nb_scans, nb_scans)
+
+    Returns
+    -------
+    bool
+    """
+
+    return (noise_struct.ndim == 2 and noise_struct.shape[0] == noise_struct.shape[1]
+            and (noise_struct.diagonal() == 1).all()
+            and np.count_nonzero(noise_struct) == noise_struct.shape[0])
+
+
+def as_noise_struct(noise_struct):
+    """Return the noise structure object corresponding to `noise_struct`.
+
+    Parameters
+    ----------
+    noise_struct : NoiseStruct or ndarray, shape (nb_scans, nb_scans)
+        dense matrices are wrapped in the cheapest matching structure
+
+    Returns
+    -------
+    noise_struct : NoiseStruct
+    """
+
+    if isinstance(noise_struct, NoiseStruct):
+        return noise_struct
+
+    noise_struct = np.asarray(noise_struct)
+    if is_identity(noise_struct):
+        return IdentityNoiseStruct(noise_struct.shape[0])
+    if np.count_nonzero(noise_struct - np.diag(noise_struct.diagonal())) == 0:
+        return DiagonalNoiseStruct(noise_struct.diagonal())
+    return DenseNoiseStruct(noise_struct)
+
+
+class NoiseStruct(object):
+    """Base class of the noise structures.
+
+    Parameters
+    ----------
+    nb_scans : int
+    """
+
+    def __init__(self, nb_scans):
+        self.nb_scans = nb_scans
+
+    def apply(self, array):
+        """Computes :math:`\\Lambda x` for `array` of shape (nb_scans, ...)."""
+        raise NotImplementedError
+
+    def quad_form(self, left, right=None):
+        """Computes :math:`x^{t} \\Lambda y` contracting the first (scan) axis of `left` and `right`.
+
+        Parameters
+        ----------
+        left : ndarray, shape (nb_scans, ...)
+        right : ndarray, shape (nb_scans, ...), optional
+            defaults to `left`
+
+        Returns
+        -------
+        ndarray, shape left.shape[1:] + right.shape[1:]
+        """
+
+        if right is None:
+            right = left
+        return np.tensordot(left, self.apply(right), axes=(0, 0))
+
+    def log_det(self):
+        """Computes :math:`\\log \\left| \\Lambda \\right|`."""
+        raise NotImplementedError
+
+    def to_array(self):
+        """Returns the dense (nb_scans, nb_scans) matrix."""
+        return self.apply(np.identity(self.nb_scans))
+
+
+class IdentityNoiseStruct(NoiseStruct):
+    """White noise: :math:`\\Lambda = I_{N}`."""
+
+    def apply(self, array):
+        return array
+
+    def quad_form(self, left, right=None):
+        if right is None:
+            right = left
+        return np.tensordot(left, right, axes=(0, 0))
+
+    def log_det(self):
+        return 0.
+
+    def to_array(self):
+        return np.identity(self.nb_scans)
+
+
+class DiagonalNoiseStruct(NoiseStruct):
+    """Independent noise: :math:`\\Lambda = \\mathrm{diag}(w)`.
+
+    Parameters
+    ----------
+    weights : ndarray, shape (nb_scans,)
+    """
+
+    def __init__(self, weights):
+        self.weights = np.asarray(weights, dtype=float)
+        NoiseStruct.__init__(self, self.weights.size)
+
+    def apply(self, array):
+        return self.weights.reshape((-1,) + (1,) * (array.ndim - 1)) * array
+
+    def log_det(self):
+        return np.log(self.weights).sum()
+
+    def to_array(self):
+        return np.diag(self.weights)
+
+
+class AR1NoiseStruct(NoiseStruct):
+    """AR(1) noise: :math:`\\Lambda` is the inverse of the autocorrelation matrix :math:`\\rho^{|i-j|}`.
+
+    .. math::
+
+        \\Lambda = \\frac{1}{1 - \\rho^{2}} \\begin{pmatrix}
+        1 & -\\rho & & \\\\
+        -\\rho & 1 + \\rho^{2} & \\ddots & \\\\
+        & \\ddots & \\ddots & -\\rho \\\\
+        & & -\\rho & 1
+        \\end{pmatrix}
+
+    Parameters
+    ----------
+    nb_scans : int
+    rho : float
+        autoregressive coefficient, with :math:`|\\rho| < 1`
+    """
+
+    def __init__(self, nb_scans, rho):
+        if abs(rho) >= 1:
+            raise Exception('AR(1) coefficient must be in ]-1, 1[ (got %f)' % rho)
+        NoiseStruct.__init__(self, nb_scans)
+        self.rho = rho
+
+    def apply(self, array):
+        rho = self.rho
+        result = (1 + rho ** 2) * array
+        result[0] -= rho ** 2 * array[0]
+        result[-1] -= rho ** 2 * array[-1]
+        result[1:] -= rho * array[:-1]
+        result[:-1] -= rho * array[1:]
+        return result / (1 - rho ** 2)
+
+    def log_det(self):
+        return -(self.nb_scans - 1) * np.log(1 - self.rho ** 2)
+
+
+class DenseNoiseStruct(NoiseStruct):
+    """Generic noise structure given as a dense matrix.
+
+    Parameters
+    ----------
+    matrix : ndarray, shape (nb_scans, nb_scans)
+    """
+
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix)
+        NoiseStruct.__init__(self, self.matrix.shape[0])
+
+    def apply(self, array):
+        return np.tensordot(self.matrix, array, axes=(1, 0))
+
+    def log_det(self):
+        return np.log(np.linalg.det(self.matrix))
+
+    def to_array(self):
+        return self.matrix
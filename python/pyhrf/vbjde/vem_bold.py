@@ -35,6 +35,7 @@ from scipy.spatial.distance import mahalanobis
 import pyhrf.vbjde.vem_tools as vt
 
 from pyhrf.boldsynth.hrf import getCanoHRF
+from pyhrf.vbjde.design import DesignCache
 
 logger = logging.getLogger(__name__)
 eps = np.spacing(1)
@@ -43,7 +44,7 @@ eps = np.spacing(1)
 def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes, tr, beta, dt, estimate_sigma_h=True,
                  sigma_h=0.05, it_max=-1, it_min=0, estimate_beta=True, contrasts=None, compute_contrasts=False,
                  hrf_hyperprior=0, estimate_hrf=True, constrained=False, zero_constraint=True, drifts_type="poly",
-                 seed=6537546):
+                 seed=6537546, design_cache=None):
     """This is the main function that computes the VEM analysis on BOLD data.
     This function uses optimized python functions.
 
@@ -95,6 +96,11 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
         for cosine
     seed : int, optional
         seed used by numpy to initialize random generator number
+    design_cache : pyhrf.vbjde.design.DesignCache, optional
+        paradigm-dependent products shared between parcels. It must be built
+        with the same paradigm, drifts type and zero constraint (see
+        :func:`pyhrf.vbjde.design.design_key`). Built from the paradigm if not
+        given.
 
     Returns
     -------
@@ -182,8 +188,16 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
     nb_conditions = len(onsets)
     nb_scans = bold_data.shape[0]
     nb_voxels = bold_data.shape[1]
-    X, occurence_matrix, condition_names = vt.create_conditions(onsets, durations, nb_conditions, nb_scans, hrf_len, tr,
-                                                                dt)
+    if design_cache is None:
+        design_cache = DesignCache.from_paradigm(onsets, durations, nb_scans, hrf_duration, tr, dt, drifts_type,
+                                                 estimate_hrf and zero_constraint)
+    elif design_cache.occurence_matrix.shape[1] != nb_scans:
+        raise Exception('design cache built for %d scans, data has %d scans'
+                        % (design_cache.occurence_matrix.shape[1], nb_scans))
+    X = design_cache.X
+    occurence_matrix = design_cache.occurence_matrix
+    condition_names = design_cache.condition_names
+    drift_basis = design_cache.drift_basis
 
     neighbours_indexes = vt.create_neighbours(graph)
 
@@ -204,9 +218,9 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
     if estimate_hrf and zero_constraint:
         hrf_len = hrf_len - 2
         hrf_regu_prior_inv = hrf_regu_prior_inv[1:-1, 1:-1]
-        occurence_matrix = occurence_matrix[:, :, 1:-1]
 
-    noise_struct = np.identity(nb_scans)
+    noise_struct = design_cache.noise_struct
+    gram = design_cache.gram
 
     noise_var = np.ones(nb_voxels)
 
@@ -228,13 +242,6 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
     beta = beta * np.ones(nb_conditions, dtype=np.float64)
     beta_list = [beta.copy()]
 
-    if drifts_type == "poly":
-        drift_basis = vt.poly_drifts_basis(nb_scans, 4, tr)
-    elif drifts_type == "cos":
-        drift_basis = vt.cosine_drifts_basis(nb_scans, 64, tr)
-    else:
-        raise Exception('drift type "%s" is not supported' % drifts_type)
-
     drift_coeffs = vt.drifts_coeffs_fit(bold_data, drift_basis)
     drift = drift_basis.dot(drift_coeffs)
     bold_data_drift = bold_data - drift
@@ -265,7 +272,7 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
         logger.debug("Before: nrls_mean = %s, nrls_covar = %s", nrls_mean, nrls_covar)
         nrls_mean, nrls_covar = vt.nrls_expectation(hrf_mean, nrls_mean, occurence_matrix, noise_struct, labels_proba,
                                                     nrls_class_mean, nrls_class_var, nb_conditions, bold_data_drift,
-                                                    nrls_covar, hrf_covar, noise_var)
+                                                    nrls_covar, hrf_covar, noise_var, gram=gram)
         logger.debug("After: nrls_mean = %s, nrls_covar = %s", nrls_mean, nrls_covar)
 
         logger.info("Expectation Z step...")
@@ -278,7 +285,8 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
             logger.info("Expectation H step...")
             logger.debug("Before: hrf_mean = %s, hrf_covar = %s", hrf_mean, hrf_covar)
             hrf_mean, hrf_covar = vt.hrf_expectation(nrls_covar, nrls_mean, occurence_matrix, noise_struct,
-                                                     hrf_regu_prior_inv, sigma_h, nb_voxels, bold_data_drift, noise_var)
+                                                     hrf_regu_prior_inv, sigma_h, nb_voxels, bold_data_drift, noise_var,
+                                                     gram=gram)
 
             if constrained:
                 hrf_mean = vt.norm1_constraint(hrf_mean, hrf_covar)
@@ -314,7 +322,7 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
         logger.info("Maximization L step...")
         logger.debug("Before: drift_coeffs = %s", drift_coeffs)
         drift_coeffs = vt.maximization_drift_coeffs(bold_data, nrls_mean, occurence_matrix, hrf_mean, noise_struct,
-                                                    drift_basis)
+                                                    drift_basis, design_cache=design_cache)
         logger.debug("After: drift_coeffs = %s", drift_coeffs)
 
         drift = drift_basis.dot(drift_coeffs)
@@ -329,7 +337,7 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
 
         logger.info("Maximization sigma noise step...")
         noise_var = vt.maximization_noise_var(occurence_matrix, hrf_mean, hrf_covar, nrls_mean, nrls_covar,
-                                              noise_struct, bold_data_drift, nb_scans)
+                                              noise_struct, bold_data_drift, nb_scans, gram=gram)
 
         # Computing Free Energy
         free_energy.append(vt.free_energy_computation(nrls_mean, nrls_covar, hrf_mean, hrf_covar, hrf_len, labels_proba,
@@ -337,7 +345,7 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
                                                       nb_conditions, nb_voxels, nb_scans, nb_classes, nrls_class_mean,
                                                       nrls_class_var, neighbours_indexes, beta, sigma_h,
                                                       np.linalg.inv(hrf_regu_prior_inv), hrf_regu_prior_inv, gamma,
-                                                      hrf_hyperprior))
+                                                      hrf_hyperprior, gram=gram))
 
         free_energy_crit.append(abs((free_energy[-2] - free_energy[-1]) / free_energy[-2]))
 
@@ -345,6 +353,26 @@ def jde_vem_bold(graph, bold_data, onsets, durations, hrf_duration, nb_classes,
         loop += 1
         compute_time.append(time.time() - start_time)
 
+    return _vem_bold_outputs(loop, bold_data, bold_data_drift, X, condition_names, nrls_mean, nrls_covar, hrf_mean,
+                             hrf_covar, labels_proba, noise_var, nrls_class_mean, nrls_class_var, beta, sigma_h,
+                             drift_coeffs, drift, m_h, compute_time, free_energy, free_energy_crit, beta_list,
+                             hrf_duration, dt, nb_classes, contrasts, compute_contrasts, estimate_hrf, constrained,
+                             normalizing, zero_constraint)
+
+
+def _vem_bold_outputs(loop, bold_data, bold_data_drift, X, condition_names, nrls_mean, nrls_covar, hrf_mean, hrf_covar,
+                      labels_proba, noise_var, nrls_class_mean, nrls_class_var, beta, sigma_h, drift_coeffs, drift, m_h,
+                      compute_time, free_energy, free_energy_crit, beta_list, hrf_duration, dt, nb_classes, contrasts,
+                      compute_contrasts, estimate_hrf, constrained, normalizing, zero_constraint):
+    """Post-processes the converged VEM quantities of one parcel.
+
+    This is shared by `jde_vem_bold` and the multi-parcel engine
+    (:func:`pyhrf.vbjde.vem_bold_parcels.jde_vem_bold_parcels`) so that both
+    return exactly the same tuple (see `jde_vem_bold` for its description).
+    """
+
+    nb_scans, nb_voxels = bold_data.shape
+
     compute_time_mean = compute_time[-1] / loop
 
     mahalanobis_zero = np.nan
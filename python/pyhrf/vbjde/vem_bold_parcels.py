@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+
+"""This module implements the VEM for BOLD data on several parcels at once.
+
+All the parcels of a parcellation share the same paradigm, number of scans and
+HRF discretization. The drift basis, the occurrence matrix, the finite
+difference prior and the Gram blocks :math:`X_{m}^{t}\Gamma X_{m'}` are thus
+built only once, and every E/M step of the JDE-VEM algorithm is computed for
+all the parcels with a single set of numpy operations.
+
+The voxels of all parcels are concatenated (segmented layout): parcel *p* owns
+the columns ``starts[p]:starts[p] + nb_voxels[p]`` of every voxel-wise array,
+and per-parcel sums are done with :func:`numpy.add.reduceat`. Parcel-wise
+quantities (HRF, mixture parameters, beta, ...) are stacked along a first
+parcel axis and broadcast to voxels through the ``segments`` index array.
+
+Each parcel keeps its own convergence test. Converged parcels are removed from
+the active set, so that the remaining iterations only involve the parcels that
+still need them. The per-parcel outputs are the same as the ones of
+:func:`pyhrf.vbjde.vem_bold.jde_vem_bold`.
+
+See Also
+--------
+pyhrf.vbjde.vem_bold, pyhrf.ui.vb_jde_analyser
+
+Attributes
+----------
+eps : float
+    mimics the machine epsilon to avoid zero values
+logger : logger
+    logger instance identifying this module to log informations
+
+"""
+
+import time
+import logging
+
+from collections import OrderedDict
+
+import numpy as np
+
+import pyhrf.vbjde.vem_tools as vt
+
+from pyhrf.graph import CSRGraph
+from pyhrf.boldsynth.hrf import getCanoHRF
+from pyhrf.vbjde.design import DesignCache
+from pyhrf.vbjde.vem_bold import _vem_bold_outputs
+
+logger = logging.getLogger(__name__)
+eps = np.spacing(1)
+
+
+class ParcelSegments(object):
+    """Segmented layout of the voxels of several parcels.
+
+    Parameters
+    ----------
+    nb_voxels : array_like of int
+        number of voxels of each parcel
+
+    Attributes
+    ----------
+    nb_voxels : ndarray, shape (nb_parcels,)
+    starts : ndarray, shape (nb_parcels,)
+        index of the first voxel of each parcel in the concatenated arrays
+    segments : ndarray, shape (sum(nb_voxels),)
+        parcel index of each voxel
+    """
+
+    def __init__(self, nb_voxels):
+        self.nb_voxels = np.asarray(nb_voxels, dtype=int)
+        self.starts = np.concatenate(([0], np.cumsum(self.nb_voxels)[:-1]))
+        self.segments = np.repeat(np.arange(len(self.nb_voxels)), self.nb_voxels)
+
+    def __len__(self):
+        return len(self.nb_voxels)
+
+    def slice(self, parcel):
+        """Return the slice of the voxels of the given parcel."""
+        return slice(self.starts[parcel], self.starts[parcel] + self.nb_voxels[parcel])
+
+    def sum(self, array, axis=-1):
+        """Sum `array` over the voxels of each parcel along `axis`."""
+        return np.add.reduceat(array, self.starts, axis=axis)
+
+
+def create_parcels_neighbours(neighbours_list, parcel_segments):
+    """Build the graph of the concatenated parcels.
+
+    Local voxel indexes are shifted by the position of their parcel so that
+    :func:`pyhrf.vbjde.vem_tools.sum_over_neighbours` can be applied on the
+    concatenated arrays. There is no edge between parcels.
+
+    Parameters
+    ----------
+    neighbours_list : list of CSRGraph
+        output of :func:`pyhrf.vbjde.vem_tools.create_neighbours` for each parcel
+    parcel_segments : ParcelSegments
+
+    Returns
+    -------
+    neighbours_indexes : pyhrf.graph.CSRGraph
+    """
+
+    neighbours_indexes = CSRGraph.block_diag(neighbours_list)
+    assert len(neighbours_indexes) == parcel_segments.segments.size
+
+    return neighbours_indexes
+
+
+def hrf_moment_products(gram, hrf_mean, hrf_covar):
+    r"""Computes :math:`\mathrm{E}_{\widetilde{p}_{H}}\left[ G^{t} \Gamma G \right]` for each parcel.
+
+    The :math:`(m, m')` entry is :math:`\widetilde{g}^{t}_{m} \Gamma \widetilde{g}_{m'} + \mathrm{tr}\left( \Gamma
+    X_{m} \Sigma_{H} X^{t}_{m'} \right)`, which is the quantity shared by the VE-A and the M-sigma_epsilon steps.
+
+    Parameters
+    ----------
+    gram : ndarray, shape (nb_conditions, nb_conditions, hrf_len, hrf_len)
+    hrf_mean : ndarray, shape (nb_parcels, hrf_len)
+    hrf_covar : ndarray, shape (nb_parcels, hrf_len, hrf_len)
+
+    Returns
+    -------
+    products : ndarray, shape (nb_parcels, nb_conditions, nb_conditions)
+    """
+
+    hrf_moment = hrf_mean[:, :, np.newaxis] * hrf_mean[:, np.newaxis, :] + hrf_covar.transpose(0, 2, 1)
+    return np.einsum('mlde,pde->pml', gram, hrf_moment)
+
+
+def jde_vem_bold_parcels(graphs, bold_data, onsets, durations, hrf_duration, nb_classes, tr, beta, dt,
+                         estimate_sigma_h=True, sigma_h=0.05, it_max=-1, it_min=0, estimate_beta=True, contrasts=None,
+                         compute_contrasts=False, hrf_hyperprior=0, estimate_hrf=True, constrained=False,
+                         zero_constraint=True, drifts_type="poly", seed=6537546, design_cache=None):
+    """Computes the VEM analysis on BOLD data of several parcels at once.
+
+    The parameters are the ones of :func:`pyhrf.vbjde.vem_bold.jde_vem_bold`
+    except for `graphs` and `bold_data` which are given for every parcel. All
+    parcels must share the same paradigm and number of scans.
+
+    Parameters
+    ----------
+    graphs : list of ndarray of lists
+        graph of each parcel
+    bold_data : list of ndarray, shape (nb_scans, nb_voxels)
+        raw data of each parcel
+    design_cache : pyhrf.vbjde.design.DesignCache, optional
+        see :func:`pyhrf.vbjde.vem_bold.jde_vem_bold`
+
+    Returns
+    -------
+    results : list of tuple
+        for each parcel, the tuple returned by
+        :func:`pyhrf.vbjde.vem_bold.jde_vem_bold`
+    """
+
+    logger.info("Multi-parcel VEM started (%d parcels).", len(bold_data))
+
+    if not contrasts:
+        contrasts = OrderedDict()
+
+    np.random.seed(seed)
+
+    if it_max <= 0:
+        it_max = 100
+
+    gamma = 7.5
+    thresh_free_energy = 1e-4
+
+    # Design quantities shared by all the parcels
+    hrf_len = np.int(np.ceil(hrf_duration / dt)) + 1
+
+    nb_parcels = len(bold_data)
+    nb_conditions = len(onsets)
+    nb_scans = bold_data[0].shape[0]
+    if any(b.shape[0] != nb_scans for b in bold_data):
+        raise Exception('All parcels must have the same number of scans')
+
+    if design_cache is None:
+        design_cache = DesignCache.from_paradigm(onsets, durations, nb_scans, hrf_duration, tr, dt, drifts_type,
+                                                 estimate_hrf and zero_constraint)
+    elif design_cache.occurence_matrix.shape[1] != nb_scans:
+        raise Exception('design cache built for %d scans, data has %d scans'
+                        % (design_cache.occurence_matrix.shape[1], nb_scans))
+    X = design_cache.X
+    occurence_matrix = design_cache.occurence_matrix
+    condition_names = design_cache.condition_names
+    drift_basis = design_cache.drift_basis
+
+    d2 = vt.buildFiniteDiffMatrix(2, hrf_len)
+    hrf_regu_prior_inv = d2.T.dot(d2) / pow(dt, 4)
+
+    if estimate_hrf and zero_constraint:
+        hrf_len = hrf_len - 2
+        hrf_regu_prior_inv = hrf_regu_prior_inv[1:-1, 1:-1]
+
+    hrf_regu_prior = np.linalg.inv(hrf_regu_prior_inv)
+
+    noise_struct = design_cache.noise_struct
+    log_det_noise_struct = noise_struct.log_det()
+    gram = design_cache.gram
+
+    if nb_classes != 2:
+        logger.warn('The number of classes is different to two.')
+
+    m_h = getCanoHRF(hrf_duration, dt)[1][:hrf_len]
+
+    # Parcel-wise initialization
+    neighbours_list = [vt.create_neighbours(graph) for graph in graphs]
+    segs = ParcelSegments([b.shape[1] for b in bold_data])
+    neighbours_indexes = create_parcels_neighbours(neighbours_list, segs)
+    bold = np.concatenate(bold_data, axis=1)
+    nb_voxels_total = bold.shape[1]
+
+    noise_var = np.ones(nb_voxels_total)
+
+    labels_proba = np.zeros((nb_conditions, nb_classes, nb_voxels_total), dtype=np.float64)
+    labels_proba[:, :, :] = 1. / nb_classes
+
+    hrf_mean = np.tile(np.array(m_h).astype(np.float64), (nb_parcels, 1))
+    if estimate_hrf:
+        hrf_covar = np.tile(np.identity(hrf_len, dtype=np.float64), (nb_parcels, 1, 1))
+    else:
+        hrf_covar = np.zeros((nb_parcels, hrf_len, hrf_len), dtype=np.float64)
+
+    sigma_h = sigma_h * np.ones(nb_parcels)
+    beta = beta * np.ones((nb_parcels, nb_conditions), dtype=np.float64)
+
+    drift_coeffs = vt.drifts_coeffs_fit(bold, drift_basis)
+    bold_drift = bold - drift_basis.dot(drift_coeffs)
+
+    nrls_class_mean = 2 * np.ones((nb_conditions, nb_classes))
+    nrls_class_mean[:, 0] = 0
+    nrls_class_var = 0.3 * np.ones((nb_conditions, nb_classes), dtype=np.float64)
+
+    nrls_mean = (np.random.normal(nrls_class_mean, nrls_class_var)[:, :, np.newaxis] * labels_proba).sum(axis=1).T
+    nrls_covar = np.identity(nb_conditions)[:, :, np.newaxis] + np.zeros((1, 1, nb_voxels_total))
+
+    nrls_class_mean = np.tile(nrls_class_mean, (nb_parcels, 1, 1))
+    nrls_class_var = np.tile(nrls_class_var, (nb_parcels, 1, 1))
+
+    # X_m^t Gamma (y_j - P l_j) for every voxel, updated with the drifts
+    xgy = vt.occurence_rdot(occurence_matrix, noise_struct.apply(bold_drift)).transpose(2, 0, 1)
+
+    # Per-parcel bookkeeping, indexed by the original parcel number
+    active = np.arange(nb_parcels)
+    free_energy = [[1.] for _ in xrange(nb_parcels)]
+    free_energy_crit = [[1.] for _ in xrange(nb_parcels)]
+    beta_list = [[b.copy()] for b in beta]
+    compute_time = [[] for _ in xrange(nb_parcels)]
+    finished = [None] * nb_parcels
+
+    start_time = time.time()
+    loop = 0
+    while active.size:
+
+        logger.info("{:-^80}".format(" Iteration n°" + str(loop + 1) + " (" + str(active.size) + " parcels) "))
+        seg = segs.segments
+
+        logger.info("Expectation A step...")
+        hrf_products = hrf_moment_products(gram, hrf_mean, hrf_covar)
+        delta_k = labels_proba / nrls_class_var[seg].transpose(1, 2, 0)
+        delta = delta_k.sum(axis=1)
+        h_tilde = hrf_products[seg].transpose(1, 2, 0) / noise_var
+        nrls_covar = h_tilde.transpose(2, 0, 1) + delta.T[:, np.newaxis, :] * np.eye(nb_conditions)
+        nrls_covar = np.linalg.inv(nrls_covar).transpose(1, 2, 0)
+        x_tilde = np.einsum('jmd,jd->jm', xgy, hrf_mean[seg]) / noise_var[:, np.newaxis]
+        x_tilde += (delta_k * nrls_class_mean[seg].transpose(1, 2, 0)).sum(axis=1).T
+        nrls_mean = np.einsum('ijk,kj->ki', nrls_covar, x_tilde)
+
+        logger.info("Expectation Z step...")
+        labels_proba = labels_expectation_parcels(nrls_covar, nrls_mean, nrls_class_var, nrls_class_mean, beta,
+                                                  labels_proba, neighbours_indexes, segs)
+
+        if estimate_hrf:
+            logger.info("Expectation H step...")
+            cov_noise = np.maximum(noise_var, eps)
+            nrls_moment = (nrls_covar.transpose(2, 0, 1)
+                           + nrls_mean[:, :, np.newaxis] * nrls_mean[:, np.newaxis, :]) / cov_noise[:, np.newaxis,
+                                                                                                    np.newaxis]
+            hrf_covar_inv = (hrf_regu_prior_inv[np.newaxis, :, :] / sigma_h[:, np.newaxis, np.newaxis]
+                             + np.einsum('pml,mlde->pde', segs.sum(nrls_moment, axis=0), gram))
+            hrf_covar = np.linalg.inv(hrf_covar_inv)
+            y_bar_tilde = segs.sum(np.einsum('jmd,jm->jd', xgy, nrls_mean / cov_noise[:, np.newaxis]), axis=0)
+            hrf_mean = np.einsum('pde,pe->pd', hrf_covar, y_bar_tilde)
+
+            if constrained:
+                for parcel in xrange(len(segs)):
+                    hrf_mean[parcel] = vt.norm1_constraint(hrf_mean[parcel], hrf_covar[parcel])
+                hrf_covar[:] = 0
+
+        if estimate_hrf and estimate_sigma_h:
+            logger.info("Maximization sigma_H step...")
+            for parcel in xrange(len(segs)):
+                if hrf_hyperprior > 0:
+                    sigma_h[parcel] = vt.maximization_sigmaH_prior(hrf_len, hrf_covar[parcel], hrf_regu_prior_inv,
+                                                                   hrf_mean[parcel], hrf_hyperprior)
+                else:
+                    sigma_h[parcel] = vt.maximization_sigmaH(hrf_len, hrf_covar[parcel], hrf_regu_prior_inv,
+                                                             hrf_mean[parcel])
+
+        logger.info("Maximization (mu,sigma) step...")
+        nrls_class_mean, nrls_class_var = maximization_class_proba_parcels(labels_proba, nrls_mean, nrls_covar, segs)
+
+        logger.info("Maximization L step...")
+        # P^t Gamma S_j m_H is computed from the cached X_m^t Gamma P products
+        db_ns_om_hm = np.einsum('mdq,pd->pmq', design_cache.om_drift, hrf_mean)
+        drift_coeffs = (design_cache.drift_projector.dot(bold)
+                        - design_cache.drift_gram_inv.dot(np.einsum('jm,jmq->qj', nrls_mean, db_ns_om_hm[seg])))
+        bold_drift = bold - drift_basis.dot(drift_coeffs)
+        ns_bold_drift = noise_struct.apply(bold_drift)
+        xgy = vt.occurence_rdot(occurence_matrix, ns_bold_drift).transpose(2, 0, 1)
+
+        if estimate_beta:
+            logger.info("Maximization beta step...")
+            for parcel, parcel_id in enumerate(active):
+                sl = segs.slice(parcel)
+                for cond_nb in xrange(0, nb_conditions):
+                    beta[parcel, cond_nb], success = vt.beta_maximization(beta[parcel, cond_nb] * np.ones((1,)),
+                                                                          labels_proba[cond_nb, :, sl],
+                                                                          neighbours_list[parcel_id], gamma)
+                beta_list[parcel_id].append(beta[parcel].copy())
+
+        logger.info("Maximization sigma noise step...")
+        hrf_products = hrf_moment_products(gram, hrf_mean, hrf_covar)[seg]
+        noise_var = (np.einsum('jm,jml,jl->j', nrls_mean, hrf_products, nrls_mean)
+                     + np.einsum('mlj,jlm->j', nrls_covar, hrf_products)
+                     + np.einsum('ij,ij->j', bold_drift, ns_bold_drift)
+                     - 2 * np.einsum('jmd,jd,jm->j', xgy, hrf_mean[seg], nrls_mean)) / nb_scans
+
+        # Computing Free Energy
+        parcels_free_energy = free_energy_parcels(nrls_mean, nrls_covar, hrf_mean, hrf_covar, hrf_len, labels_proba,
+                                                  noise_var, log_det_noise_struct, nb_conditions, nb_scans,
+                                                  nrls_class_mean, nrls_class_var, neighbours_indexes, beta, sigma_h,
+                                                  hrf_regu_prior, hrf_regu_prior_inv, gamma, hrf_hyperprior, segs)
+        loop += 1
+        elapsed = time.time() - start_time
+
+        keep = np.ones(active.size, dtype=bool)
+        for parcel, parcel_id in enumerate(active):
+            free_energy[parcel_id].append(parcels_free_energy[parcel])
+            free_energy_crit[parcel_id].append(abs((free_energy[parcel_id][-2] - free_energy[parcel_id][-1])
+                                                   / free_energy[parcel_id][-2]))
+            compute_time[parcel_id].append(elapsed)
+
+            if (loop <= it_min
+                    or ((np.asarray(free_energy_crit[parcel_id][-5:]) > thresh_free_energy).any() and loop < it_max)):
+                continue
+
+            logger.info("Parcel %d converged after %d iterations", parcel_id, loop)
+            keep[parcel] = False
+            sl = segs.slice(parcel)
+            finished[parcel_id] = _vem_bold_outputs(
+                loop, bold_data[parcel_id], bold_drift[:, sl].copy(), X, condition_names, nrls_mean[sl].copy(),
+                nrls_covar[:, :, sl].copy(), hrf_mean[parcel].copy(), hrf_covar[parcel].copy(),
+                labels_proba[:, :, sl].copy(), noise_var[sl].copy(), nrls_class_mean[parcel].copy(),
+                nrls_class_var[parcel].copy(), beta[parcel].copy(), sigma_h[parcel], drift_coeffs[:, sl].copy(),
+                drift_basis.dot(drift_coeffs[:, sl]), m_h, compute_time[parcel_id], free_energy[parcel_id],
+                free_energy_crit[parcel_id], beta_list[parcel_id], hrf_duration, dt, nb_classes, contrasts,
+                compute_contrasts, estimate_hrf, constrained, False, zero_constraint
+            )
+
+        if keep.all():
+            continue
+
+        # Remove the converged parcels from the active set
+        active = active[keep]
+        if not active.size:
+            break
+        voxels = keep[seg]
+        segs = ParcelSegments(segs.nb_voxels[keep])
+        neighbours_indexes = create_parcels_neighbours([neighbours_list[p] for p in active], segs)
+        bold = bold[:, voxels]
+        bold_drift = bold_drift[:, voxels]
+        xgy = xgy[voxels]
+        drift_coeffs = drift_coeffs[:, voxels]
+        noise_var = noise_var[voxels]
+        nrls_mean = nrls_mean[voxels]
+        nrls_covar = nrls_covar[:, :, voxels]
+        labels_proba = labels_proba[:, :, voxels]
+        hrf_mean = hrf_mean[keep]
+        hrf_covar = hrf_covar[keep]
+        sigma_h = sigma_h[keep]
+        beta = beta[keep]
+        nrls_class_mean = nrls_class_mean[keep]
+        nrls_class_var = nrls_class_var[keep]
+
+    logger.info("Multi-parcel VEM done in {t[0]:.0f} min {t[1]:.0f} s".format(t=divmod(time.time() - start_time, 60)))
+
+    return finished
+
+
+def labels_expectation_parcels(nrls_covar, nrls_mean, nrls_class_var, nrls_class_mean, beta, labels_proba,
+                               neighbours_indexes, parcel_segments):
+    """Computes the E-Z step of the JDE-VEM algorithm for concatenated parcels.
+
+    This is the parallel (synchronous) update of
+    :func:`pyhrf.vbjde.vem_tools.labels_expectation` where the mixture
+    parameters and beta are given for each parcel.
+
+    Parameters
+    ----------
+    nrls_covar : ndarray, shape (nb_conditions, nb_conditions, nb_voxels)
+    nrls_mean : ndarray, shape (nb_voxels, nb_conditions)
+    nrls_class_var : ndarray, shape (nb_parcels, nb_conditions, nb_classes)
+    nrls_class_mean : ndarray, shape (nb_parcels, nb_conditions, nb_classes)
+    beta : ndarray, shape (nb_parcels, nb_conditions)
+    labels_proba : ndarray, shape (nb_conditions, nb_classes, nb_voxels)
+    neighbours_indexes : pyhrf.graph.CSRGraph
+    parcel_segments : ParcelSegments
+
+    Returns
+    -------
+    labels_proba : ndarray, shape (nb_conditions, nb_classes, nb_voxels)
+    """
+
+    segments = parcel_segments.segments
+    class_var = nrls_class_var[segments]
+    alpha = (-0.5 * np.diagonal(nrls_covar)[:, :, np.newaxis] / class_var).transpose(1, 2, 0)
+    alpha -= (parcel_segments.sum(alpha, axis=2) / parcel_segments.nb_voxels)[:, :, segments]
+
+    gauss = vt.normpdf(nrls_mean[..., np.newaxis], nrls_class_mean[segments], np.sqrt(class_var)).transpose(1, 2, 0)
+
+    local_energy = vt.sum_over_neighbours(neighbours_indexes, beta[segments].T[:, np.newaxis, :] * labels_proba)
+    energy = alpha + local_energy
+
+    labels_proba_nans = labels_proba.copy()
+    labels_proba = np.exp(energy) * gauss
+
+    if (labels_proba.sum(axis=1) == 0).any():
+        mask = labels_proba.sum(axis=1)[:, np.newaxis, :].repeat(2, axis=1) == 0
+        labels_proba[mask] = labels_proba_nans[mask]
+
+    if np.isinf(labels_proba.sum(axis=1)).any():
+        mask = np.isinf(labels_proba.sum(axis=1))[:, np.newaxis, :].repeat(1, axis=1)
+        labels_proba[mask] = labels_proba_nans[mask]
+
+    return labels_proba / labels_proba.sum(axis=1)[:, np.newaxis, :]
+
+
+def maximization_class_proba_parcels(labels_proba, nrls_mean, nrls_covar, parcel_segments):
+    """Computes the M-(mu, sigma) step of the JDE-VEM algorithm for concatenated parcels.
+
+    See :func:`pyhrf.vbjde.vem_tools.maximization_class_proba`.
+
+    Returns
+    -------
+    nrls_class_mean : ndarray, shape (nb_parcels, nb_conditions, nb_classes)
+    nrls_class_var : ndarray, shape (nb_parcels, nb_conditions, nb_classes)
+    """
+
+    labels_proba_sum = parcel_segments.sum(labels_proba, axis=2)
+
+    nrls_class_mean = np.zeros_like(labels_proba_sum)
+    nrls_class_mean[:, 1] = parcel_segments.sum(labels_proba[:, 1, :] * nrls_mean.T, axis=1) / labels_proba_sum[:, 1]
+    nrls_class_mean = nrls_class_mean.transpose(2, 0, 1)
+
+    nm_minus_ncm = (nrls_mean[..., np.newaxis]
+                    - nrls_class_mean[parcel_segments.segments]).transpose(1, 2, 0)**2
+
+    nrls_covar_diag = np.diagonal(nrls_covar).T
+
+    nrls_class_var = parcel_segments.sum(labels_proba * (nm_minus_ncm + nrls_covar_diag[:, np.newaxis, :]),
+                                         axis=2) / labels_proba_sum
+
+    return nrls_class_mean, nrls_class_var.transpose(2, 0, 1)
+
+
+def free_energy_parcels(nrls_mean, nrls_covar, hrf_mean, hrf_covar, hrf_len, labels_proba, noise_var,
+                        log_det_noise_struct, nb_conditions, nb_scans, nrls_class_mean, nrls_class_var,
+                        neighbours_indexes, beta, sigma_h, hrf_regu_prior, hrf_regu_prior_inv, gamma, hrf_hyperprior,
+                        parcel_segments):
+    """Computes the free energy of each parcel.
+
+    See :func:`pyhrf.vbjde.vem_tools.free_energy_computation`. The noise
+    variance is expected to be the one just computed by the M-sigma_epsilon
+    step, as done in :func:`pyhrf.vbjde.vem_bold.jde_vem_bold`.
+
+    Returns
+    -------
+    free_energy : ndarray, shape (nb_parcels,)
+    """
+
+    segments = parcel_segments.segments
+    nb_voxels = parcel_segments.nb_voxels
+
+    # likelihood (the noise variance is the maximizer of the expectation)
+    expectation_likelihood = - (nb_scans * nb_voxels * np.log(2*np.pi)
+                                - nb_voxels * log_det_noise_struct
+                                + nb_scans * parcel_segments.sum(np.log(np.absolute(noise_var)))
+                                + nb_scans * parcel_segments.sum(noise_var / noise_var)) / 2.
+
+    # nrls
+    const = (2*np.pi)**nb_conditions * np.exp(nb_conditions)
+    det_nrls_covar = np.linalg.det(nrls_covar.transpose((2, 0, 1)))
+    entropy_nrls = parcel_segments.sum(np.log(np.sqrt(const*det_nrls_covar)))
+
+    class_var = nrls_class_var[segments]
+    diag_nrls_covar = np.diagonal(nrls_covar)[:, :, np.newaxis]
+    s = -labels_proba.transpose(2, 0, 1) * (np.log(2*np.pi*class_var)
+                                            + ((nrls_mean[:, :, np.newaxis] - nrls_class_mean[segments])**2
+                                               + diag_nrls_covar) / class_var) / 2
+    expectation_nrls = parcel_segments.sum(s.sum(axis=(1, 2)))
+
+    # labels
+    labels_proba_log = labels_proba.copy()
+    labels_proba_log[labels_proba_log == 0] = eps
+    entropy_labels = -parcel_segments.sum((labels_proba * np.log(labels_proba_log)).sum(axis=(0, 1)))
+
+    labels_neigh = vt.sum_over_neighbours(neighbours_indexes, labels_proba)
+    beta_labels_neigh = beta[segments].T[:, np.newaxis, :] * labels_neigh
+    energy = np.exp(beta_labels_neigh - beta_labels_neigh.max(axis=0))
+    energy /= energy.sum(axis=0)
+    energy_neigh = vt.sum_over_neighbours(neighbours_indexes, energy)
+    first_sum = -parcel_segments.sum(np.log(np.exp(beta_labels_neigh).sum(axis=1)).sum(axis=0))
+    second_sum = (beta.T * parcel_segments.sum((labels_proba * labels_neigh/2.
+                                                + energy * (labels_neigh-energy_neigh/2.)).sum(axis=1),
+                                               axis=1)).sum(axis=0)
+    expectation_labels = first_sum + second_sum
+
+    # hrf
+    total_prior = np.zeros(len(parcel_segments))
+    expectation_hrf = np.zeros(len(parcel_segments))
+    entropy_hrf = np.zeros(len(parcel_segments))
+    for parcel in xrange(len(parcel_segments)):
+        # hrf_covar is set to 0 when the hrf is not estimated
+        if np.linalg.det(hrf_covar[parcel]) != 0:
+            expectation_hrf[parcel] = vt.expectation_ptilde_hrf(hrf_mean[parcel], hrf_covar[parcel], sigma_h[parcel],
+                                                                hrf_regu_prior, hrf_regu_prior_inv, hrf_len)
+            entropy_hrf[parcel] = vt.hrf_entropy(hrf_covar[parcel], hrf_len)
+            if hrf_hyperprior:
+                total_prior[parcel] += np.log(hrf_hyperprior) - hrf_hyperprior*sigma_h[parcel]
+
+    if gamma:
+        total_prior += nb_conditions*np.log(gamma) - gamma*beta.sum(axis=1)
+
+    return (expectation_likelihood + expectation_nrls + expectation_labels + expectation_hrf
+            + entropy_nrls + entropy_hrf + entropy_labels + total_prior)
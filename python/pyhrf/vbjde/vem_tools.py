@@ -17,7 +17,9 @@ from scipy.optimize import fmin_slsqp, brentq, least_squares, leastsq
 from scipy.stats import norm
 from sympy.parsing.sympy_parser import parse_expr
 
-from pyhrf.paradigm import restarize_events
+from pyhrf.graph import CSRGraph, as_csr_graph
+from pyhrf.paradigm import restarize_events, ParadigmOperator
+from pyhrf.vbjde.noise import as_noise_struct, IdentityNoiseStruct
 from pyhrf.boldsynth.hrf import getCanoHRF
 
 
@@ -413,7 +415,8 @@ def create_conditions(onsets, durations, nb_conditions, nb_scans, hrf_len, tr, d
 
 
 def create_neighbours(graph):
-    """Transforms the graph list in ndarray. This is for performances purposes. Sets the empty neighbours to -1.
+    """Transforms the graph list in a CSR graph. This is for performances purposes: sums over neighbours are then
+    sparse matrix products (see :func:`sum_over_neighbours`).
 
     Parameters
     ----------
@@ -422,15 +425,10 @@ def create_neighbours(graph):
 
     Returns
     -------
-    neighbours_indexes : ndarray
+    neighbours_indexes : pyhrf.graph.CSRGraph
     """
 
-    max_neighbours = len(max(graph, key=len))
-
-    neighbours_indexes = [np.concatenate((arr, np.zeros(max_neighbours-len(arr))-1))
-                          for arr in graph]
-
-    return np.asarray(neighbours_indexes, dtype=int)
+    return as_csr_graph(graph)
 
 
 def _trap_area(p1, p2):
@@ -514,7 +512,21 @@ def roc_curve(dvals, labels, rocN=None, normalize=True):
 
 
 def sum_over_neighbours(neighbours_indexes, array_to_sum):
-    """Sums the `array_to_sum` over the neighbours in the graph."""
+    """Sums the `array_to_sum` over the neighbours in the graph.
+
+    Parameters
+    ----------
+    neighbours_indexes : pyhrf.graph.CSRGraph or ndarray
+        graph (see :func:`create_neighbours`), or array of neighbours filled with -1
+    array_to_sum : ndarray, shape (..., nb_voxels)
+
+    Returns
+    -------
+    ndarray, shape (..., nb_voxels)
+    """
+
+    if isinstance(neighbours_indexes, CSRGraph):
+        return neighbours_indexes.sum_over_neighbours(array_to_sum)
 
     if not neighbours_indexes.size:
         return array_to_sum
@@ -522,6 +534,9 @@ def sum_over_neighbours(neighbours_indexes, array_to_sum):
     if neighbours_indexes.max() > array_to_sum.shape[-1] - 1:
         raise Exception("Can't sum over neighbours. Please check dimensions")
 
+    if neighbours_indexes.min() >= 0:
+        return array_to_sum[..., neighbours_indexes].sum(axis=-1)
+
     array_cat_zero = np.concatenate((array_to_sum,
                                      np.zeros(array_to_sum.shape[:-1]+(1,), dtype=array_to_sum.dtype)),
                                     axis=-1)
@@ -759,10 +774,75 @@ def norm1_constraint(function, variance):
 ##############################################################
 
 
+def design_gram_blocks(occurence_matrix, noise_struct):
+    r"""Computes the Gram blocks of the occurrence matrix.
+
+    .. math::
+
+        \mathcal{X}_{m,m'} = \mathbf{X}_{m}^{t} \Gamma \mathbf{X}_{m'}
+
+    Parameters
+    ----------
+    occurence_matrix : ndarray, shape (nb_conditions, nb_scans, hrf_len) or ParadigmOperator
+    noise_struct : NoiseStruct or ndarray, shape (nb_scans, nb_scans)
+
+    Returns
+    -------
+    gram : ndarray, shape (nb_conditions, nb_conditions, hrf_len, hrf_len)
+    """
+
+    if isinstance(occurence_matrix, ParadigmOperator):
+        noise_struct = as_noise_struct(noise_struct)
+        return occurence_matrix.gram(None if isinstance(noise_struct, IdentityNoiseStruct) else noise_struct)
+
+    om_scans = occurence_matrix.transpose(1, 0, 2)
+    return as_noise_struct(noise_struct).quad_form(om_scans).transpose(0, 2, 1, 3)
+
+
+def occurence_rdot(occurence_matrix, array):
+    """Computes :math:`X^{t}_{m} y` for each condition.
+
+    Parameters
+    ----------
+    occurence_matrix : ndarray, shape (nb_conditions, nb_scans, hrf_len) or ParadigmOperator
+    array : ndarray, shape (nb_scans,) or (nb_scans, nb_columns)
+
+    Returns
+    -------
+    ndarray, shape (nb_conditions, hrf_len) or (nb_conditions, hrf_len, nb_columns)
+    """
+
+    if isinstance(occurence_matrix, ParadigmOperator):
+        return occurence_matrix.rdot(array)
+    return np.tensordot(occurence_matrix, array, axes=(1, 0))
+
+
+def hrf_gram_moment(gram, hrf_mean, hrf_covar):
+    r"""Computes :math:`\mathrm{E}_{\widetilde{p}_{H}}\left[ G^{t} \Gamma G \right]`.
+
+    The :math:`(m, m')` entry is :math:`\widetilde{g}^{t}_{m} \Gamma \widetilde{g}_{m'} + \mathrm{tr}\left(
+    \Gamma X_{m} \Sigma_{H} X^{t}_{m'} \right)`, which is the quantity shared by the VE-A and the
+    M-sigma_epsilon steps.
+
+    Parameters
+    ----------
+    gram : ndarray, shape (nb_conditions, nb_conditions, hrf_len, hrf_len)
+        output of :func:`design_gram_blocks`
+    hrf_mean : ndarray, shape (hrf_len,)
+    hrf_covar : ndarray, shape (hrf_len, hrf_len)
+
+    Returns
+    -------
+    ndarray, shape (nb_conditions, nb_conditions)
+    """
+
+    return np.tensordot(gram, np.outer(hrf_mean, hrf_mean) + hrf_covar.T, axes=([2, 3], [0, 1]))
+
+
 def nrls_expectation(hrf_mean, nrls_mean, occurence_matrix, noise_struct,
                      labels_proba, nrls_class_mean, nrls_class_var,
                      nb_conditions, y_tilde, nrls_covar,
-                     hrf_covar, noise_var):
+                     hrf_covar, noise_var, gram=None):
     r"""Computes the VE-A step of the JDE-VEM algorithm.
 
     .. math::
@@ -786,7 +866,7 @@ def nrls_expectation(hrf_mean, nrls_mean, occurence_matrix, noise_struct,
     hrf_mean : ndarray, shape (hrf_len,)
     nrls_mean : ndarray, shape (nb_voxels, nb_conditions)
     occurence_matrix : ndarray, shape (nb_conditions, nb_scans, hrf_len)
-    noise_struct : ndarray, shape (nb_scans, nb_scans)
+    noise_struct : NoiseStruct or ndarray, shape (nb_scans, nb_scans)
     labels_proba : ndarray, shape (nb_conditions, nb_classes, nb_voxels)
     nrls_class_mean : ndarray, shape (nb_conditions, nb_classes)
     nrls_class_var : ndarray, shape (nb_conditions, nb_classes)
@@ -796,6 +876,8 @@ def nrls_expectation(hrf_mean, nrls_mean, occurence_matrix, noise_struct,
     nrls_covar : ndarray, shape (nb_conditions, nb_conditions, nb_voxels)
     hrf_covar : ndarray, shape (hrf_len, hrf_len)
     noise_var : ndarray, shape (nb_voxels,)
+    gram : ndarray, shape (nb_conditions, nb_conditions, hrf_len, hrf_len), optional
+        precomputed output of :func:`design_gram_blocks`
 
     Returns
     -------
@@ -803,27 +885,26 @@ def nrls_expectation(hrf_mean, nrls_mean, occurence_matrix, noise_struct,
     nrls_covar : ndarray, shape (nb_conditions, nb_conditions, nb_voxels)
     """
 
+    noise_struct = as_noise_struct(noise_struct)
+    if gram is None:
+        gram = design_gram_blocks(occurence_matrix, noise_struct)
+
     # Pre-compute some matrix products
     om_hm_prod = occurence_matrix.dot(hrf_mean).T  # matrix G made of columns g_m = X_m * m_H
-    om_hc_prod = occurence_matrix.dot(hrf_covar.T)
-    ns_om_prod = np.tensordot(noise_struct, occurence_matrix, axes=(1, 1))
 
     # first term of nrls_covar: p_q / sigma_h
     delta_k = labels_proba / nrls_class_var[:, :, np.newaxis]
     delta = delta_k.sum(axis=1)  # sum across classes K
 
     # second term of nrls_covar: G.T*Gamma*G + tr(Gamma*X*Sigma_H*X.T)
-    h_tilde = om_hm_prod.T.dot(noise_struct).dot(om_hm_prod)[..., np.newaxis]
-    h_tilde += np.einsum('ijk, jlk', om_hc_prod, ns_om_prod)[..., np.newaxis]
-    h_tilde = h_tilde / noise_var
+    h_tilde = hrf_gram_moment(gram, hrf_mean, hrf_covar)[..., np.newaxis] / noise_var
 
     # nrls_covar computation
     nrls_covar = h_tilde.transpose(2, 0, 1) + delta.T[:, np.newaxis, :] * np.eye(nb_conditions)
     nrls_covar = np.linalg.inv(nrls_covar).transpose(1, 2, 0)
 
     # first term of nrls_mean: G.T*Gamma*y_tilde
-    ns_yt_prod = noise_struct.dot(y_tilde).T
-    x_tilde = ns_yt_prod.dot(om_hm_prod) / noise_var[:, np.newaxis]
+    x_tilde = noise_struct.quad_form(y_tilde, om_hm_prod) / noise_var[:, np.newaxis]
 
     # second term of nrls_mean
     x_tilde += (delta_k * nrls_class_mean[:, :, np.newaxis]).sum(axis=1).T
@@ -835,7 +916,7 @@ def nrls_expectation(hrf_mean, nrls_mean, occurence_matrix, noise_struct,
 
 
 def hrf_expectation(nrls_covar, nrls_mean, occurence_matrix, noise_struct, hrf_regu_prior_inv, sigmaH, nb_voxels,
-                    y_tilde, noise_var, prior_mean_term=0., prior_cov_term=0.):
+                    y_tilde, noise_var, prior_mean_term=0., prior_cov_term=0., gram=None):
 
     r"""Computes the VE-H step of the JDE-VEM algorithm.
 
@@ -861,12 +942,17 @@ def hrf_expectation(nrls_covar, nrls_mean, occurence_matrix, noise_struct, hrf_r
     :math:`m^{th}` and :math:`(m,m')^{th}` entries of the mean vector and covariance matrix of the current
     :math:`q^{(r-1)}_{A_{i}}`, respectively.
 
+    Since :math:`\widetilde{S}_{i}^{t} \Gamma \widetilde{S}_{i} = \sum_{m,m'} m_{A_{mi}} m_{A_{m'i}}
+    \mathbf{X}^{t}_{m} \Gamma \mathbf{X}_{m'}`, both sums over the voxels are computed from the
+    :math:`(M, M)` weights :math:`\sum_{i} (\sigma_{A_{mi}A_{m'i}} + m_{A_{mi}} m_{A_{m'i}}) /
+    \sigma^{2}_{i}` and the Gram blocks of the occurrence matrix (see :func:`design_gram_blocks`).
+
     Parameters
     ----------
     nrls_covar : ndarray, shape (nb_conditions, nb_conditions, nb_voxels)
     nrls_mean : ndarray, shape (nb_voxels, nb_conditions)
     occurence_matrix : ndarray, shape (nb_conditions, nb_scans, hrf_len)
-    noise_struct : ndarray, shape (nb_scans, nb_scans)
+    noise_struct : NoiseStruct or ndarray, shape (nb_scans, nb_scans)
     hrf_regu_prior_inv : ndarray, shape (hrf_len, hrf_len)
         inverse of the hrf regularization prior matrix `R`
     sigmaH : float
@@ -875,6 +961,8 @@ def hrf_expectation(nrls_covar, nrls_mean, occurence_matrix, noise_struct, hrf_r
     noise_var : ndarray, shape (nb_voxels,)
     prior_mean_term : float, optional
     prior_cov_term : float, optional
+    gram : ndarray, shape (nb_conditions, nb_conditions, hrf_len, hrf_len), optional
+        precomputed output of :func:`design_gram_blocks`
 
     Returns
     -------
@@ -882,23 +970,20 @@ def hrf_expectation(nrls_covar, nrls_mean, occurence_matrix, noise_struct, hrf_r
     hrf_covar : ndarray, shape (hrf_len, hrf_len)
     """
 
-    # Pre-compute some matrix products
-    nm_om_prod = np.tensordot(nrls_mean, occurence_matrix, axes=(1, 0))
-    ns_om_prod = np.tensordot(noise_struct, occurence_matrix, axes=(1, 1))
-    om_ns_om_prod = np.tensordot(occurence_matrix.T, ns_om_prod, axes=(1, 0))
-    cov_noise = np.maximum(noise_var, eps)[:, np.newaxis, np.newaxis]
-    nm_om_ns_prod = np.tensordot(nm_om_prod, noise_struct, axes=(1, 0)) / cov_noise
+    noise_struct = as_noise_struct(noise_struct)
+    if gram is None:
+        gram = design_gram_blocks(occurence_matrix, noise_struct)
+
+    noise_var_inv = 1. / np.maximum(noise_var, eps)
+    weighted_nrls_mean = nrls_mean * noise_var_inv[:, np.newaxis]
 
     # Sigma_H computation
     # first term: part of the prior -> R^-1 / sigmaH
     hrf_covar_inv = hrf_regu_prior_inv / sigmaH
 
-    # second term: sum_{m, m'} (Sigma_a(m,m') * X_m.T * noise_struct_i * X_m')
-    hrf_covar_inv += (np.einsum('ijk,lijm->klm', nrls_covar, om_ns_om_prod) / cov_noise).sum(0)
-
-    # third term: let S=sum_m (m_a * X_m), then S.T * noise_struct_i * S
-    for i in xrange(nb_voxels):
-        hrf_covar_inv += nm_om_ns_prod[i, :, :].dot(nm_om_prod[i, :, :])
+    # second and third terms: sum_{m, m'} (Sigma_a(m,m') + m_a(m) * m_a(m')) * X_m.T * noise_struct_i * X_m'
+    nrls_moment = nrls_covar.dot(noise_var_inv) + nrls_mean.T.dot(weighted_nrls_mean)
+    hrf_covar_inv += np.tensordot(nrls_moment, gram, axes=([0, 1], [0, 1]))
 
     # forth term (depends on prior type): we sum the term that corresponds to the prior
     hrf_covar_inv += prior_cov_term
@@ -906,8 +991,12 @@ def hrf_expectation(nrls_covar, nrls_mean, occurence_matrix, noise_struct, hrf_r
     # Sigma_H
     hrf_covar = np.linalg.inv(hrf_covar_inv)
 
-    # m_H computation: S.T * noise_struct_i * y_tilde
-    y_bar_tilde = np.einsum('ijk,ki->j', nm_om_ns_prod, y_tilde)
+    # m_H computation: sum_i S_i.T * noise_struct_i * y_tilde_i
+    ns_yt_prod = noise_struct.apply(y_tilde.dot(weighted_nrls_mean))
+    if isinstance(occurence_matrix, ParadigmOperator):
+        y_bar_tilde = occurence_matrix.sum_rdot(ns_yt_prod)
+    else:
+        y_bar_tilde = np.einsum('ijk,ji->k', occurence_matrix, ns_yt_prod)
 
     # we sum the term that corresponds to the prior
     y_bar_tilde += prior_mean_term
@@ -965,9 +1054,8 @@ def labels_expectation(nrls_covar, nrls_mean, nrls_class_var, nrls_class_mean, b
     nrls_class_mean : ndarray, shape (nb_conditions, nb_classes)
     beta : ndarray, shape
     labels_proba : ndarray, shape (nb_conditions, nb_classes, nb_voxels)
-    neighbours_indexes : ndarray, shape (nb_voxels, max(len(a) for a in graph))
-        This is the version of graph array where arrays from graph smaller than
-        the maximum ones are filled with -1
+    neighbours_indexes : pyhrf.graph.CSRGraph
+        graph of the voxels (see :func:`create_neighbours`)
     nb_conditions : int
     nb_classes : int
     nb_voxels : int
@@ -989,10 +1077,11 @@ def labels_expectation(nrls_covar, nrls_mean, nrls_class_var, nrls_class_mean, b
     if not parallel and nb_voxels:
         energy = np.zeros_like(labels_proba)
         local_energy = np.zeros_like(labels_proba)
+        graph = as_csr_graph(neighbours_indexes)
 
         for vox in xrange(nb_voxels):
-            local_energy[:, :, vox] = sum_over_neighbours(neighbours_indexes[vox, :],
-                                                          beta[..., np.newaxis, np.newaxis] * labels_proba)
+            local_energy[:, :, vox] = (beta[..., np.newaxis, np.newaxis]
+                                       * labels_proba[:, :, graph[vox]]).sum(axis=2)
 
             energy[:, :, vox] = alpha[:, :, vox] + local_energy[:, :, vox]
 
@@ -1056,21 +1145,44 @@ def maximization_class_proba(labels_proba, nrls_mean, nrls_covar):
     return nrls_class_mean, nrls_class_var
 
 
-def maximization_drift_coeffs(data, nrls_mean, occurence_matrix, hrf_mean, noise_struct, drift_basis):
+def maximization_drift_coeffs(data, nrls_mean, occurence_matrix, hrf_mean, noise_struct, drift_basis,
+                              design_cache=None):
     r"""Computes the M-(l, Gamma) step of the JDE-VEM algorithm. In the AR(1) case:
 
     .. math::
 
         \ell^{(r)}_{j} = \left( \bm{P}^{\intercal} \bm{\Lambda}^{(r)}_{j} \bm{P} \right)^{-1} \bm{P}^{\intercal} \bm{\Lambda}^{(r)}_{j} \left( y_{j} - \bm{\widetilde{S}}_{j} m^{(r)}_{H} \right)
 
+    Parameters
+    ----------
+    data : ndarray, shape (nb_scans, nb_voxels)
+    nrls_mean : ndarray, shape (nb_voxels, nb_conditions)
+    occurence_matrix : ndarray, shape (nb_conditions, nb_scans, hrf_len)
+    hrf_mean : ndarray, shape (hrf_len,)
+    noise_struct : NoiseStruct or ndarray, shape (nb_scans, nb_scans)
+    drift_basis : ndarray, shape (nb_scans, nb_drift_coeffs)
+    design_cache : pyhrf.vbjde.design.DesignCache, optional
+        if given, its cached products (built with the same noise structure)
+        are used and the stimulus induced signal is never formed
+
+    Returns
+    -------
+    drift_coeffs : ndarray, shape (nb_drift_coeffs, nb_voxels)
     """
 
+    if design_cache is not None:
+        db_ns_om_hm = design_cache.om_drift.transpose(0, 2, 1).dot(hrf_mean)
+        return (design_cache.drift_projector.dot(data)
+                - design_cache.drift_gram_inv.dot(nrls_mean.dot(db_ns_om_hm).T))
+
+    noise_struct = as_noise_struct(noise_struct)
+
     # Precomputations
-    db_ns_db = drift_basis.T.dot(noise_struct).dot(drift_basis)
+    db_ns_db = noise_struct.quad_form(drift_basis)
 
     data_s = data - nrls_mean.dot(occurence_matrix.dot(hrf_mean)).T
 
-    return np.linalg.inv(db_ns_db).dot(drift_basis.T).dot(noise_struct).dot(data_s)
+    return np.linalg.inv(db_ns_db).dot(noise_struct.quad_form(drift_basis, data_s))
 
 
 def maximization_sigmaH(D, Sigma_H, R, m_H):
@@ -1109,7 +1221,7 @@ def maximization_sigmaH_prior(D, Sigma_H, R, m_H, gamma_h):
 
 
 def maximization_noise_var(occurence_matrix, hrf_mean, hrf_covar, nrls_mean, nrls_covar, noise_struct, data_drift,
-                           nb_scans):
+                           nb_scans, gram=None):
     r"""Computes the M-sigma_epsilon step of the JDE-VEM algorithm.
 
     .. math::
@@ -1126,21 +1238,40 @@ def maximization_noise_var(occurence_matrix, hrf_mean, hrf_covar, nrls_mean, nrl
 
         \widetilde{g}^{t}_{m}\Lambda^{(r)}_{j}\widetilde{g}_{m'} + \mathrm{tr}\left(\Lambda^{(r)}_{j} X_{m}
         \Sigma^{(r)}_{H} X^{t}_{m'} \right)
+
+    Parameters
+    ----------
+    occurence_matrix : ndarray, shape (nb_conditions, nb_scans, hrf_len)
+    hrf_mean : ndarray, shape (hrf_len,)
+    hrf_covar : ndarray, shape (hrf_len, hrf_len)
+    nrls_mean : ndarray, shape (nb_voxels, nb_conditions)
+    nrls_covar : ndarray, shape (nb_conditions, nb_conditions, nb_voxels)
+    noise_struct : NoiseStruct or ndarray, shape (nb_scans, nb_scans)
+    data_drift : ndarray, shape (nb_scans, nb_voxels)
+    nb_scans : int
+    gram : ndarray, shape (nb_conditions, nb_conditions, hrf_len, hrf_len), optional
+        precomputed output of :func:`design_gram_blocks`
+
+    Returns
+    -------
+    noise_var : ndarray, shape (nb_voxels,)
     """
 
+    noise_struct = as_noise_struct(noise_struct)
+    if gram is None:
+        gram = design_gram_blocks(occurence_matrix, noise_struct)
+
     # Precomputations
     om_hm = occurence_matrix.dot(hrf_mean)
-    ns_om = np.tensordot(noise_struct, occurence_matrix, axes=(1, 1))
     nm_om_hm = nrls_mean.dot(om_hm)
 
-    hm_om_ns_om_hm = ns_om.transpose(1, 0, 2).dot(hrf_mean).dot(om_hm.T)
-    hc_om_ns_om = np.einsum('ijk,ljk->il', occurence_matrix.dot(hrf_covar.T), ns_om.transpose(1, 0, 2))
+    hm_om_ns_om = hrf_gram_moment(gram, hrf_mean, hrf_covar)
 
-    hm_om_nm_ns_nm_om_hm = np.einsum('ij,ij->i', nrls_mean.dot(hm_om_ns_om_hm + hc_om_ns_om), nrls_mean)
+    hm_om_nm_ns_nm_om_hm = np.einsum('ij,ij->i', nrls_mean.dot(hm_om_ns_om), nrls_mean)
 
-    tr_nc_om_ns_om = np.einsum('ijk,ji->k', nrls_covar, hm_om_ns_om_hm + hc_om_ns_om)
+    tr_nc_om_ns_om = np.einsum('ijk,ji->k', nrls_covar, hm_om_ns_om)
 
-    ns_df = noise_struct.dot(data_drift)
+    ns_df = noise_struct.apply(data_drift)
     df_ns_df = np.einsum('ij,ij->j', data_drift, ns_df)
 
     nm_om_hm_ns_df = np.einsum('ij,ji->i', nm_om_hm, ns_df)
@@ -1184,7 +1315,7 @@ def beta_gradient(beta, labels_proba, labels_neigh, neighbours_indexes, gamma, g
     beta : float
     labels_proba : ndarray
     labels_neigh : ndarray
-    neighbours_indexes : ndarray
+    neighbours_indexes : pyhrf.graph.CSRGraph
     gamma : float
     gradient_method : str
         for testing purposes
@@ -1227,7 +1358,7 @@ def beta_maximization(beta, labels_proba, neighbours_indexes, gamma):
     beta : ndarray
         initial value of beta
     labels_proba : ndarray
-    neighbours_indexes : ndarray
+    neighbours_indexes : pyhrf.graph.CSRGraph
     gamma : float
 
     Returns
@@ -1781,9 +1912,8 @@ def expectation_Q_asl(Sigma_A, m_A, Sigma_C, m_C, sigma_Ma, mu_Ma, sigma_Mc, \
     # Update Ztilde ie the quantity which is involved in the a priori
     # Potts field [by solving for the mean-field fixed point Equation]
     # TODO: decide if we take out the computation of p_q_t or Ztilde
-    B_pqt = Beta[:, np.newaxis, np.newaxis] * p_q_t.copy()
-    B_pqt = np.concatenate((B_pqt, np.zeros((M, K, 1), dtype=B_pqt.dtype)), axis=2)
-    local_energy = B_pqt[:, :, neighbours_indexes].sum(axis=3).transpose(2, 0, 1)
+    B_pqt = Beta[:, np.newaxis, np.newaxis] * p_q_t
+    local_energy = sum_over_neighbours(neighbours_indexes, B_pqt).transpose(2, 0, 1)
     energy = (alpha + local_energy)
     energy -= energy.max()
     Probas = (np.exp(energy) * Gauss_mat).transpose(1, 2, 0)
@@ -1807,9 +1937,8 @@ def expectation_Q_ms(Sigma_A, m_A, Sigma_C, m_C, sigma_Ma, mu_Ma, sigma_Mc, \
     # Update Ztilde ie the quantity which is involved in the a priori
     # Potts field [by solving for the mean-field fixed point Equation]
     # TODO: decide if we take out the computation of p_q_t or Ztilde
-    B_pqt = Beta[:, np.newaxis, np.newaxis] * p_q_t.copy()
-    B_pqt = np.concatenate((B_pqt, np.zeros((M, K, 1), dtype=B_pqt.dtype)), axis=2)
-    local_energy = B_pqt[:, :, neighbours_indexes].sum(axis=3).transpose(2, 0, 1)
+    B_pqt = Beta[:, np.newaxis, np.newaxis] * p_q_t
+    local_energy = sum_over_neighbours(neighbours_indexes, B_pqt).transpose(2, 0, 1)
     energy = (local_energy + alpha + Gauss_mat )
     #energy -= energy.max()
     Probas = (np.exp(energy)).transpose(1, 2, 0)
@@ -1831,10 +1960,9 @@ def expectation_Q_async_asl(Sigma_A, m_A, Sigma_C, m_C, sigma_Ma, mu_Ma, sigma_M
     energy = np.zeros_like(p_q_t)
     local_energy = np.zeros_like(p_q_t)
     Probas = np.zeros_like(p_q_t)
+    graph = as_csr_graph(neighbours_indexes)
     for vox in xrange(J):
-        B_pqt = Beta[:, np.newaxis, np.newaxis] * p_q_t.copy()
-        B_pqt = np.concatenate((B_pqt, np.zeros((M, K, 1), dtype=B_pqt.dtype)), axis=2)
-        local_energy[:, :, vox] = B_pqt[:, :, neighbours_indexes[vox, :]].sum(axis=2)
+        local_energy[:, :, vox] = (Beta[:, np.newaxis, np.newaxis] * p_q_t[:, :, graph[vox]]).sum(axis=2)
         energy[:, :, vox] = (alpha[:, :, vox] + local_energy[:, :, vox])
         Probas[:, :, vox] = (np.exp(energy[:, :, vox]) * Gauss_mat[:, :, vox])
         aux = Probas[:, :, vox].sum(axis=1)[:, np.newaxis]
@@ -2410,7 +2538,7 @@ def computeFit(hrf_mean, nrls_mean, X, nb_voxels, nb_scans):
     ----------
     hrf_mean: ndarray
     nrls_mean: ndarray
-    X: OrderedDict
+    X: OrderedDict or ParadigmOperator
     nb_voxels: int
     nb_scans: int
 
@@ -2419,6 +2547,9 @@ def computeFit(hrf_mean, nrls_mean, X, nb_voxels, nb_scans):
     ndarray
     """
 
+    if isinstance(X, ParadigmOperator):
+        return nrls_mean.dot(X.dot(hrf_mean)).T
+
     stim_ind_signal = np.zeros((nb_scans, nb_voxels), dtype=np.float64)
 
     for voxel in xrange(0, nb_voxels):
@@ -2429,7 +2560,7 @@ def computeFit(hrf_mean, nrls_mean, X, nb_voxels, nb_scans):
 
 
 def expectation_ptilde_likelihood(data_drift, nrls_mean, nrls_covar, hrf_mean, hrf_covar, occurence_matrix, noise_var,
-                                  noise_struct, nb_voxels, nb_scans):
+                                  noise_struct, nb_voxels, nb_scans, gram=None):
     r"""Expectation with respect to likelihood.
 
     .. math::
@@ -2456,20 +2587,23 @@ def expectation_ptilde_likelihood(data_drift, nrls_mean, nrls_covar, hrf_mean, h
     hrf_covar : ndarray, shape (hrf_len, hrf_len)
     occurence_matrix : ndarray, shape (nb_conditions, nb_scans, hrf_len)
     noise_var : ndarray, shape (nb_voxels,)
-    noise_struct : ndarray, shape (nb_scans, nb_scans)
+    noise_struct : NoiseStruct or ndarray, shape (nb_scans, nb_scans)
     nb_voxels : int
     nb_scans : int
+    gram : ndarray, shape (nb_conditions, nb_conditions, hrf_len, hrf_len), optional
+        precomputed output of :func:`design_gram_blocks`
 
     Returns
     -------
     ptilde_likelihood : float
     """
 
+    noise_struct = as_noise_struct(noise_struct)
     noise_var_tmp = maximization_noise_var(occurence_matrix, hrf_mean, hrf_covar, nrls_mean,
-                                           nrls_covar, noise_struct, data_drift, nb_scans)
+                                           nrls_covar, noise_struct, data_drift, nb_scans, gram=gram)
 
     return - (nb_scans * nb_voxels*np.log(2*np.pi)
-              - nb_voxels * np.log(np.linalg.det(noise_struct))
+              - nb_voxels * noise_struct.log_det()
               + nb_scans * np.log(np.absolute(noise_var)).sum()
               + nb_scans * (noise_var_tmp / noise_var).sum()) / 2.
 
@@ -2511,10 +2645,7 @@ def expectation_ptilde_labels(labels_proba, neighbours_indexes, beta, nb_conditi
     """
 
     # term p_{q^{m}_{k}}
-    labels_neigh = np.concatenate((labels_proba,
-                                   np.zeros((nb_conditions, nb_classes, 1), dtype=labels_proba.dtype)),
-                                  axis=2)
-    labels_neigh = labels_neigh[:, :, neighbours_indexes].sum(axis=3)
+    labels_neigh = sum_over_neighbours(neighbours_indexes, labels_proba)
 
     beta_labels_neigh = beta[:, np.newaxis, np.newaxis] * labels_neigh
 
@@ -2523,7 +2654,7 @@ def expectation_ptilde_labels(labels_proba, neighbours_indexes, beta, nb_conditi
     energy /= energy.sum(axis=0)
 
     # term p^{MF}_{k}
-    energy_neigh = energy[:, :, neighbours_indexes].sum(axis=3)
+    energy_neigh = sum_over_neighbours(neighbours_indexes, energy)
 
     first_sum = -np.log(np.exp(beta_labels_neigh).sum(axis=1)).sum()
     second_sum = (beta * (labels_proba * labels_neigh/2.
@@ -2562,7 +2693,7 @@ def free_energy_computation(nrls_mean, nrls_covar, hrf_mean, hrf_covar, hrf_len,
                             noise_struct, nb_conditions, nb_voxels, nb_scans, nb_classes,
                             nrls_class_mean, nrls_class_var, neighbours_indexes,
                             beta, sigma_h, hrf_regu_prior, hrf_regu_prior_inv,
-                            gamma, hrf_hyperprior):
+                            gamma, hrf_hyperprior, gram=None):
     r"""Compute the free energy functional.
 
     .. math::
@@ -2582,7 +2713,8 @@ def free_energy_computation(nrls_mean, nrls_covar, hrf_mean, hrf_covar, hrf_len,
 
     expectation_likelihood = expectation_ptilde_likelihood(data_drift, nrls_mean, nrls_covar,
                                                            hrf_mean, hrf_covar, occurence_matrix,
-                                                           noise_var, noise_struct, nb_voxels, nb_scans)
+                                                           noise_var, noise_struct, nb_voxels, nb_scans,
+                                                           gram=gram)
 
     entropy_nrls = nrls_entropy(nrls_covar, nb_conditions)
     expectation_nrls = expectation_ptilde_nrls(labels_proba, nrls_class_mean, nrls_class_var, nrls_mean, nrls_covar)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the estimation of log-partition functions of Potts fields from
+the reference lnZ table (pyhrf.jde.lnz_table), against on-line path sampling.
+
+1. Leave-one-out on the reference table: each reference grid is estimated
+   from the other ones, with the closest reference extrapolation ("es",
+   Cpt_Vec_Estim_lnZ_Graph_ref) and with the interpolation ("interp",
+   interpolate_lnz).
+2. Parcels of the packaged parcellation: lnZ grids estimated by "es" and
+   "interp" are compared to path sampling ("ps"), along with the time taken
+   by each method, ie the warm-up time of BetaSampler per parcel.
+
+Errors are the maximum over beta in [0, 1.4] of |lnZ - lnZ_ref| divided by
+the number of cliques, so that they are comparable across graph sizes.
+"""
+import time
+
+import numpy as np
+
+import pyhrf
+from pyhrf.tools._io import read_volume
+from pyhrf.graph import parcels_to_csr_graphs, kerMask3D_6n
+from pyhrf.jde.beta import Cpt_Vec_Estim_lnZ_Graph, Cpt_Vec_Estim_lnZ_Graph_fast3
+from pyhrf.jde.lnz_table import (load_lnz_table, interpolate_lnz,
+                                 interpolate_lnz_from_descriptors)
+
+
+def grid_error(grid, ref_grid, nb_cliques):
+    betas = ref_grid[1]
+    lnz = np.interp(betas, grid[1], grid[0])
+    return np.abs(lnz - ref_grid[0])[betas <= 1.4].max() / nb_cliques
+
+
+def leave_one_out(table):
+    print 'Leave-one-out on the reference table (error / clique):'
+    print '%8s %8s %20s %20s' % ('labels', 'nb refs', 'es (median, max)',
+                                 'interp (median, max)')
+    for nb_labels in np.unique(table['nb_labels']):
+        refs = np.where(table['nb_labels'] == nb_labels)[0]
+        errors = {'es': [], 'interp': []}
+        for i in refs:
+            others = table[np.arange(len(table)) != i]
+            ref = table[i]
+            sites = ref['nb_sites'] + 0.
+            cliques = ref['nb_cliques'] + 0.
+            # closest reference, rescaled by the ratio of clique numbers:
+            same = others[others['nb_labels'] == nb_labels]
+            logN = np.log(nb_labels)
+            err0 = (np.abs((same['nb_sites'] - 1.) * cliques /
+                           same['nb_cliques'] - (sites - 1.)) * logN +
+                    np.abs(same['std_ngbh'] - ref['std_ngbh']))
+            best = same[np.argmin(err0)]
+            ratio = cliques / best['nb_cliques']
+            es = ratio * best['log_pf'] + (1 - ratio) * logN
+            errors['es'].append(np.abs(es - ref['log_pf']).max() / cliques)
+            interp = interpolate_lnz_from_descriptors(
+                nb_labels, ref['nb_sites'], ref['nb_cliques'],
+                ref['std_ngbh'], table=others)
+            if interp is None:  # density out of the range of the others
+                continue
+            errors['interp'].append(np.abs(interp[0] - ref['log_pf']).max() /
+                                    cliques)
+        print '%8d %8d %9.4f, %8.4f %9.4f, %8.4f' % \
+            (nb_labels, len(refs), np.median(errors['es']),
+             np.max(errors['es']), np.median(errors['interp']),
+             np.max(errors['interp']))
+
+
+def parcels(nb_labels=2):
+    parcellation = read_volume(
+        pyhrf.get_data_file_name('subj0_parcellation.nii.gz'))[0]
+    graphs = parcels_to_csr_graphs(parcellation.astype(int), kerMask3D_6n,
+                                   toDiscard=[0])
+    print
+    print 'Parcels of subj0_parcellation (%d labels), error / clique ' \
+        'w.r.t. path sampling and time (s):' % nb_labels
+    print '%6s %6s %8s | %8s | %8s %8s | %8s %8s' % \
+        ('parcel', 'sites', 'cliques', 'ps time', 'es err', 'es time',
+         'int err', 'int time')
+    for parcel_id, graph in sorted(graphs.items()):
+        np.random.seed(parcel_id)
+        t0 = time.time()
+        ps = Cpt_Vec_Estim_lnZ_Graph(graph, nb_labels)
+        t_ps = time.time() - t0
+        t0 = time.time()
+        es = Cpt_Vec_Estim_lnZ_Graph_fast3(graph, nb_labels)
+        t_es = time.time() - t0
+        t0 = time.time()
+        interp = interpolate_lnz(graph, nb_labels)
+        t_interp = time.time() - t0
+        nb_cliques = graph.nb_cliques()
+        print '%6d %6d %8d | %8.3f | %8.4f %8.3f | %8s %8.4f' % \
+            (parcel_id, len(graph), nb_cliques, t_ps,
+             grid_error(es, ps, nb_cliques), t_es,
+             '%.4f' % grid_error(interp, ps, nb_cliques)
+             if interp is not None else 'n/a', t_interp)
+
+
+if __name__ == '__main__':
+    leave_one_out(load_lnz_table())
+    for nb_labels in [2, 3]:
+        parcels(nb_labels)